@@ -0,0 +1,449 @@
+'''
+load and latency benchmark for the HTTP API
+
+Drives the routes in src/main.py with a pool of virtual users, either
+in-process through httpx's ASGI transport or against a multi-worker uvicorn
+started for the run, and reports throughput and p50/p95/p99 per endpoint.
+
+    python -m benchmarks.load --workload mixed --duration 10 --concurrency 32
+    python -m benchmarks.load --mode uvicorn --workers 4 --workload login --json login.json
+    python -m benchmarks.load --db bench.db --workload history --baseline login.json
+
+Without --db a temporary database is seeded (see benchmarks.seed for the
+users/items it contains). Settings such as GROUP_COMMIT_ENABLED or
+HASH_WORKERS are read from the environment as usual, so the same workload
+can be compared across configurations as well as across commits.
+'''
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter, defaultdict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+import httpx
+
+from benchmarks.seed import seed, BENCH_PASSWORD, ADMIN_USERNAME
+
+# Rows per /admin/items/import request
+IMPORT_ROWS = 20
+
+
+@dataclass
+class EndpointStats:
+    latencies: List[float] = field(default_factory=list)
+    statuses: Counter = field(default_factory=Counter)
+    errors: int = 0
+
+    def summary(self, elapsed: float) -> dict:
+        latencies = sorted(self.latencies)
+        return {
+            "requests": len(latencies),
+            "rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+            "p50_ms": percentile(latencies, 50),
+            "p95_ms": percentile(latencies, 95),
+            "p99_ms": percentile(latencies, 99),
+            "max_ms": round(latencies[-1] * 1000, 3) if latencies else None,
+            "errors": self.errors,
+            "statuses": {str(code): count for code, count in sorted(self.statuses.items())},
+        }
+
+
+def percentile(sorted_latencies: List[float], pct: float) -> Optional[float]:
+    if not sorted_latencies:
+        return None
+    # Nearest-rank
+    rank = max(0, math.ceil(pct / 100 * len(sorted_latencies)) - 1)
+    return round(sorted_latencies[rank] * 1000, 3)
+
+
+class VirtualUser:
+    def __init__(self, client: httpx.AsyncClient, stats: Dict[str, EndpointStats], ctx: dict, index: int):
+        self.client = client
+        self.stats = stats
+        self.ctx = ctx
+        self.index = index
+        self.username = f"bench{index % ctx['users']}"
+        self.rng = random.Random(index)
+        self.headers: Dict[str, str] = {}
+        self.refresh_token: Optional[str] = None
+
+    async def request(self, label: str, method: str, url: str, **kwargs) -> Optional[httpx.Response]:
+        stats = self.stats[label]
+        started = time.perf_counter()
+        try:
+            response = await self.client.request(method, url, **kwargs)
+        except httpx.HTTPError:
+            stats.errors += 1
+            return None
+        stats.latencies.append(time.perf_counter() - started)
+        stats.statuses[response.status_code] += 1
+        if response.status_code >= 500:
+            stats.errors += 1
+        return response
+
+    async def login(self, username: Optional[str] = None) -> None:
+        response = await self.request("POST /auth/login", "POST", "/auth/login",
+                                      json={"username": username or self.username, "password": BENCH_PASSWORD})
+        if username is None and response is not None and response.status_code == 200:
+            body = response.json()
+            self.headers = {"Authorization": f"Bearer {body['access_token']}"}
+            self.refresh_token = body["refresh_token"]
+
+    def other_user(self) -> str:
+        users = self.ctx["users"]
+        other = self.rng.randrange(users)
+        if users > 1 and f"bench{other}" == self.username:
+            other = (other + 1) % users
+        return f"bench{other}"
+
+    # Operations, one per route; picked by the workload weights
+
+    async def op_register(self):
+        name = f"reg_{uuid.uuid4().hex[:16]}"
+        await self.request("POST /auth/register", "POST", "/auth/register",
+                           json={"username": name, "password": BENCH_PASSWORD})
+
+    async def op_login(self):
+        # A random user each time, keeping this user's own tokens: the bcrypt-bound path
+        await self.login(self.other_user())
+
+    async def op_refresh(self):
+        response = await self.request("POST /auth/refresh", "POST", "/auth/refresh",
+                                      json={"refresh_token": self.refresh_token})
+        if response is not None and response.status_code == 200:
+            body = response.json()
+            self.headers = {"Authorization": f"Bearer {body['access_token']}"}
+            self.refresh_token = body["refresh_token"]
+
+    async def op_logout(self):
+        await self.request("POST /auth/logout", "POST", "/auth/logout",
+                           json={"refresh_token": self.refresh_token})
+        await self.login()
+
+    async def op_me(self):
+        await self.request("GET /users/me", "GET", "/users/me", headers=self.headers)
+
+    async def op_balance(self):
+        await self.request("GET /wallet/balance", "GET", "/wallet/balance", headers=self.headers)
+
+    async def op_top_up(self):
+        await self.request("POST /wallet/top-up", "POST", "/wallet/top-up",
+                           json={"amount": 5.0}, headers=self.headers)
+
+    async def op_spend(self):
+        await self.request("POST /wallet/spend", "POST", "/wallet/spend",
+                           json={"amount": 1.0}, headers=self.headers)
+
+    async def op_transfer(self):
+        await self.request("POST /wallet/transfer", "POST", "/wallet/transfer",
+                           json={"recipient_username": self.other_user(), "amount": 1.0}, headers=self.headers)
+
+    async def op_history(self):
+        response = await self.request("GET /transactions", "GET", "/transactions",
+                                      params={"limit": 50}, headers=self.headers)
+        cursor = response.headers.get("X-Next-Cursor") if response is not None else None
+        if cursor:
+            await self.request("GET /transactions?cursor", "GET", "/transactions",
+                               params={"limit": 50, "cursor": cursor}, headers=self.headers)
+
+    async def op_export(self):
+        await self.request("GET /transactions/export", "GET", "/transactions/export", headers=self.headers)
+
+    async def op_items(self):
+        await self.request("GET /items", "GET", "/items")
+
+    async def op_item(self):
+        await self.request("GET /items/{item_id}", "GET", f"/items/{self.rng.choice(self.ctx['item_ids'])}")
+
+    async def op_search(self):
+        await self.request("GET /items/search", "GET", "/items/search",
+                           params={"q": f"item{self.rng.randrange(10)}", "limit": 20})
+
+    async def op_buy(self):
+        await self.request("POST /items/buy/{item_id}", "POST", f"/items/buy/{self.rng.choice(self.ctx['item_ids'])}",
+                           headers=self.headers)
+
+    async def op_flash_buy(self):
+        await self.request("POST /items/buy/{flash_item_id}", "POST", f"/items/buy/{self.ctx['flash_item_id']}",
+                           headers=self.headers)
+
+    async def op_admin_create_item(self):
+        await self.request("POST /admin/items", "POST", "/admin/items",
+                           json={"name": f"bench-{uuid.uuid4().hex[:8]}", "price": 1.0, "stock_val": 10},
+                           headers=self.ctx["admin_headers"])
+
+    async def op_admin_import(self):
+        # Upserts the same small batch, so repeated imports don't grow the catalog
+        rows = "".join(f"bench-import-{i},imported{i},1.0,10\n" for i in range(IMPORT_ROWS))
+        await self.request("POST /admin/items/import", "POST", "/admin/items/import",
+                           params={"format": "csv", "mode": "upsert"}, content="id,name,price,stock_val\n" + rows,
+                           headers={**self.ctx["admin_headers"], "Content-Type": "text/csv"})
+
+    async def op_admin_flash_sale(self):
+        await self.request("PUT /admin/items/{item_id}/flash-sale", "PUT",
+                           f"/admin/items/{self.ctx['flash_item_id']}/flash-sale",
+                           json={"enabled": True}, headers=self.ctx["admin_headers"])
+
+    async def op_admin_users(self):
+        await self.request("GET /admin/users", "GET", "/admin/users", headers=self.ctx["admin_headers"])
+
+    async def op_admin_export(self):
+        # Scoped to one user; the unscoped export is a bulk job, not a request
+        await self.request("GET /admin/transactions/export", "GET", "/admin/transactions/export",
+                           params={"user_id": self.ctx["admin_export_user_id"]}, headers=self.ctx["admin_headers"])
+
+    async def op_admin_write_stats(self):
+        await self.request("GET /admin/write-batching/stats", "GET", "/admin/write-batching/stats",
+                           headers=self.ctx["admin_headers"])
+
+    async def op_admin_cache_stats(self):
+        await self.request("GET /admin/cache/stats", "GET", "/admin/cache/stats", headers=self.ctx["admin_headers"])
+
+    async def op_admin_admission_stats(self):
+        await self.request("GET /admin/admission/stats", "GET", "/admin/admission/stats",
+                           headers=self.ctx["admin_headers"])
+
+    async def op_admin_profiler(self):
+        await self.request("GET /admin/profiler/requests", "GET", "/admin/profiler/requests",
+                           headers=self.ctx["admin_headers"])
+
+    async def op_admin_profiler_clear(self):
+        await self.request("DELETE /admin/profiler/requests", "DELETE", "/admin/profiler/requests",
+                           headers=self.ctx["admin_headers"])
+
+    async def op_health(self):
+        await self.request("GET /health", "GET", "/health")
+
+    async def op_metrics(self):
+        await self.request("GET /metrics", "GET", "/metrics")
+
+
+# Operation name -> relative weight
+WORKLOADS: Dict[str, Dict[str, int]] = {
+    "login": {"login": 1},
+    "transfer": {"transfer": 1},
+    "wallet": {"top_up": 1, "spend": 1, "transfer": 1},
+    "flash": {"flash_buy": 1},
+    "history": {"history": 7, "export": 1, "balance": 2},
+    "mixed": {
+        "login": 2, "refresh": 2, "me": 15, "balance": 15, "top_up": 10, "spend": 10,
+        "transfer": 10, "history": 15, "items": 10, "item": 5, "buy": 3, "flash_buy": 3,
+    },
+    # Every route except the /test-* debugging endpoints, evenly
+    "all": {name[3:]: 1 for name in dir(VirtualUser) if name.startswith("op_")},
+}
+
+
+async def setup(client: httpx.AsyncClient, stats: Dict[str, EndpointStats], ctx: dict, concurrency: int) -> List[VirtualUser]:
+    response = await client.post("/auth/login", json={"username": ADMIN_USERNAME, "password": BENCH_PASSWORD})
+    if response.status_code != 200:
+        raise SystemExit("could not log in as the benchmark admin; was the database seeded by benchmarks.seed?")
+    ctx["admin_headers"] = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    items = (await client.get("/items")).json()
+    by_name = {item["name"]: item["id"] for item in items}
+    ctx["flash_item_id"] = by_name.get("item0") or items[0]["id"]
+    ctx["item_ids"] = [item_id for name, item_id in by_name.items() if item_id != ctx["flash_item_id"]] or [ctx["flash_item_id"]]
+    me = (await client.get("/users/me", headers=ctx["admin_headers"])).json()
+    ctx["admin_export_user_id"] = me["id"]
+
+    # Logins used only to get tokens are not part of the measurement
+    vusers = [VirtualUser(client, defaultdict(EndpointStats), ctx, index) for index in range(concurrency)]
+    for batch_start in range(0, len(vusers), 16):
+        await asyncio.gather(*(vuser.login() for vuser in vusers[batch_start:batch_start + 16]))
+    for vuser in vusers:
+        if not vuser.headers:
+            raise SystemExit(f"login failed for {vuser.username}")
+        vuser.stats = stats
+    return vusers
+
+
+async def drive(vuser: VirtualUser, weights: Dict[str, int], deadline: float) -> None:
+    ops = [getattr(vuser, f"op_{name}") for name in weights]
+    while time.perf_counter() < deadline:
+        await vuser.rng.choices(ops, weights=list(weights.values()))[0]()
+
+
+async def run_workload(client: httpx.AsyncClient, ctx: dict, workload: str, concurrency: int, duration: float, warmup: float) -> dict:
+    stats: Dict[str, EndpointStats] = defaultdict(EndpointStats)
+    vusers = await setup(client, stats, ctx, concurrency)
+    weights = WORKLOADS[workload]
+    if warmup > 0:
+        for vuser in vusers:
+            vuser.stats = defaultdict(EndpointStats)
+        await asyncio.gather(*(drive(vuser, weights, time.perf_counter() + warmup) for vuser in vusers))
+        for vuser in vusers:
+            vuser.stats = stats
+    started = time.perf_counter()
+    await asyncio.gather(*(drive(vuser, weights, started + duration) for vuser in vusers))
+    elapsed = time.perf_counter() - started
+
+    endpoints = {label: endpoint.summary(elapsed) for label, endpoint in sorted(stats.items())}
+    total = sum(endpoint["requests"] for endpoint in endpoints.values())
+    return {
+        "elapsed_s": round(elapsed, 3),
+        "total_requests": total,
+        "total_rps": round(total / elapsed, 2),
+        "endpoints": endpoints,
+    }
+
+
+@asynccontextmanager
+async def asgi_client(concurrency: int):
+    # Imported here so DATABASE_URL set by main() is picked up
+    from src.main import app
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+            yield client
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@asynccontextmanager
+async def uvicorn_client(concurrency: int, workers: int, log_path: str):
+    port = _free_port()
+    with open(log_path, "wb") as log:
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "src.main:app", "--host", "127.0.0.1", "--port", str(port),
+             "--workers", str(workers), "--log-level", "warning", "--no-access-log"],
+            env=os.environ.copy(), stdout=log, stderr=subprocess.STDOUT,
+        )
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=60) as client:
+            for _ in range(300):
+                if server.poll() is not None:
+                    raise SystemExit(f"uvicorn exited with {server.returncode}; see {log_path}")
+                try:
+                    if (await client.get("/health")).status_code == 200:
+                        break
+                except httpx.HTTPError:
+                    pass
+                await asyncio.sleep(0.1)
+            else:
+                raise SystemExit(f"uvicorn did not become healthy; see {log_path}")
+            yield client
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+
+async def run(args, ctx: dict) -> dict:
+    if args.mode == "asgi":
+        client_context = asgi_client(args.concurrency)
+    else:
+        client_context = uvicorn_client(args.concurrency, args.workers, os.path.join(ctx["workdir"], "uvicorn.log"))
+    async with client_context as client:
+        return await run_workload(client, ctx, args.workload, args.concurrency, args.duration, args.warmup)
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(result: dict, baseline: Optional[dict]) -> None:
+    base_endpoints = (baseline or {}).get("results", {}).get("endpoints", {})
+    header = f"{'endpoint':40s} {'reqs':>8s} {'rps':>9s} {'p50 ms':>9s} {'p95 ms':>9s} {'p99 ms':>9s} {'err':>5s}"
+    if base_endpoints:
+        header += f" {'rps Δ':>8s} {'p95 Δ':>8s}"
+    print(header)
+    for label, endpoint in result["endpoints"].items():
+        line = (f"{label:40s} {endpoint['requests']:8d} {endpoint['rps']:9.1f} {endpoint['p50_ms']:9.2f} "
+                f"{endpoint['p95_ms']:9.2f} {endpoint['p99_ms']:9.2f} {endpoint['errors']:5d}")
+        base = base_endpoints.get(label)
+        if base and base["rps"] and base["p95_ms"]:
+            line += (f" {(endpoint['rps'] / base['rps'] - 1) * 100:+7.1f}%"
+                     f" {(endpoint['p95_ms'] / base['p95_ms'] - 1) * 100:+7.1f}%")
+        print(line)
+    print(f"{'total':40s} {result['total_requests']:8d} {result['total_rps']:9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=("asgi", "uvicorn"), default="asgi")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="uvicorn workers")
+    parser.add_argument("--workload", choices=sorted(WORKLOADS), default="mixed")
+    parser.add_argument("--concurrency", type=int, default=32, help="virtual users")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds measured")
+    parser.add_argument("--warmup", type=float, default=1.0, help="seconds run before measuring")
+    parser.add_argument("--db", help="database seeded by benchmarks.seed (default: seed a temporary one)")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--items", type=int, default=100)
+    parser.add_argument("--transactions", type=int, default=10000)
+    parser.add_argument("--json", help="write machine-readable results here")
+    parser.add_argument("--baseline", help="earlier --json output to compare against")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="ewallet-bench-")
+    seeded = None
+    db_path = args.db
+    if db_path is None:
+        db_path = os.path.join(workdir, "bench.db")
+    # Before anything imports src.database, which binds its engine on import
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.abspath(db_path)}"
+    if int(os.getenv("DB_SHARDS", "0")) and "DB_SHARD_URL" not in os.environ:
+        # Shards next to the main database: bench.shard0.db, ...
+        os.environ["DB_SHARD_URL"] = f"sqlite:///{os.path.splitext(os.path.abspath(db_path))[0]}.shard{{shard}}.db"
+    if args.db is None:
+        seeded = seed(db_path, args.users, args.items, args.transactions)
+    # Keep per-request log output out of the measurement
+    logging.disable(logging.INFO)
+
+    users = args.users
+    if seeded is None:
+        import sqlite3
+        with sqlite3.connect(db_path) as connection:
+            if int(os.getenv("DB_SHARDS", "0")):
+                users = connection.execute("SELECT count(*) FROM userdirectory WHERE username GLOB 'bench[0-9]*'").fetchone()[0]
+            else:
+                users = connection.execute("SELECT count(*) FROM user WHERE username LIKE 'bench%' AND NOT is_admin").fetchone()[0]
+    ctx = {"users": max(users, 1), "workdir": workdir}
+
+    result = asyncio.run(run(args, ctx))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+
+    if args.json:
+        report = {
+            "commit": git_commit(),
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "config": {key: value for key, value in vars(args).items() if key not in ("json", "baseline")},
+            "env": {key: value for key, value in os.environ.items()
+                    if key.startswith(("DB_", "SQLITE_", "GROUP_COMMIT_", "FLASH_SALE_", "HASH_", "BCRYPT_"))},
+            "seed": seeded,
+            "results": result,
+        }
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+'''
+measure bcrypt verify throughput (the cost of a login) as the hashing
+process pool grows
+
+    python -m benchmarks.login_throughput --logins 64 --max-workers 8
+'''
+
+import argparse
+import asyncio
+import os
+import time
+
+from src.hashing import PasswordHasher, hash_password, verify_password
+
+
+async def run_pool(workers: int, hashed: str, logins: int) -> float:
+    hasher = PasswordHasher(workers=workers, max_pending=logins)
+    try:
+        # Warm the pool so process start-up isn't counted
+        await asyncio.gather(*(hasher.verify("password123", hashed) for _ in range(max(workers, 1))))
+        started = time.perf_counter()
+        results = await asyncio.gather(*(hasher.verify("password123", hashed) for _ in range(logins)))
+        elapsed = time.perf_counter() - started
+    finally:
+        hasher.shutdown()
+    assert all(results)
+    return logins / elapsed
+
+
+def run_inline(hashed: str, logins: int) -> float:
+    started = time.perf_counter()
+    for _ in range(logins):
+        assert verify_password("password123", hashed)
+    return logins / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--logins", type=int, default=64)
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    hashed = hash_password("password123")
+    inline = run_inline(hashed, args.logins)
+    print(f"inline          {inline:8.1f} logins/s")
+
+    workers = 1
+    while workers <= args.max_workers:
+        rate = asyncio.run(run_pool(workers, hashed, args.logins))
+        print(f"{workers:2d} worker(s)    {rate:8.1f} logins/s  ({rate / inline:.2f}x)")
+        workers *= 2
+
+
+if __name__ == "__main__":
+    main()
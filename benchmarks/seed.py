@@ -0,0 +1,127 @@
+'''
+seed a SQLite database for the load benchmarks
+
+Users are bench0..benchN-1 with password "password123" (one hash shared by
+all of them, so seeding a million users doesn't take a million bcrypt
+calls), plus an admin "bench_admin". Items are item0..itemM-1; the first
+--flash-items of them are flagged for flash-sale mode. Transactions are
+spread round-robin over the users with timestamps going back in time.
+With DB_SHARDS set, users and transactions go to the shard databases
+(DB_SHARD_URL) and the username directory to the main one.
+
+    python -m benchmarks.seed bench.db --users 100000 --items 1000 --transactions 1000000
+'''
+
+import argparse
+import itertools
+import os
+import time
+import uuid
+from collections import defaultdict
+from contextlib import ExitStack
+from datetime import datetime, timedelta, timezone
+from typing import Iterator, List
+
+BENCH_PASSWORD = "password123"
+ADMIN_USERNAME = "bench_admin"
+SEED_BALANCE = 1_000_000.0
+SEED_STOCK = 1_000_000
+CHUNK_SIZE = 10_000
+
+
+def _chunks(rows: Iterator[dict], size: int = CHUNK_SIZE) -> Iterator[List[dict]]:
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def seed(path: str, users: int, items: int, transactions: int, flash_items: int = 1) -> dict:
+    from src.database import DB_SHARDS, create_db_engine, shard_for, shard_url
+    from src.hashing import hash_password
+    from src.migrate import migrate_database
+    from src.models import User, Item, Transaction, UserDirectory
+
+    if os.path.exists(path):
+        raise SystemExit(f"{path} already exists")
+    url = f"sqlite:///{path}"
+    engine = create_db_engine(url)
+    migrate_database(engine)
+    shard_engines = [create_db_engine(shard_url(shard)) for shard in range(DB_SHARDS)]
+    for shard_engine in shard_engines:
+        migrate_database(shard_engine, shard=True)
+
+    hashed = hash_password(BENCH_PASSWORD)
+    now = datetime.now(timezone.utc)
+    user_ids = [str(uuid.uuid4()) for _ in range(users)]
+
+    def user_rows():
+        yield {"id": str(uuid.uuid4()), "username": ADMIN_USERNAME, "email": f"{ADMIN_USERNAME}@example.com",
+               "hashed_password": hashed, "balance": SEED_BALANCE, "is_admin": True, "ledger_seq": 0, "created_at": now}
+        for i, user_id in enumerate(user_ids):
+            yield {"id": user_id, "username": f"bench{i}", "email": f"bench{i}@example.com",
+                   "hashed_password": hashed, "balance": SEED_BALANCE, "is_admin": False,
+                   "ledger_seq": len(range(i, transactions, users)), "created_at": now}
+
+    def item_rows():
+        for i in range(items):
+            yield {"id": str(uuid.uuid4()), "name": f"item{i}", "price": 1.0 + i % 100,
+                   "stock_val": SEED_STOCK, "flash_sale": i < flash_items, "owner_id": None}
+
+    def transaction_rows():
+        for i in range(transactions):
+            yield {"id": str(uuid.uuid4()), "amount": 10.0, "transaction_type": "top_up",
+                   "user_id": user_ids[i % users], "product_id": None,
+                   "timestamp": now - timedelta(seconds=i), "ledger_seq": i // users + 1}
+
+    started = time.perf_counter()
+    # One transaction, executemany in chunks: the ORM unit of work is far too
+    # slow for millions of rows
+    with ExitStack() as stack:
+        connection = stack.enter_context(engine.begin())
+        shard_connections = [stack.enter_context(shard_engine.begin()) for shard_engine in shard_engines]
+        for table, rows, user_key in (
+            (User.__table__, user_rows(), "id"),
+            (Item.__table__, item_rows(), None),
+            (Transaction.__table__, transaction_rows() if users else iter(()), "user_id"),
+        ):
+            for chunk in _chunks(rows):
+                if not shard_connections or user_key is None:
+                    connection.execute(table.insert(), chunk)
+                    continue
+                by_shard = defaultdict(list)
+                for row in chunk:
+                    by_shard[shard_for(row[user_key])].append(row)
+                for shard, shard_rows in by_shard.items():
+                    shard_connections[shard].execute(table.insert(), shard_rows)
+                if table is User.__table__:
+                    connection.execute(UserDirectory.__table__.insert(), [
+                        {"username": row["username"], "user_id": row["id"], "shard": shard_for(row["id"])}
+                        for row in chunk
+                    ])
+    for seeded_engine in (engine, *shard_engines):
+        seeded_engine.dispose()
+    return {
+        "users": users,
+        "items": items,
+        "transactions": transactions,
+        "flash_items": min(flash_items, items),
+        "shards": DB_SHARDS,
+        "seconds": round(time.perf_counter() - started, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--items", type=int, default=100)
+    parser.add_argument("--transactions", type=int, default=10000)
+    parser.add_argument("--flash-items", type=int, default=1)
+    args = parser.parse_args()
+    print(seed(args.path, args.users, args.items, args.transactions, args.flash_items))
+
+
+if __name__ == "__main__":
+    main()
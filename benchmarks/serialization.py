@@ -0,0 +1,127 @@
+'''
+compare the old list-response path (ORM rows -> pydantic schemas ->
+response_model validation -> JSON) with the fast path (tuple rows -> dicts
+-> orjson) for /admin/users and /transactions
+
+    python -m benchmarks.serialization --rows 5000 --repeat 20
+'''
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from typing import List
+
+from pydantic import TypeAdapter
+from sqlmodel import SQLModel, Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from src.database import create_db_engine, create_async_db_engine
+from src.models import User, Transaction
+from src.schema import UserSchema, TransactionSchema
+from src.crud import list_user_rows, get_user_transaction_rows
+from src.responses import FastJSONResponse, user_payload, transaction_payload
+
+users_adapter = TypeAdapter(List[UserSchema])
+transactions_adapter = TypeAdapter(List[TransactionSchema])
+
+
+def seed(url: str, rows: int) -> str:
+    engine = create_db_engine(url)
+    SQLModel.metadata.create_all(engine)
+    now = datetime.now(timezone.utc)
+    with Session(engine) as session:
+        owner = User(username="owner", email="owner@example.com", hashed_password="x")
+        session.add(owner)
+        session.add_all(
+            User(username=f"user{i}", email=f"user{i}@example.com", hashed_password="x")
+            for i in range(rows)
+        )
+        session.add_all(
+            Transaction(user_id=owner.id, amount=float(i), transaction_type="top_up",
+                        timestamp=now - timedelta(seconds=i), ledger_seq=i + 1)
+            for i in range(rows)
+        )
+        session.commit()
+        owner_id = owner.id
+    engine.dispose()
+    return owner_id
+
+
+async def old_users(session: AsyncSession) -> bytes:
+    users = (await session.exec(select(User))).all()
+    schemas = [
+        UserSchema(id=u.id, username=u.username, wallet_bal=u.balance,
+                   role="admin" if u.is_admin else "user")
+        for u in users
+    ]
+    # What FastAPI does with response_model: validate, then serialize
+    return users_adapter.dump_json(users_adapter.validate_python(schemas))
+
+
+async def new_users(session: AsyncSession) -> bytes:
+    return FastJSONResponse([user_payload(*row) for row in await list_user_rows(session)]).body
+
+
+async def old_transactions(session: AsyncSession, user_id: str, limit: int) -> bytes:
+    statement = (select(Transaction).where(Transaction.user_id == user_id)
+                 .order_by(Transaction.timestamp.desc(), Transaction.id.desc()).limit(limit))
+    schemas = [
+        TransactionSchema(id=t.id, user_id=t.user_id or "", product_id=t.product_id,
+                          amount=t.amount, timestamp=t.timestamp, type=t.transaction_type)
+        for t in (await session.exec(statement)).all()
+    ]
+    return transactions_adapter.dump_json(transactions_adapter.validate_python(schemas))
+
+
+async def new_transactions(session: AsyncSession, user_id: str, limit: int) -> bytes:
+    rows = await get_user_transaction_rows(session, user_id, limit=limit)
+    return FastJSONResponse([transaction_payload(*row) for row in rows]).body
+
+
+async def timed(engine, repeat: int, fn, *args) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        async with AsyncSession(engine, expire_on_commit=False) as session:
+            started = time.perf_counter()
+            await fn(session, *args)
+            best = min(best, time.perf_counter() - started)
+    return best
+
+
+async def run(url: str, owner_id: str, repeat: int, limit: int):
+    engine = create_async_db_engine(url)
+    try:
+        async with AsyncSession(engine) as session:
+            # Same bytes either way, so the fast path is a drop-in replacement
+            assert await old_users(session) == await new_users(session)
+            assert (await old_transactions(session, owner_id, limit)
+                    == await new_transactions(session, owner_id, limit))
+        for name, old, new, args in (
+            ("/admin/users", old_users, new_users, ()),
+            ("/transactions", old_transactions, new_transactions, (owner_id, limit)),
+        ):
+            old_time = await timed(engine, repeat, old, *args)
+            new_time = await timed(engine, repeat, new, *args)
+            print(f"{name:15s} old {old_time * 1000:8.2f} ms   new {new_time * 1000:8.2f} ms"
+                  f"   ({old_time / new_time:.2f}x)")
+    finally:
+        await engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--limit", type=int, default=500, help="transactions page size")
+    args = parser.parse_args()
+
+    url = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'serialization.db')}"
+    owner_id = seed(url, args.rows)
+    asyncio.run(run(url, owner_id, args.repeat, args.limit))
+
+
+if __name__ == "__main__":
+    main()
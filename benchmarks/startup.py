@@ -0,0 +1,118 @@
+'''
+cold-start benchmark: how long a freshly started worker takes to serve
+
+Each run starts one uvicorn worker against an already migrated database
+(what a scale-out worker sees) and measures, from process start:
+
+- ready: the first 200 from /health (imports plus lifespan startup)
+- login: the first /auth/login (starts the bcrypt pool)
+- balance: the first authenticated /wallet/balance after that
+
+plus, in a separate interpreter, the time to import src.main.
+
+    python -m benchmarks.startup --runs 5
+    python -m benchmarks.startup --runs 10 --json startup.json
+'''
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.load import _free_port
+from benchmarks.seed import seed, BENCH_PASSWORD
+
+
+def import_time() -> float:
+    output = subprocess.run(
+        [sys.executable, "-c", "import time; t = time.perf_counter(); import src.main; print(time.perf_counter() - t)"],
+        env=os.environ.copy(), capture_output=True, text=True, check=True,
+    ).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def cold_start(log_path: str) -> dict:
+    port = _free_port()
+    started = time.perf_counter()
+    with open(log_path, "ab") as log:
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "src.main:app", "--host", "127.0.0.1", "--port", str(port),
+             "--log-level", "warning", "--no-access-log"],
+            env=os.environ.copy(), stdout=log, stderr=subprocess.STDOUT,
+        )
+    timings = {}
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=30) as client:
+            while True:
+                if server.poll() is not None:
+                    raise SystemExit(f"uvicorn exited with {server.returncode}; see {log_path}")
+                try:
+                    if client.get("/health").status_code == 200:
+                        break
+                except httpx.HTTPError:
+                    pass
+                if time.perf_counter() - started > 60:
+                    raise SystemExit(f"uvicorn did not become healthy; see {log_path}")
+                time.sleep(0.005)
+            timings["ready"] = time.perf_counter() - started
+            response = client.post("/auth/login", json={"username": "bench0", "password": BENCH_PASSWORD})
+            response.raise_for_status()
+            timings["login"] = time.perf_counter() - started
+            headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+            client.get("/wallet/balance", headers=headers).raise_for_status()
+            timings["balance"] = time.perf_counter() - started
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+    return timings
+
+
+def summarize(samples: list) -> dict:
+    return {
+        "min_ms": round(min(samples) * 1000, 1),
+        "median_ms": round(statistics.median(samples) * 1000, 1),
+        "max_ms": round(max(samples) * 1000, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure worker cold-start time")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--json", help="write the results here")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, "startup.db")
+        os.environ["DATABASE_URL"] = f"sqlite:///{path}"
+        os.environ.setdefault("DB_SHARD_URL", f"sqlite:///{os.path.join(workdir, 'startup.shard{shard}.db')}")
+        seed(path, users=10, items=10, transactions=0)
+        # Start every run from a migrated database, as a scale-out worker would
+        subprocess.run([sys.executable, "-m", "src.migrate"], env=os.environ.copy(), check=True,
+                       stdout=subprocess.DEVNULL)
+
+        results = {"import": [], "ready": [], "login": [], "balance": []}
+        log_path = os.path.join(workdir, "uvicorn.log")
+        for _ in range(args.runs):
+            results["import"].append(import_time())
+            for key, value in cold_start(log_path).items():
+                results[key].append(value)
+
+    report = {key: summarize(samples) for key, samples in results.items()}
+    for key, stats in report.items():
+        print(f"{key:8s} min {stats['min_ms']:8.1f} ms   median {stats['median_ms']:8.1f} ms   max {stats['max_ms']:8.1f} ms")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"runs": args.runs, "results": report}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
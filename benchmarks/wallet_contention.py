@@ -0,0 +1,89 @@
+'''
+hammer a single wallet with concurrent spends from many threads and report
+the throughput and the outcome; tests/test_wallet.py asserts the same
+scenario (no lost update, no overdraft, one ledger row per spend)
+
+    python -m benchmarks.wallet_contention --threads 16 --spends 100
+'''
+
+import argparse
+import asyncio
+import os
+import tempfile
+import threading
+import time
+
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
+from sqlmodel import SQLModel, Session, create_engine, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from src.models import User, Transaction
+from src.crud import get_user_by_username, spend_money
+
+INITIAL_BALANCE = 1000.0
+
+
+def worker(url: str, username: str, spends: int, amount: float, results: list):
+    async def run():
+        # Each thread gets its own event loop, so it needs its own engine
+        engine = create_async_engine(url, poolclass=NullPool, connect_args={"timeout": 30})
+        ok = 0
+        try:
+            for _ in range(spends):
+                async with AsyncSession(engine, expire_on_commit=False) as session:
+                    user = await get_user_by_username(session, username)
+                    spent, _ = await spend_money(session, user, amount)
+                    if spent:
+                        ok += 1
+        finally:
+            await engine.dispose()
+        return ok
+
+    results.append(asyncio.run(run()))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--spends", type=int, default=100)
+    parser.add_argument("--amount", type=float, default=1.0)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "contention.db")
+    sync_engine = create_engine(f"sqlite:///{path}")
+    SQLModel.metadata.create_all(sync_engine)
+    with Session(sync_engine) as session:
+        session.add(User(username="hammer", email="hammer@example.com",
+                         hashed_password="x", balance=INITIAL_BALANCE))
+        session.commit()
+
+    results: list = []
+    threads = [
+        threading.Thread(target=worker, args=(f"sqlite+aiosqlite:///{path}", "hammer", args.spends, args.amount, results))
+        for _ in range(args.threads)
+    ]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    with Session(sync_engine) as session:
+        user = session.exec(select(User).where(User.username == "hammer")).one()
+        ledger = session.exec(select(Transaction).where(Transaction.user_id == user.id)).all()
+
+    succeeded = sum(results)
+    attempted = args.threads * args.spends
+    expected_successes = min(attempted, int(INITIAL_BALANCE // args.amount))
+    expected_balance = INITIAL_BALANCE - succeeded * args.amount
+
+    print(f"attempted={attempted} succeeded={succeeded} elapsed={elapsed:.2f}s "
+          f"ops/s={attempted / elapsed:.0f}")
+    print(f"balance={user.balance} expected={expected_balance} ledger_rows={len(ledger)} "
+          f"expected_successes={expected_successes}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+'''
+rate limiting and admission control
+
+Routes listed in the middleware's `routes` get any of:
+
+- token buckets per client IP and per authenticated user, answered with 429
+  and a Retry-After once a bucket is empty;
+- a cap on requests in flight, with a short bounded queue behind it. A full
+  queue, or a wait longer than the queue timeout, is answered with 503.
+
+Rejections are decided before the request body is read, so a burst costs a
+dict lookup per request rather than a bcrypt call or a database write lock.
+Buckets live in memory, per process: with several workers each one
+enforces the limits on its own share of the traffic.
+'''
+
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, NamedTuple, Optional, Tuple
+
+from src.auth import bearer_subject
+from src.database import env_bool
+from src.metrics import admission_decisions
+
+RATE_LIMIT_ENABLED = env_bool("RATE_LIMIT_ENABLED", False)
+RATE_LIMIT_SHARDS = int(os.getenv("RATE_LIMIT_SHARDS", "64"))
+# Buckets kept across all shards; the least recently used go first
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+# Only behind a proxy that sets X-Forwarded-For; otherwise clients pick their own IP
+RATE_LIMIT_TRUST_FORWARDED_FOR = env_bool("RATE_LIMIT_TRUST_FORWARDED_FOR", False)
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "2"))
+
+
+class RateLimit(NamedTuple):
+    rate: float  # tokens added per second
+    burst: float  # bucket size
+
+
+class RouteLimits(NamedTuple):
+    per_ip: Optional[RateLimit] = None
+    per_user: Optional[RateLimit] = None
+    max_concurrent: Optional[int] = None
+    max_queued: int = 0
+    queue_timeout: float = ADMISSION_QUEUE_TIMEOUT
+
+
+class TokenBuckets:
+    """Token buckets spread over shards with a lock each, so lookups for
+    different keys rarely contend. Idle buckets are evicted LRU-first."""
+
+    def __init__(self, shards: int = RATE_LIMIT_SHARDS, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self._shards = [(threading.Lock(), OrderedDict()) for _ in range(max(1, shards))]
+        self._max_per_shard = max(1, max_keys // len(self._shards))
+        self.evictions = 0
+
+    def take(self, key: Hashable, limit: RateLimit) -> float:
+        # 0 when a token was taken, else seconds until one is available
+        lock, buckets = self._shards[hash(key) % len(self._shards)]
+        now = time.monotonic()
+        with lock:
+            entry = buckets.get(key)
+            if entry is None:
+                tokens = limit.burst
+            else:
+                tokens, updated = entry
+                tokens = min(limit.burst, tokens + (now - updated) * limit.rate)
+                buckets.move_to_end(key)
+            wait = 0.0 if tokens >= 1 else (1 - tokens) / limit.rate
+            buckets[key] = (tokens - 1 if not wait else tokens, now)
+            if len(buckets) > self._max_per_shard:
+                buckets.popitem(last=False)
+                self.evictions += 1
+        return wait
+
+    def clear(self) -> None:
+        for lock, buckets in self._shards:
+            with lock:
+                buckets.clear()
+
+    def stats(self) -> dict:
+        return {
+            "keys": sum(len(buckets) for _, buckets in self._shards),
+            "max_keys": self._max_per_shard * len(self._shards),
+            "evictions": self.evictions,
+        }
+
+
+class ConcurrencyLimiter:
+    def __init__(self, limit: int, max_queued: int, timeout: float):
+        self.limit = limit
+        self.max_queued = max_queued
+        self.timeout = timeout
+        self.in_flight = 0
+        self.queued = 0
+        self._semaphore = asyncio.Semaphore(limit)
+
+    async def acquire(self) -> Optional[str]:
+        # None once admitted, else why not
+        if self._semaphore.locked():
+            if self.queued >= self.max_queued:
+                return "queue_full"
+            self.queued += 1
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), self.timeout)
+            except asyncio.TimeoutError:
+                return "queue_timeout"
+            finally:
+                self.queued -= 1
+        else:
+            await self._semaphore.acquire()
+        self.in_flight += 1
+        return None
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self._semaphore.release()
+
+    def stats(self) -> dict:
+        return {"limit": self.limit, "in_flight": self.in_flight, "queued": self.queued, "max_queued": self.max_queued}
+
+
+buckets = TokenBuckets()
+# route -> limiter, filled in by AdmissionMiddleware; read for stats and metrics
+admission_limiters: Dict[str, ConcurrencyLimiter] = {}
+
+
+def _client_ip(scope, headers: dict) -> str:
+    if RATE_LIMIT_TRUST_FORWARDED_FOR:
+        forwarded = headers.get(b"x-forwarded-for")
+        if forwarded:
+            return forwarded.split(b",")[0].strip().decode("latin-1")
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+
+def _user(headers: dict) -> Optional[str]:
+    # Requests without a valid token get no user bucket; the route itself
+    # turns them away with a 401
+    return bearer_subject(headers.get(b"authorization", b"").decode("latin-1"))
+
+
+class AdmissionMiddleware:
+    # Plain ASGI middleware. Route keys are paths; a key ending in "/" is a
+    # prefix (e.g. "/items/buy/")
+
+    def __init__(self, app, routes: Dict[str, RouteLimits], enabled: bool = RATE_LIMIT_ENABLED):
+        self.app = app
+        self.enabled = enabled
+        self.routes = dict(routes)
+        self.prefixes = tuple(sorted((path for path in self.routes if path.endswith("/")), key=len, reverse=True))
+        self.limiters = {
+            route: ConcurrencyLimiter(limits.max_concurrent, limits.max_queued, limits.queue_timeout)
+            for route, limits in self.routes.items() if limits.max_concurrent
+        }
+        admission_limiters.update(self.limiters)
+
+    def _match(self, path: str) -> Tuple[Optional[str], Optional[RouteLimits]]:
+        limits = self.routes.get(path)
+        if limits is not None:
+            return path, limits
+        for prefix in self.prefixes:
+            if path.startswith(prefix):
+                return prefix, self.routes[prefix]
+        return None, None
+
+    async def __call__(self, scope, receive, send):
+        if not self.enabled or scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        route, limits = self._match(scope["path"])
+        if limits is None:
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope["headers"])
+        if limits.per_ip:
+            wait = buckets.take((route, "ip", _client_ip(scope, headers)), limits.per_ip)
+            if wait:
+                return await self._reject(send, route, "rate_limited_ip", 429, wait)
+        if limits.per_user:
+            user = _user(headers)
+            wait = buckets.take((route, "user", user), limits.per_user) if user else 0.0
+            if wait:
+                return await self._reject(send, route, "rate_limited_user", 429, wait)
+
+        limiter = self.limiters.get(route)
+        if limiter is None:
+            admission_decisions.inc(route=route, outcome="admitted")
+            return await self.app(scope, receive, send)
+        shed = await limiter.acquire()
+        if shed:
+            return await self._reject(send, route, shed, 503, limiter.timeout)
+        admission_decisions.inc(route=route, outcome="admitted")
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.release()
+
+    async def _reject(self, send, route: str, outcome: str, status_code: int, retry_after: float) -> None:
+        admission_decisions.inc(route=route, outcome=outcome)
+        body = b'{"detail":"Too many requests"}' if status_code == 429 else b'{"detail":"Server busy, try again shortly"}'
+        await send({"type": "http.response.start", "status": status_code, "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+        ]})
+        await send({"type": "http.response.body", "body": body})
+
+
+def stats() -> dict:
+    return {
+        "enabled": RATE_LIMIT_ENABLED,
+        "buckets": buckets.stats(),
+        "routes": {route: limiter.stats() for route, limiter in admission_limiters.items()},
+    }
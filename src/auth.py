@@ -1,34 +1,48 @@
 from fastapi import HTTPException, Depends, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 import os
 from dotenv import load_dotenv
-from typing import Optional
+from typing import Optional, Tuple
+import uuid
 from datetime import datetime, timezone, timedelta
+from sqlmodel.ext.asyncio.session import AsyncSession
+from src.database import DB_SHARDS, get_async_session, user_session
+from src.cache import user_cache
+from src.hashing import password_hasher, HashQueueFull
 import logging
 
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 load_dotenv()
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-change-in-production")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "7"))
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+def _hashing_busy() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Server busy, try again shortly",
+        headers={"Retry-After": "1"},
+    )
+
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    try:
+        return await password_hasher.verify(plain_password, hashed_password)
+    except HashQueueFull:
+        raise _hashing_busy()
 
 
-def get_password_hash(password: str) -> str:
-    logger.debug("Starting password hash")
-    hashed = pwd_context.hash(password)
-    logger.debug("Password hash completed")
-    return hashed
+async def get_password_hash_async(password: str) -> str:
+    try:
+        return await password_hasher.hash(password)
+    except HashQueueFull:
+        raise _hashing_busy()
 
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
@@ -51,10 +65,47 @@ def decode_access_token(token: str) -> dict:
         )
 
 
-async def get_current_user(token: str = Depends(oauth2_scheme)):
+def bearer_subject(authorization: str) -> Optional[str]:
+    # The user an Authorization header's access token is for; None if it
+    # doesn't carry a valid one (the route itself then answers 401)
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    try:
+        payload = decode_access_token(token)
+    except HTTPException:
+        return None
+    return None if payload.get("type") == "refresh" else payload.get("sub")
+
+
+def create_refresh_token(data: dict) -> Tuple[str, str, datetime]:
+    jti = uuid.uuid4().hex
+    expire = datetime.now(timezone.utc) + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+    to_encode = data.copy()
+    to_encode.update({"exp": expire, "jti": jti, "type": "refresh"})
+    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM), jti, expire
+
+
+def decode_refresh_token(token: str) -> dict:
+    payload = decode_access_token(token)
+    if payload.get("type") != "refresh" or not payload.get("jti") or not payload.get("uid"):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return payload
+
+
+async def get_current_user(
+    token: str = Depends(oauth2_scheme),
+    session: AsyncSession = Depends(get_async_session)
+):
     # Local import to avoid circular import issues
-    from src.models import User
-    from src.crud import get_user_by_username
+    if DB_SHARDS:
+        from src.sharding import get_user_by_username
+    else:
+        from src.crud import get_user_by_username
 
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -65,25 +116,34 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
     try:
         payload = decode_access_token(token)
         username: Optional[str] = payload.get("sub")
-        if username is None:
+        # Refresh tokens are only accepted by /auth/refresh
+        if username is None or payload.get("type") == "refresh":
             raise credentials_exception
     except JWTError:
         raise credentials_exception
 
-    user = get_user_by_username(username)
+    user = user_cache.get(username)
     if user is None:
-        raise credentials_exception
-
-    # Return fresh user instance with all required attributes
-    return User(
-        id=user.id,
-        username=user.username,
-        email=user.email,
-        hashed_password=user.hashed_password,
-        balance=user.balance,
-        is_admin=user.is_admin,
-        created_at=user.created_at
-    )
+        user = await get_user_by_username(session, username)
+        if user is None:
+            raise credentials_exception
+        # Detach so the cached row can be shared by later requests, and hand
+        # the connection back to the pool instead of holding it for the
+        # rest of the request (users read from a shard come back detached)
+        if user in session:
+            session.expunge(user)
+        await session.rollback()
+        user_cache.set(username, user)
+    return user
+
+
+async def get_user_session(
+    current_user=Depends(get_current_user),
+    session: AsyncSession = Depends(get_async_session)
+):
+    # The current user's shard under DB_SHARDS, else the request session
+    async with user_session(session, current_user.id) as user_db:
+        yield user_db
 
 
 async def get_current_admin_user(current_user=Depends(get_current_user)):
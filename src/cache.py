@@ -0,0 +1,135 @@
+'''
+in-process caches shared by the auth and CRUD layers
+'''
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, NamedTuple, Optional, Tuple
+
+
+class TTLCache:
+    """Bounded LRU cache whose entries also expire after ``ttl`` seconds."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+
+class CatalogSnapshot(NamedTuple):
+    version: int
+    body: bytes
+    etag: str
+    # item id -> (body, etag)
+    items: Dict[str, Tuple[bytes, str]]
+
+
+def _etag(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+
+
+class CatalogCache:
+    """Pre-serialized item catalog, valid until the next ``bump()``."""
+
+    def __init__(self):
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self._snapshot: Optional[CatalogSnapshot] = None
+
+    def bump(self) -> None:
+        self.version += 1
+
+    def get(self) -> Optional[CatalogSnapshot]:
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.version == self.version:
+            self.hits += 1
+            return snapshot
+        self.misses += 1
+        return None
+
+    def store(self, version: int, items: List[dict]) -> CatalogSnapshot:
+        # `version` is read before loading; a bump during the load leaves the
+        # snapshot stale so the next request rebuilds it
+        encoded = {}
+        for item in items:
+            body = json.dumps(item, separators=(",", ":")).encode()
+            encoded[item["id"]] = (body, _etag(body))
+        body = b"[" + b",".join(entry[0] for entry in encoded.values()) + b"]"
+        snapshot = CatalogSnapshot(version, body, _etag(body), encoded)
+        if version == self.version:
+            self._snapshot = snapshot
+        return snapshot
+
+    def stats(self) -> dict:
+        snapshot = self._snapshot
+        return {
+            "version": self.version,
+            "items": len(snapshot.items) if snapshot else 0,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))
+
+# Authenticated principals keyed by username. Entries are detached User rows;
+# wallet mutations write their RETURNING balance straight into the cached row.
+user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+catalog_cache = CatalogCache()
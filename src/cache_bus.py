@@ -0,0 +1,202 @@
+'''
+cross-worker cache invalidation
+
+user_cache and catalog_cache live in each worker process. With several
+uvicorn workers, a top-up, purchase or stock change in one worker would
+leave the others serving the old balance or catalog until their TTL runs
+out. With CACHE_BUS_ENABLED, the CRUD layer publishes what it changed, and
+every CACHE_BUS_INTERVAL_MS each worker:
+
+1. writes its buffered events to the CacheInvalidation table in the main
+   database, one INSERT for the whole batch;
+2. reads the rows above the last id it applied (a primary key range scan)
+   and evicts the keys other workers changed.
+
+Other workers' caches therefore catch up within about two intervals of a
+commit, without any service beyond the database already in use. Writes
+never wait for the bus. Events are deduplicated while buffered, so a burst of
+top-ups on one wallet costs one row. Rows older than CACHE_BUS_RETENTION
+are pruned; a worker that hasn't polled successfully for that long may
+have missed some, so it clears its caches instead.
+
+Flash-sale counters (src/flash_sale.py) aren't a cache that can just be
+dropped: for those the event names the item, and the worker reloads that
+item's counter from the database.
+'''
+
+import asyncio
+import logging
+import os
+import time
+import uuid
+from datetime import datetime, timezone, timedelta
+from typing import Optional, Set, Tuple
+
+from sqlalchemy import delete, func, insert, select
+
+from src.cache import user_cache, catalog_cache
+from src.database import async_session, env_bool
+from src.models import CacheInvalidation
+
+logger = logging.getLogger(__name__)
+
+CACHE_BUS_ENABLED = env_bool("CACHE_BUS_ENABLED", False)
+CACHE_BUS_INTERVAL_MS = float(os.getenv("CACHE_BUS_INTERVAL_MS", "100"))
+CACHE_BUS_RETENTION = float(os.getenv("CACHE_BUS_RETENTION", "300"))
+# Rows read per query; a worker that fell behind reads several pages a tick
+CACHE_BUS_PAGE_SIZE = 1000
+
+
+class CacheBus:
+    def __init__(self, enabled: bool = CACHE_BUS_ENABLED, interval: float = CACHE_BUS_INTERVAL_MS / 1000,
+                 retention: float = CACHE_BUS_RETENTION):
+        self.enabled = enabled
+        self.interval = interval
+        self.retention = retention
+        self.origin = uuid.uuid4().hex
+        self.last_id = 0
+        self.published = 0
+        self.written = 0
+        self.applied = 0
+        self.polls = 0
+        self.resyncs = 0
+        self.errors = 0
+        self._pending: Set[Tuple[str, Optional[str]]] = set()
+        # Flash-sale items whose counters need reloading; None means all
+        self._flash_sale_items: Set[Optional[str]] = set()
+        self._last_poll = time.monotonic()
+        self._last_prune = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def publish(self, entity: str, key: Optional[str] = None) -> None:
+        # No-op unless the bus is running, so scripts using crud don't buffer
+        if self._task is None:
+            return
+        self._pending.add((entity, key))
+        self.published += 1
+
+    async def start(self) -> None:
+        if not self.enabled:
+            return
+        table = CacheInvalidation.__table__
+        async with async_session() as session:
+            # Only changes made from now on matter; the caches start empty
+            self.last_id = (await session.execute(select(func.max(table.c.id)))).scalar() or 0
+        self._last_poll = time.monotonic()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        try:
+            await self._write(self._pending)
+        except Exception as e:
+            logger.error("Dropping %d cache invalidations on shutdown: %s", len(self._pending), e)
+        self._pending = set()
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sync()
+            except Exception as e:
+                self.errors += 1
+                logger.error("Cache invalidation sync failed: %s", e, exc_info=True)
+
+    async def _write(self, events: Set[Tuple[str, Optional[str]]]) -> None:
+        if not events:
+            return
+        now = datetime.now(timezone.utc)
+        async with async_session() as session:
+            await session.execute(insert(CacheInvalidation.__table__), [
+                {"entity": entity, "key": key, "origin": self.origin, "created_at": now}
+                for entity, key in events
+            ])
+            await session.commit()
+        self.written += len(events)
+
+    async def sync(self) -> None:
+        pending, self._pending = self._pending, set()
+        try:
+            await self._write(pending)
+        except Exception:
+            self._pending |= pending
+            raise
+
+        if time.monotonic() - self._last_poll > self.retention:
+            # Rows this worker never read may already be pruned
+            user_cache.clear()
+            catalog_cache.bump()
+            self._flash_sale_items.add(None)
+            self.resyncs += 1
+
+        table = CacheInvalidation.__table__
+        async with async_session() as session:
+            # Ids are assigned under SQLite's write lock, so they become
+            # visible in order and reading past last_id can't skip a row
+            while True:
+                rows = (await session.execute(
+                    select(table.c.id, table.c.entity, table.c.key, table.c.origin)
+                    .where(table.c.id > self.last_id)
+                    .order_by(table.c.id)
+                    .limit(CACHE_BUS_PAGE_SIZE)
+                )).all()
+                for row_id, entity, key, origin in rows:
+                    self.last_id = row_id
+                    if origin != self.origin:
+                        self._apply(entity, key)
+                if len(rows) < CACHE_BUS_PAGE_SIZE:
+                    break
+            await self._reload_flash_sale()
+            self.polls += 1
+            self._last_poll = time.monotonic()
+
+            if self._last_poll - self._last_prune > self.retention / 5:
+                cutoff = datetime.now(timezone.utc) - timedelta(seconds=self.retention)
+                await session.execute(delete(table).where(table.c.created_at < cutoff))
+                await session.commit()
+                self._last_prune = self._last_poll
+
+    def _apply(self, entity: str, key: Optional[str]) -> None:
+        if entity == "user":
+            user_cache.invalidate(key)
+        elif entity == "catalog":
+            catalog_cache.bump()
+        elif entity == "flash_sale":
+            self._flash_sale_items.add(key)
+        self.applied += 1
+
+    async def _reload_flash_sale(self) -> None:
+        if not self._flash_sale_items:
+            return
+        # Local import to avoid circular import issues
+        from src.flash_sale import flash_sale
+        items, self._flash_sale_items = self._flash_sale_items, set()
+        try:
+            await flash_sale.reload(None if None in items else items)
+        except Exception:
+            self._flash_sale_items |= items
+            raise
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self._task is not None,
+            "last_id": self.last_id,
+            "pending": len(self._pending),
+            "published": self.published,
+            "written": self.written,
+            "applied": self.applied,
+            "polls": self.polls,
+            "resyncs": self.resyncs,
+            "errors": self.errors,
+            "seconds_since_poll": round(time.monotonic() - self._last_poll, 3),
+        }
+
+
+cache_bus = CacheBus()
@@ -1,250 +1,653 @@
 from sqlmodel import select
-from src.database import get_session
-from src.models import User, Item, Transaction
-from src.auth import get_password_hash
+from sqlalchemy import update, delete, insert, tuple_, func, literal_column
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlmodel.ext.asyncio.session import AsyncSession
+from src.models import User, Item, Transaction, RefreshToken, IdempotencyRecord
+from src.auth import get_password_hash_async
+from src.cache import user_cache, catalog_cache
+from src.cache_bus import cache_bus
+from src.metrics import wallet_operations
+from src import search
 from fastapi import HTTPException, status
-from typing import Tuple, Optional, List
+from typing import Iterable, NamedTuple, Tuple, Optional, List
+from datetime import datetime, timezone, timedelta
+import importlib
+import time
 import logging 
 import uuid
 
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-def create_user(username: str, password: str, role: str = "user") -> dict:
+# Sign-up credit; it has no Transaction row, so reconciliation starts here
+INITIAL_BALANCE = 1000.0
+
+# Cache changes are also published on the cache bus, so other worker
+# processes evict their copies
+def _catalog_changed() -> None:
+    catalog_cache.bump()
+    cache_bus.publish("catalog")
+
+def _forget_user(username: str) -> None:
+    user_cache.invalidate(username)
+    cache_bus.publish("user", username)
+
+def _flash_sale_changed(item_id: str) -> None:
+    # The caller updates this worker's counter; others reload theirs
+    cache_bus.publish("flash_sale", item_id)
+
+async def create_user(session: AsyncSession, username: str, password: str, role: str = "user") -> dict:
     try:
-        logger.debug(f"Attempting to create user: {username}, role: {role}")
-
-        session = next(get_session())
-        try:
-            existing_user = session.exec(select(User).where(User.username == username)).first()
-            if existing_user:
-                logger.warning(f"Username already exists: {username}")
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail="Username already registered"
-                )
-    
-            logger.debug("Hashing password...")
-            password_hash = get_password_hash(password)
-            logger.debug("Password hashed successfully")
-    
-            is_admin = role == "admin"
-            user = User(
-                username=username,
-                email=f"{username}@example.com",
-                hashed_password=password_hash,
-                balance=1000.0,
-                is_admin=is_admin
+        logger.debug("Attempting to create user: %s, role: %s", username, role)
+
+        existing_user = (await session.exec(select(User).where(User.username == username))).first()
+        if existing_user:
+            logger.warning("Username already exists: %s", username)
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Username already registered"
             )
-            logger.debug(f"User object created for: {username}")
-    
-            session.add(user)
-            session.commit()
-            session.refresh(user)
-            logger.debug(f"User created successfully with ID: {user.id}")
-    
-            return {
-                "id": user.id,
-                "username": user.username,
-                "wallet_bal": user.balance,
-                "role": "admin" if user.is_admin else "user"
-            }
-        finally:
-            session.close()
+
+        logger.debug("Hashing password...")
+        password_hash = await get_password_hash_async(password)
+        logger.debug("Password hashed successfully")
+
+        is_admin = role == "admin"
+        user = User(
+            username=username,
+            email=f"{username}@example.com",
+            hashed_password=password_hash,
+            balance=INITIAL_BALANCE,
+            is_admin=is_admin
+        )
+        logger.debug("User object created for: %s", username)
+
+        session.add(user)
+        await session.commit()
+        await session.refresh(user)
+        logger.debug("User created successfully with ID: %s", user.id)
+
+        return {
+            "id": user.id,
+            "username": user.username,
+            "wallet_bal": user.balance,
+            "role": "admin" if user.is_admin else "user"
+        }
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Error creating user: {str(e)}", exc_info=True)
+        logger.error("Error creating user: %s", e, exc_info=True)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to create user: {str(e)}"
         )
 
-def create_clean_user(user: User) -> User:
-    return User(
-        id=user.id,
-        username=user.username,
-        email=user.email,
-        hashed_password=user.hashed_password,
-        balance=user.balance,
-        is_admin=user.is_admin,
-        created_at=user.created_at
-    )
+async def get_user_by_username(session: AsyncSession, username: str) -> Optional[User]:
+    return (await session.exec(select(User).where(User.username == username))).first()
 
-def get_user_by_username(username: str) -> Optional[User]:
-    session = next(get_session())
-    try:
-        user = session.exec(select(User).where(User.username == username)).first()
-        if user:
-            return create_clean_user(user)
-        return None
-    finally:
-        session.close()
+async def get_user_by_id(session: AsyncSession, user_id: str) -> Optional[User]:
+    return await session.get(User, user_id)
 
-def get_user_by_id(user_id: str) -> Optional[User]:
-    session = next(get_session())
-    try:
-        user = session.get(User, user_id)
-        if user:
-            return create_clean_user(user)
-        return None
-    finally:
-        session.close()
+async def list_users(session: AsyncSession) -> List[User]:
+    return list((await session.exec(select(User))).all())
 
-def list_users() -> List[User]:
-    session = next(get_session())
-    try:
-        users = session.exec(select(User)).all()
-        return [create_clean_user(user) for user in users]
-    finally:
-        session.close()
+async def list_items(session: AsyncSession) -> List[Item]:
+    return list((await session.exec(select(Item))).all())
 
-def list_items() -> List[Item]:
-    session = next(get_session())
-    try:
-        return list(session.exec(select(Item)).all())
-    finally:
-        session.close()
+async def get_item_by_id(session: AsyncSession, item_id: str) -> Optional[Item]:
+    return await session.get(Item, item_id)
 
-def get_item_by_id(item_id: str) -> Optional[Item]:
-    session = next(get_session())
-    try:
-        return session.get(Item, item_id)
-    finally:
-        session.close()
+async def add_item(session: AsyncSession, name: str, price: float, stock_val: int, flash_sale: bool = False) -> Item:
+    item = Item(name=name, price=price, stock_val=stock_val, flash_sale=flash_sale)
+    session.add(item)
+    await session.commit()
+    await session.refresh(item)
+    _catalog_changed()
+    if item.flash_sale:
+        _flash_sale_changed(item.id)
+    return item
 
-def add_item(name: str, price: float, stock_val: int) -> Item:
-    session = next(get_session())
-    try:
-        item = Item(name=name, price=price, stock_val=stock_val)
+async def update_item_stock(session: AsyncSession, item_id: str, new_stock: int) -> Optional[Item]:
+    item = await session.get(Item, item_id)
+    if item:
+        item.stock_val = new_stock
         session.add(item)
-        session.commit()
-        session.refresh(item)
-        return item
-    finally:
-        session.close()
-
-def update_item_stock(item_id: str, new_stock: int) -> Optional[Item]:
-    session = next(get_session())
-    try:
-        item = session.get(Item, item_id)
-        if item:
-            item.stock_val = new_stock
-            session.add(item)
-            session.commit()
-            session.refresh(item)
-        return item
-    finally:
-        session.close()
-
-def spend_money(user_id: str, amount: float) -> Tuple[Optional[User], Optional[Transaction]]:
-    session = next(get_session())
-    try:
-        user = session.get(User, user_id)
-        if not user or user.balance < amount:
-            return None, None
-        
-        user.balance -= amount
-        transaction = Transaction(
-            user_id=user_id,
-            amount=-amount,
-            transaction_type="spend"
+        await session.commit()
+        await session.refresh(item)
+        _catalog_changed()
+        if item.flash_sale:
+            # Local import to avoid circular import issues
+            from src.flash_sale import flash_sale
+            flash_sale.restock(item.id, item.stock_val)
+            _flash_sale_changed(item.id)
+    return item
+
+async def set_item_flash_sale(session: AsyncSession, item_id: str, enabled: bool) -> Optional[Item]:
+    item = (await session.exec(
+        update(Item)
+        .where(Item.id == item_id)
+        .values(flash_sale=enabled)
+        .returning(Item)
+        .execution_options(synchronize_session=False, populate_existing=True)
+    )).scalar_one_or_none()
+    await session.commit()
+    if item:
+        _flash_sale_changed(item.id)
+    return item
+
+async def list_flash_sale_items(session: AsyncSession, item_ids: Optional[Iterable[str]] = None) -> List[Item]:
+    statement = select(Item).where(Item.flash_sale == True)  # noqa: E712
+    if item_ids is not None:
+        statement = statement.where(Item.id.in_(list(item_ids)))
+    return list((await session.exec(statement)).all())
+
+ITEM_SEARCH_PAGE_SIZE = 50
+ITEM_SEARCH_PAGE_MAX = 200
+ITEM_SEARCH_SORTS = ("relevance", "name", "price", "-price")
+
+async def search_items(
+    session: AsyncSession,
+    q: Optional[str] = None,
+    prefix: Optional[str] = None,
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+    in_stock: bool = False,
+    sort: str = "relevance",
+    limit: int = ITEM_SEARCH_PAGE_SIZE,
+    after: Optional[Tuple[object, str]] = None,
+) -> List[tuple]:
+    # Rows are (id, name, price, stock_val, sort_key); `after` is the
+    # (sort_key, id) of the last row already seen
+    statement = select(Item.id, Item.name, Item.price, Item.stock_val)
+    match = search.fts_match_query(q) if q else None
+    if q and match is None:
+        return []
+    rank = None
+    if match and search.fts_enabled:
+        rank = search.item_fts.c.rank
+        statement = statement.join(
+            search.item_search_key, search.item_search_key.c.item_id == Item.id
+        ).join(
+            search.item_fts, search.item_fts.c.rowid == search.item_search_key.c.search_id
+        ).where(literal_column("item_fts").op("MATCH")(match))
+    elif match:
+        for term in search.search_terms(q):
+            statement = statement.where(func.lower(Item.name).contains(term.lower(), autoescape=True))
+    if prefix:
+        # A range rather than LIKE so the ix_item_name index is used
+        statement = statement.where(Item.name >= prefix, Item.name < prefix + "\U0010ffff")
+    if min_price is not None:
+        statement = statement.where(Item.price >= min_price)
+    if max_price is not None:
+        statement = statement.where(Item.price <= max_price)
+    if in_stock:
+        statement = statement.where(Item.stock_val > 0)
+
+    if sort == "relevance" and rank is None:
+        sort = "name"
+    key = {"relevance": rank, "name": Item.name, "price": Item.price, "-price": Item.price}[sort]
+    descending = sort == "-price"
+    if after:
+        after_key, after_id = after
+        if descending:
+            statement = statement.where(tuple_(key, Item.id) < tuple_(after_key, after_id))
+        else:
+            statement = statement.where(tuple_(key, Item.id) > tuple_(after_key, after_id))
+    if descending:
+        statement = statement.order_by(key.desc(), Item.id.desc())
+    else:
+        statement = statement.order_by(key, Item.id)
+    statement = statement.add_columns(key).limit(min(limit, ITEM_SEARCH_PAGE_MAX))
+    return list((await session.exec(statement)).all())
+
+# Imported when first used; loading the postgresql dialect on a SQLite
+# deployment would only slow down worker start
+_UPSERT_DIALECTS = {"sqlite": "sqlalchemy.dialects.sqlite", "postgresql": "sqlalchemy.dialects.postgresql"}
+IMPORT_UPDATE_COLUMNS = ("name", "price", "stock_val", "flash_sale")
+
+async def bulk_import_items(session: AsyncSession, rows: List[dict], upsert: bool = False) -> None:
+    # One executemany and one commit for the whole batch. Rows need every
+    # column, including id. With upsert, an existing id is updated in place.
+    table = Item.__table__
+    if upsert:
+        dialect = session.bind.dialect.name
+        if dialect not in _UPSERT_DIALECTS:
+            raise ValueError(f"upsert is not supported on {dialect}")
+        statement = importlib.import_module(_UPSERT_DIALECTS[dialect]).insert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.id],
+            set_={column: statement.excluded[column] for column in IMPORT_UPDATE_COLUMNS}
         )
-        session.add(user)
-        session.add(transaction)
-        session.commit()
-        session.refresh(user)
-        session.refresh(transaction)
-        return user, transaction
-    finally:
-        session.close()
-
-def top_up_wallet(user_id: str, amount: float) -> Tuple[Optional[User], Optional[Transaction]]:
-    session = next(get_session())
+    else:
+        statement = insert(table)
     try:
-        user = session.get(User, user_id)
-        if not user:
-            return None, None
-        
-        user.balance += amount
+        await session.exec(statement, params=rows)
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        raise
+    _catalog_changed()
+
+# Wallet mutations take the User already loaded into the request session
+# by get_current_user instead of fetching it again by id. Balances and stock
+# are changed with conditional UPDATE ... RETURNING statements so concurrent
+# requests can't lose updates or overdraw, and nothing needs a refresh.
+def _as_balance(value) -> Optional[float]:
+    # SQLite hands back whole-number REALs as int (940, not 940.0)
+    return None if value is None else float(value)
+
+class _Posting(NamedTuple):
+    # A balance change: the new balance, and the ledger_seq its
+    # Transaction row takes
+    balance: float
+    ledger_seq: int
+
+def _as_posting(row) -> Optional[_Posting]:
+    return None if row is None else _Posting(_as_balance(row.balance), row.ledger_seq)
+
+async def _debit(session: AsyncSession, user_id: str, amount: float) -> Optional[_Posting]:
+    result = await session.exec(
+        update(User)
+        .where(User.id == user_id, User.balance >= amount)
+        .values(balance=User.balance - amount, ledger_seq=User.ledger_seq + 1)
+        .returning(User.balance, User.ledger_seq)
+        .execution_options(synchronize_session=False)
+    )
+    return _as_posting(result.one_or_none())
+
+async def _credit(session: AsyncSession, user_id: str, amount: float) -> Optional[_Posting]:
+    result = await session.exec(
+        update(User)
+        .where(User.id == user_id)
+        .values(balance=User.balance + amount, ledger_seq=User.ledger_seq + 1)
+        .returning(User.balance, User.ledger_seq)
+        .execution_options(synchronize_session=False)
+    )
+    return _as_posting(result.one_or_none())
+
+def _remember_balance(user: User, new_balance: float) -> None:
+    # Keeps the cached principal in step with the committed balance
+    set_committed_value(user, "balance", new_balance)
+    user_cache.set(user.username, user)
+    cache_bus.publish("user", user.username)
+
+async def spend_money(session: AsyncSession, user: User, amount: float) -> Tuple[Optional[User], Optional[Transaction]]:
+    posting = await _debit(session, user.id, amount)
+    if posting is None:
+        await session.rollback()
+        wallet_operations.inc(operation="spend", outcome="insufficient_funds")
+        return None, None
+
+    transaction = Transaction(
+        user_id=user.id,
+        amount=-amount,
+        transaction_type="spend",
+        ledger_seq=posting.ledger_seq
+    )
+    session.add(transaction)
+    await session.commit()
+    _remember_balance(user, posting.balance)
+    wallet_operations.inc(operation="spend", outcome="ok")
+    return user, transaction
+
+async def top_up_wallet(session: AsyncSession, user: User, amount: float) -> Tuple[Optional[User], Optional[Transaction]]:
+    posting = await _credit(session, user.id, amount)
+    if posting is None:
+        await session.rollback()
+        wallet_operations.inc(operation="top_up", outcome="unknown_user")
+        return None, None
+
+    transaction = Transaction(
+        user_id=user.id,
+        amount=amount,
+        transaction_type="top_up",
+        ledger_seq=posting.ledger_seq
+    )
+    session.add(transaction)
+    await session.commit()
+    _remember_balance(user, posting.balance)
+    wallet_operations.inc(operation="top_up", outcome="ok")
+    return user, transaction
+
+async def apply_wallet_operations(session: AsyncSession, operations: List[Tuple[str, User, float]]) -> List[Optional[Tuple[float, Transaction]]]:
+    # Group commit: many top-ups/spends in one transaction, each still a
+    # guarded single-statement UPDATE. Returns each operation's own balance.
+    results: List[Optional[Tuple[float, Transaction]]] = []
+    for kind, user, amount in operations:
+        if kind == "spend":
+            posting = await _debit(session, user.id, amount)
+            signed_amount = -amount
+        else:
+            posting = await _credit(session, user.id, amount)
+            signed_amount = amount
+        if posting is None:
+            results.append(None)
+            continue
         transaction = Transaction(
-            user_id=user_id,
-            amount=amount,
-            transaction_type="top_up"
+            user_id=user.id,
+            amount=signed_amount,
+            transaction_type=kind,
+            ledger_seq=posting.ledger_seq
         )
-        session.add(user)
         session.add(transaction)
-        session.commit()
-        session.refresh(user)
-        session.refresh(transaction)
-        return user, transaction
-    finally:
-        session.close()
-
-def transfer_money(sender_id: str, recipient_username: str, amount: float) -> Tuple[Optional[User], Optional[User], Optional[Transaction]]:
-    session = next(get_session())
-    try:
-        sender = session.get(User, sender_id)
-        recipient = session.exec(select(User).where(User.username == recipient_username)).first()
-        if not sender or not recipient or sender.id == recipient.id or sender.balance < amount:
-            return None, None, None
-        
-        sender.balance -= amount
-        recipient.balance += amount
-        
-        transaction = Transaction(
-            user_id=sender_id,
-            amount=-amount,
-            transaction_type="transfer_out"
-        )
-        recipient_transaction = Transaction(
-            user_id=recipient.id,
-            amount=amount,
-            transaction_type="transfer_in"
+        results.append((posting.balance, transaction))
+    await session.commit()
+    for (kind, user, amount), result in zip(operations, results):
+        if result:
+            _remember_balance(user, result[0])
+            wallet_operations.inc(operation=kind, outcome="ok")
+        else:
+            wallet_operations.inc(operation=kind, outcome="insufficient_funds" if kind == "spend" else "unknown_user")
+    return results
+
+async def transfer_money(session: AsyncSession, sender: User, recipient_username: str, amount: float) -> Tuple[Optional[User], Optional[User], Optional[Transaction]]:
+    recipient = (await session.exec(
+        select(User).where(User.username == recipient_username, User.id != sender.id)
+    )).first()
+    if recipient is None:
+        await session.rollback()
+        wallet_operations.inc(operation="transfer", outcome="invalid_recipient")
+        return None, None, None
+
+    # Both wallets are updated in user-id order, so concurrent transfers in
+    # opposite directions take the row locks in the same order and can't
+    # deadlock (PostgreSQL; SQLite has one write lock anyway)
+    if sender.id < recipient.id:
+        sender_posting = await _debit(session, sender.id, amount)
+        recipient_posting = sender_posting and await _credit(session, recipient.id, amount)
+    else:
+        recipient_posting = await _credit(session, recipient.id, amount)
+        sender_posting = recipient_posting and await _debit(session, sender.id, amount)
+    if sender_posting is None or recipient_posting is None:
+        await session.rollback()
+        wallet_operations.inc(operation="transfer", outcome="insufficient_funds")
+        return None, None, None
+
+    transaction = Transaction(
+        user_id=sender.id,
+        amount=-amount,
+        transaction_type="transfer_out",
+        ledger_seq=sender_posting.ledger_seq
+    )
+    recipient_transaction = Transaction(
+        user_id=recipient.id,
+        amount=amount,
+        transaction_type="transfer_in",
+        ledger_seq=recipient_posting.ledger_seq
+    )
+    session.add(transaction)
+    session.add(recipient_transaction)
+    await session.commit()
+    _remember_balance(sender, sender_posting.balance)
+    set_committed_value(recipient, "balance", recipient_posting.balance)
+    _forget_user(recipient.username)
+    wallet_operations.inc(operation="transfer", outcome="ok")
+    return sender, recipient, transaction
+
+async def buy_item(session: AsyncSession, user: User, item_id: str) -> Tuple[Optional[User], Optional[Item], Optional[Transaction]]:
+    item = (await session.exec(
+        update(Item)
+        .where(Item.id == item_id, Item.stock_val > 0)
+        .values(stock_val=Item.stock_val - 1)
+        .returning(Item)
+        .execution_options(synchronize_session=False, populate_existing=True)
+    )).scalar_one_or_none()
+    if item is None:
+        await session.rollback()
+        # Unknown item ids land here too
+        wallet_operations.inc(operation="purchase", outcome="out_of_stock")
+        return None, None, None
+
+    posting = await _debit(session, user.id, item.price)
+    if posting is None:
+        # Rolls the stock decrement back as well
+        await session.rollback()
+        wallet_operations.inc(operation="purchase", outcome="insufficient_funds")
+        return None, None, None
+
+    transaction = Transaction(
+        user_id=user.id,
+        product_id=item_id,
+        amount=-item.price,
+        transaction_type="purchase",
+        ledger_seq=posting.ledger_seq
+    )
+    session.add(transaction)
+    await session.commit()
+    _remember_balance(user, posting.balance)
+    _catalog_changed()
+    wallet_operations.inc(operation="purchase", outcome="ok")
+    return user, item, transaction
+
+TRANSACTION_PAGE_SIZE = 50
+TRANSACTION_PAGE_MAX = 500
+
+def _as_utc(value: datetime) -> datetime:
+    # Naive values (e.g. read back from SQLite) are UTC
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+def _user_transactions_statement(
+    statement,
+    user_id: str,
+    limit: int,
+    after: Optional[Tuple[datetime, str]],
+    transaction_type: Optional[str],
+    since: Optional[datetime],
+    until: Optional[datetime],
+):
+    # Newest first; `after` is the (timestamp, id) of the last row already seen
+    statement = statement.where(Transaction.user_id == user_id)
+    if transaction_type:
+        statement = statement.where(Transaction.transaction_type == transaction_type)
+    if since:
+        statement = statement.where(Transaction.timestamp >= _as_utc(since))
+    if until:
+        statement = statement.where(Transaction.timestamp < _as_utc(until))
+    if after:
+        after_timestamp, after_id = after
+        statement = statement.where(
+            tuple_(Transaction.timestamp, Transaction.id) < tuple_(_as_utc(after_timestamp), after_id)
         )
-        session.add(sender)
-        session.add(recipient)
-        session.add(transaction)
-        session.add(recipient_transaction)
-        session.commit()
-        session.refresh(sender)
-        session.refresh(recipient)
-        session.refresh(transaction)
-        return sender, recipient, transaction
-    finally:
-        session.close()
-
-def buy_item(user_id: str, item_id: str) -> Tuple[Optional[User], Optional[Item], Optional[Transaction]]:
-    session = next(get_session())
-    try:
-        user = session.get(User, user_id)
-        item = session.get(Item, item_id)
-        if not user or not item or user.balance < item.price or item.stock_val <= 0:
-            return None, None, None
-        
-        user.balance -= item.price
-        item.stock_val -= 1
-        
+    statement = statement.order_by(Transaction.timestamp.desc(), Transaction.id.desc())
+    return statement.limit(min(limit, TRANSACTION_PAGE_MAX))
+
+async def get_user_transactions(
+    session: AsyncSession,
+    user_id: str,
+    limit: int = TRANSACTION_PAGE_SIZE,
+    after: Optional[Tuple[datetime, str]] = None,
+    transaction_type: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+) -> List[Transaction]:
+    statement = _user_transactions_statement(
+        select(Transaction), user_id, limit, after, transaction_type, since, until
+    )
+    return list((await session.exec(statement)).all())
+
+# Plain-tuple variants for the list endpoints: no ORM identity map or
+# attribute instrumentation, columns in TRANSACTION_ROW_COLUMNS order.
+TRANSACTION_ROW_COLUMNS = (
+    Transaction.id, Transaction.user_id, Transaction.product_id,
+    Transaction.amount, Transaction.timestamp, Transaction.transaction_type
+)
+USER_ROW_COLUMNS = (User.id, User.username, User.balance, User.is_admin)
+
+async def get_user_transaction_rows(
+    session: AsyncSession,
+    user_id: str,
+    limit: int = TRANSACTION_PAGE_SIZE,
+    after: Optional[Tuple[datetime, str]] = None,
+    transaction_type: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+) -> List[tuple]:
+    statement = _user_transactions_statement(
+        select(*TRANSACTION_ROW_COLUMNS), user_id, limit, after, transaction_type, since, until
+    )
+    return list((await session.exec(statement)).all())
+
+async def list_user_rows(session: AsyncSession) -> List[tuple]:
+    return list((await session.exec(select(*USER_ROW_COLUMNS))).all())
+
+async def apply_flash_sale_orders(session: AsyncSession, orders: List[Tuple[User, str]]) -> Tuple[List[Optional[Tuple[Item, Transaction]]], List[str]]:
+    # Commits a whole batch of flash-sale purchases in one transaction. Each
+    # order still gets its own guarded stock and balance UPDATE, so a batch
+    # never oversells or overdraws, and stock, debits and ledger rows land
+    # together or not at all. Returns each order's result (None if refused)
+    # and its outcome: "ok", "out_of_stock" or "insufficient_funds".
+    results: List[Optional[Tuple[Item, Transaction]]] = []
+    balances = []
+    outcomes = []
+    for user, item_id in orders:
+        item = (await session.exec(
+            update(Item)
+            .where(Item.id == item_id, Item.stock_val > 0)
+            .values(stock_val=Item.stock_val - 1)
+            .returning(Item)
+            .execution_options(synchronize_session=False, populate_existing=True)
+        )).scalar_one_or_none()
+        if item is None:
+            results.append(None)
+            outcomes.append("out_of_stock")
+            continue
+        posting = await _debit(session, user.id, item.price)
+        if posting is None:
+            await session.exec(
+                update(Item)
+                .where(Item.id == item_id)
+                .values(stock_val=Item.stock_val + 1)
+                .execution_options(synchronize_session=False)
+            )
+            results.append(None)
+            outcomes.append("insufficient_funds")
+            continue
         transaction = Transaction(
-            user_id=user_id,
+            user_id=user.id,
             product_id=item_id,
             amount=-item.price,
-            transaction_type="purchase"
+            transaction_type="purchase",
+            ledger_seq=posting.ledger_seq
         )
-        session.add(user)
-        session.add(item)
         session.add(transaction)
-        session.commit()
-        session.refresh(user)
-        session.refresh(item)
-        session.refresh(transaction)
-        return user, item, transaction
-    finally:
-        session.close()
-
-def get_user_transactions(user_id: str) -> List[Transaction]:
-    session = next(get_session())
+        balances.append((user, posting.balance))
+        outcomes.append("ok")
+        # Snapshot the stock now; later orders in the batch refresh the same row
+        results.append((Item(id=item.id, name=item.name, price=item.price, stock_val=item.stock_val), transaction))
+    await session.commit()
+    for user, new_balance in balances:
+        _remember_balance(user, new_balance)
+    if balances:
+        _catalog_changed()
+    for outcome in outcomes:
+        wallet_operations.inc(operation="flash_sale_purchase", outcome=outcome)
+    return results, outcomes
+
+EXPORT_BATCH_SIZE = 1000
+
+async def iter_transaction_batches(session: AsyncSession, user_id: Optional[str] = None, batch_size: int = EXPORT_BATCH_SIZE):
+    # Plain column tuples fetched batch_size at a time from a server-side cursor,
+    # walking ix_transaction_user_id_timestamp so no sort is needed
+    statement = select(
+        Transaction.id,
+        Transaction.user_id,
+        Transaction.product_id,
+        Transaction.amount,
+        Transaction.timestamp,
+        Transaction.transaction_type,
+    )
+    if user_id:
+        statement = statement.where(Transaction.user_id == user_id)
+    statement = statement.order_by(Transaction.user_id, Transaction.timestamp, Transaction.id)
+    result = await session.stream(statement.execution_options(yield_per=batch_size))
+    async for rows in result.partitions():
+        yield rows
+
+# Refresh tokens: one row per live token id, deleted on use so each token
+# can only be redeemed once. Expired rows are swept at most once per interval.
+REFRESH_TOKEN_PURGE_INTERVAL = 300
+_last_refresh_token_purge = 0.0
+
+async def purge_expired_refresh_tokens(session: AsyncSession) -> int:
+    result = await session.exec(
+        delete(RefreshToken).where(RefreshToken.expires_at <= datetime.now(timezone.utc))
+    )
+    return result.rowcount
+
+async def store_refresh_token(session: AsyncSession, jti: str, user_id: str, expires_at: datetime) -> None:
+    global _last_refresh_token_purge
+    if time.monotonic() - _last_refresh_token_purge > REFRESH_TOKEN_PURGE_INTERVAL:
+        _last_refresh_token_purge = time.monotonic()
+        await purge_expired_refresh_tokens(session)
+    session.add(RefreshToken(jti=jti, user_id=user_id, expires_at=expires_at))
+    await session.commit()
+
+async def rotate_refresh_token(session: AsyncSession, old_jti: str, new_jti: str, expires_at: datetime) -> Optional[str]:
+    user_id = (await session.exec(
+        delete(RefreshToken)
+        .where(RefreshToken.jti == old_jti, RefreshToken.expires_at > datetime.now(timezone.utc))
+        .returning(RefreshToken.user_id)
+    )).scalar_one_or_none()
+    if user_id is None:
+        await session.rollback()
+        return None
+    session.add(RefreshToken(jti=new_jti, user_id=user_id, expires_at=expires_at))
+    await session.commit()
+    return user_id
+
+async def revoke_refresh_token(session: AsyncSession, jti: str) -> bool:
+    result = await session.exec(delete(RefreshToken).where(RefreshToken.jti == jti))
+    await session.commit()
+    return result.rowcount > 0
+
+# Idempotency keys: the first request inserts a placeholder row (the claim),
+# later duplicates find it and either replay the stored response or wait.
+async def claim_idempotency_key(session: AsyncSession, key: str, fingerprint: str, claim_timeout: float) -> Optional[IdempotencyRecord]:
+    # Returns None when this caller won the claim, else the existing record.
+    # A claim left unanswered for claim_timeout seconds is presumed
+    # abandoned (its worker crashed or restarted), and a request with the
+    # same body takes it over.
+    session.add(IdempotencyRecord(key=key, fingerprint=fingerprint))
     try:
-        return list(session.exec(select(Transaction).where(Transaction.user_id == user_id)).all())
-    finally:
-        session.close()
\ No newline at end of file
+        await session.commit()
+        return None
+    except IntegrityError:
+        await session.rollback()
+    now = datetime.now(timezone.utc)
+    result = await session.exec(
+        update(IdempotencyRecord)
+        .where(
+            IdempotencyRecord.key == key,
+            IdempotencyRecord.status_code.is_(None),
+            IdempotencyRecord.fingerprint == fingerprint,
+            IdempotencyRecord.created_at < now - timedelta(seconds=claim_timeout),
+        )
+        .values(created_at=now)
+    )
+    await session.commit()
+    if result.rowcount:
+        return None
+    return await get_idempotency_record(session, key)
+
+async def get_idempotency_record(session: AsyncSession, key: str) -> Optional[IdempotencyRecord]:
+    return await session.get(IdempotencyRecord, key, populate_existing=True)
+
+async def complete_idempotency_key(session: AsyncSession, key: str, status_code: int, content_type: Optional[str], body: bytes) -> None:
+    await session.exec(
+        update(IdempotencyRecord)
+        .where(IdempotencyRecord.key == key)
+        .values(status_code=status_code, content_type=content_type, body=body)
+    )
+    await session.commit()
+
+async def release_idempotency_key(session: AsyncSession, key: str) -> None:
+    await session.exec(delete(IdempotencyRecord).where(IdempotencyRecord.key == key))
+    await session.commit()
+
+async def purge_expired_idempotency_records(session: AsyncSession, ttl_seconds: float) -> int:
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=ttl_seconds)
+    result = await session.exec(delete(IdempotencyRecord).where(IdempotencyRecord.created_at < cutoff))
+    await session.commit()
+    return result.rowcount
@@ -1,21 +1,159 @@
+import hashlib
+import importlib.util
 import os
-from sqlmodel import create_engine, SQLModel, Session
+from contextlib import nullcontext
+from typing import List
+from sqlmodel import create_engine, Session
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy import event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
 from dotenv import load_dotenv
+from src.metrics import instrument_engine
 
 load_dotenv()
 
+def env_bool(name: str, default: bool) -> bool:
+    return os.getenv(name, str(default)).strip().lower() in ("1", "true", "yes", "on")
+
 # Use SQLite for testing instead of PostgreSQL
-DATABASE_URL = "sqlite:///./test.db"
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./test.db")
+
+DB_ECHO = env_bool("DB_ECHO", False)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+
+# Only applied to SQLite connections
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+# Negative values are KiB, so the default is a 64 MiB page cache
+SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", "-65536"))
+
+# Opt-in sharding: with DB_SHARDS=N, users, their ledger, refresh tokens and
+# balance checkpoints live in N databases picked by a hash of the user id.
+# DATABASE_URL keeps items, the username directory and everything else.
+# N can't change once users exist.
+DB_SHARDS = int(os.getenv("DB_SHARDS", "0"))
+DB_SHARD_URL = os.getenv("DB_SHARD_URL", "sqlite:///./test.shard{shard}.db")
+
+# backend -> (async driver, package it needs)
+_ASYNC_DRIVERS = {
+    "sqlite": ("sqlite+aiosqlite", "aiosqlite"),
+    "postgresql": ("postgresql+asyncpg", "asyncpg"),
+}
+
+def to_async_url(url: str) -> str:
+    parsed = make_url(url)
+    backend = parsed.get_backend_name()
+    if backend not in _ASYNC_DRIVERS or parsed.get_dialect().is_async:
+        return url
+    driver, module = _ASYNC_DRIVERS[backend]
+    if importlib.util.find_spec(module) is None:
+        raise RuntimeError(f"{backend} URLs need the {module} package for the async engine: pip install {module}")
+    return parsed.set(drivername=driver).render_as_string(hide_password=False)
+
+def _is_sqlite(url: str) -> bool:
+    return make_url(url).get_backend_name() == "sqlite"
+
+def _is_memory_sqlite(url: str) -> bool:
+    database = make_url(url).database
+    return _is_sqlite(url) and (not database or database == ":memory:")
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.execute(f"PRAGMA cache_size={SQLITE_CACHE_SIZE}")
+    cursor.close()
+
+def _engine_kwargs(url: str) -> dict:
+    kwargs = {"echo": DB_ECHO}
+    if _is_sqlite(url):
+        kwargs["connect_args"] = {"check_same_thread": False}
+    if not _is_memory_sqlite(url):
+        kwargs.update(
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_recycle=DB_POOL_RECYCLE,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_pre_ping=not _is_sqlite(url),
+        )
+    return kwargs
+
+def create_db_engine(url: str = DATABASE_URL) -> Engine:
+    db_engine = create_engine(url, **_engine_kwargs(url))
+    if _is_sqlite(url):
+        event.listen(db_engine, "connect", _set_sqlite_pragmas)
+    return db_engine
 
-engine = create_engine(DATABASE_URL, echo=True, connect_args={"check_same_thread": False})
+def create_async_db_engine(url: str = DATABASE_URL) -> AsyncEngine:
+    url = to_async_url(url)
+    db_engine = create_async_engine(url, **_engine_kwargs(url))
+    if _is_sqlite(url):
+        event.listen(db_engine.sync_engine, "connect", _set_sqlite_pragmas)
+    return db_engine
+
+engine = create_db_engine()
+async_engine = create_async_db_engine()
+instrument_engine(engine, "sync")
+instrument_engine(async_engine.sync_engine, "async")
+
+def shard_url(shard: int) -> str:
+    return DB_SHARD_URL.format(shard=shard)
+
+def shard_for(user_id: str) -> int:
+    digest = hashlib.blake2b(user_id.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % DB_SHARDS
+
+shard_engines = [create_db_engine(shard_url(shard)) for shard in range(DB_SHARDS)]
+shard_async_engines = [create_async_db_engine(shard_url(shard)) for shard in range(DB_SHARDS)]
+for shard, shard_engine in enumerate(shard_async_engines):
+    instrument_engine(shard_engine.sync_engine, f"shard{shard}")
+
+def shard_tables():
+    # Local import to avoid circular import issues
+    from src.models import User, Transaction, RefreshToken, BalanceCheckpoint
+    return [model.__table__ for model in (User, Transaction, RefreshToken, BalanceCheckpoint)]
 
 def init_db():
-    SQLModel.metadata.create_all(engine)
+    # Local import to avoid circular import issues
+    from src.migrate import ensure_schema
+    ensure_schema()
 
 def get_session():
     with Session(engine) as session:
         yield session
 
+def async_session() -> AsyncSession:
+    # expire_on_commit=False so returned objects can be read without lazy IO
+    return AsyncSession(async_engine, expire_on_commit=False)
+
+async def get_async_session():
+    async with async_session() as session:
+        yield session
+
+def shard_session(shard: int) -> AsyncSession:
+    return AsyncSession(shard_async_engines[shard], expire_on_commit=False)
+
+def shard_sessions() -> List[AsyncSession]:
+    # One session per database holding users, for fan-out reads
+    if not DB_SHARDS:
+        return [async_session()]
+    return [shard_session(shard) for shard in range(DB_SHARDS)]
+
+def user_session(session: AsyncSession, user_id: str):
+    # Context manager for work on one user's row, ledger or refresh tokens:
+    # `session` itself, unless DB_SHARDS puts the user on a shard
+    if not DB_SHARDS:
+        return nullcontext(session)
+    return shard_session(shard_for(user_id))
+
 # Remove the test connection function that's causing the error
 def test_db_connection():
     try:
@@ -26,4 +164,4 @@ def test_db_connection():
         # Don't raise the exception during import
         pass
 
-# Don't call test_db_connection() during import
\ No newline at end of file
+# Don't call test_db_connection() during import
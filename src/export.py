@@ -0,0 +1,52 @@
+'''
+streaming ledger exports (NDJSON / CSV)
+'''
+
+import csv
+import io
+import json
+from typing import AsyncIterator, Optional
+
+from src.database import DB_SHARDS, shard_for, shard_session, shard_sessions
+from src.crud import iter_transaction_batches
+
+EXPORT_COLUMNS = ("id", "user_id", "product_id", "amount", "timestamp", "type")
+EXPORT_MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+
+def _ndjson_batch(rows) -> bytes:
+    return "".join(
+        json.dumps(dict(zip(EXPORT_COLUMNS, (*row[:4], row[4].isoformat(), row[5]))), separators=(",", ":")) + "\n"
+        for row in rows
+    ).encode()
+
+
+def _csv_batch(rows, buffer: io.StringIO, writer) -> bytes:
+    buffer.seek(0)
+    buffer.truncate()
+    writer.writerows((*row[:4], row[4].isoformat(), row[5]) for row in rows)
+    return buffer.getvalue().encode()
+
+
+async def export_transactions(fmt: str, user_id: Optional[str] = None) -> AsyncIterator[bytes]:
+    # Runs after the handler has returned, so it owns its session
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == "csv":
+        writer.writerow(EXPORT_COLUMNS)
+        yield buffer.getvalue().encode()
+    if DB_SHARDS and user_id:
+        sessions = [shard_session(shard_for(user_id))]
+    else:
+        # With DB_SHARDS, one shard after another, each ordered by user
+        sessions = shard_sessions()
+    for session in sessions:
+        async with session:
+            async for rows in iter_transaction_batches(session, user_id):
+                if fmt == "csv":
+                    yield _csv_batch(rows, buffer, writer)
+                else:
+                    yield _ndjson_batch(rows)
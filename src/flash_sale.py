@@ -0,0 +1,123 @@
+'''
+hot-item purchase path for flash sales
+
+Stock for flagged items is counted in memory so sold-out buyers are turned
+away without touching the database. Accepted orders are queued to a single
+writer task (a BatchWriter) that commits them through apply_flash_sale_orders.
+The database stays the source of truth: each batch commits its stock
+decrements, debits and ledger rows atomically, and the counters are rebuilt
+from Item.stock_val on start-up, so a crash loses nothing that was
+confirmed to a buyer.
+
+Each worker keeps its own counters. When an item is enabled, disabled or
+restocked, the other workers hear of it on the cache bus and reload that
+item's counter from the database. Units sold by other workers aren't
+broadcast: a worker that overestimates the stock has the order refused by
+the database instead.
+'''
+
+import os
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+from src.database import DB_SHARDS, async_session
+from src.models import User, Item, Transaction
+from src.crud import apply_flash_sale_orders, list_flash_sale_items
+from src.group_commit import BatchWriter
+from src.metrics import wallet_operations
+from src import sharding
+
+FLASH_SALE_MAX_BATCH = int(os.getenv("FLASH_SALE_MAX_BATCH", "200"))
+FLASH_SALE_MAX_WAIT_MS = float(os.getenv("FLASH_SALE_MAX_WAIT_MS", "5"))
+
+
+class FlashSaleEngine(BatchWriter):
+    def __init__(self, max_batch: int = FLASH_SALE_MAX_BATCH, max_wait_ms: float = FLASH_SALE_MAX_WAIT_MS):
+        super().__init__(max_batch, max_wait_ms)
+        self.sold_out = 0
+        # item id -> units not yet reserved by a queued order
+        self._stock: Dict[str, int] = {}
+        # item id -> queued orders not yet committed
+        self._pending: Counter = Counter()
+
+    def is_active(self, item_id: str) -> bool:
+        return item_id in self._stock
+
+    def enable(self, item: Item) -> None:
+        self._stock[item.id] = item.stock_val - self._pending[item.id]
+
+    def disable(self, item_id: str) -> None:
+        self._stock.pop(item_id, None)
+
+    def restock(self, item_id: str, stock_val: int) -> None:
+        if item_id in self._stock:
+            self._stock[item_id] = stock_val - self._pending[item_id]
+
+    async def start(self) -> None:
+        async with async_session() as session:
+            for item in await list_flash_sale_items(session):
+                self.enable(item)
+        await super().start()
+
+    async def reload(self, item_ids: Optional[Iterable[str]] = None) -> None:
+        # Re-reads the counters of items another worker enabled, disabled or
+        # restocked (every item if item_ids is None) from the database
+        async with async_session() as session:
+            items = await list_flash_sale_items(session, item_ids)
+        stale = set(self._stock if item_ids is None else item_ids)
+        for item in items:
+            self.enable(item)
+            stale.discard(item.id)
+        for item_id in stale:
+            self.disable(item_id)
+
+    async def buy(self, user: User, item_id: str) -> Optional[Tuple[Item, Transaction]]:
+        if self._stock.get(item_id, 0) <= 0:
+            self.sold_out += 1
+            wallet_operations.inc(operation="flash_sale_purchase", outcome="sold_out")
+            return None
+        self._stock[item_id] -= 1
+        self._pending[item_id] += 1
+        return await self.submit((user, item_id))
+
+    async def _write(self, orders: List[Tuple[User, str]]) -> List[Union[None, Tuple[Item, Transaction], Exception]]:
+        try:
+            async with async_session() as session:
+                if DB_SHARDS:
+                    results, outcomes = await sharding.purchase(session, orders, operation="flash_sale_purchase")
+                else:
+                    results, outcomes = await apply_flash_sale_orders(session, orders)
+        except Exception:
+            for _, item_id in orders:
+                self._settle(item_id, "error")
+            raise
+        for (_, item_id), outcome in zip(orders, outcomes):
+            self._settle(item_id, outcome)
+        return results
+
+    def _settle(self, item_id: str, outcome: str) -> None:
+        self._pending[item_id] -= 1
+        if not self._pending[item_id]:
+            del self._pending[item_id]
+        if outcome == "ok" or item_id not in self._stock:
+            return
+        if outcome == "out_of_stock":
+            # The database is sold out (other workers sold the rest): stop
+            # queueing orders for it until a restock says otherwise
+            self._stock[item_id] = 0
+        else:
+            # Give the reservation back (insufficient funds, or a failed or
+            # unconfirmed write; if that one did sell, the database refuses
+            # a later order and the counter drops to 0 then)
+            self._stock[item_id] += 1
+
+    def stats(self) -> dict:
+        return {
+            **super().stats(),
+            "items": dict(self._stock),
+            "pending": sum(self._pending.values()),
+            "sold_out": self.sold_out,
+        }
+
+
+flash_sale = FlashSaleEngine()
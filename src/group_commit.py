@@ -0,0 +1,185 @@
+'''
+micro-batching writers: callers queue work, one task commits it in batches
+
+SQLite (and any fsync-bound database) pays per commit, not per statement, so
+coalescing concurrent writes into one transaction raises write throughput.
+'''
+
+import asyncio
+import logging
+import os
+import time
+from collections import defaultdict
+from typing import Any, List, Optional, Tuple, Union
+
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from src import profiler
+from src.database import DB_SHARDS, async_session, env_bool, shard_for, shard_session
+from src.models import User, Transaction
+from src.crud import apply_wallet_operations, spend_money, top_up_wallet
+from src.sharding import write_outcome_unknown
+
+logger = logging.getLogger(__name__)
+
+GROUP_COMMIT_ENABLED = env_bool("GROUP_COMMIT_ENABLED", False)
+GROUP_COMMIT_MAX_BATCH = int(os.getenv("GROUP_COMMIT_MAX_BATCH", "100"))
+GROUP_COMMIT_MAX_WAIT_MS = float(os.getenv("GROUP_COMMIT_MAX_WAIT_MS", "2"))
+
+
+class BatchWriter:
+    """Coalesces submitted items and hands each batch to ``_write``.
+
+    ``_write`` returns one result per item; raising fails the whole batch.
+    An exception returned as an item's result is raised to that item's
+    caller alone. The batch's statements are profiled for every request
+    that submitted to it.
+    """
+
+    def __init__(self, max_batch: int, max_wait_ms: float):
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.batches = 0
+        self.items = 0
+        self.failed_batches = 0
+        self.max_batch_seen = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seen = 0.0
+        self._queue: Optional[asyncio.Queue] = None
+        self._writer: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._writer is not None
+
+    async def start(self) -> None:
+        self._queue = asyncio.Queue()
+        self._writer = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._writer is None:
+            return
+        # Let queued work commit before shutting the writer down
+        await self._queue.join()
+        self._writer.cancel()
+        try:
+            await self._writer
+        except asyncio.CancelledError:
+            pass
+        self._writer = None
+
+    async def submit(self, item: Any) -> Any:
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((item, future, time.perf_counter(), profiler.current()))
+        return await future
+
+    async def _write(self, items: List[Any]) -> List[Any]:
+        raise NotImplementedError
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            if self.max_wait:
+                await asyncio.sleep(self.max_wait)
+            while len(batch) < self.max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                await self._flush(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _flush(self, batch: List[Tuple[Any, asyncio.Future, float, Optional[profiler.RequestProfile]]]) -> None:
+        waited = time.perf_counter() - batch[0][2]
+        self.batches += 1
+        self.items += len(batch)
+        self.max_batch_seen = max(self.max_batch_seen, len(batch))
+        self.wait_seconds += waited
+        self.max_wait_seen = max(self.max_wait_seen, waited)
+        try:
+            with profiler.shared(profile for _, _, _, profile in batch):
+                results = await self._write([item for item, _, _, _ in batch])
+        except Exception as e:
+            self.failed_batches += 1
+            logger.error("%s batch of %d failed: %s", type(self).__name__, len(batch), e, exc_info=True)
+            for _, future, _, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future, _, _), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        return {
+            "max_batch": self.max_batch,
+            "max_wait_ms": self.max_wait * 1000,
+            "batches": self.batches,
+            "items": self.items,
+            "failed_batches": self.failed_batches,
+            "avg_batch_size": self.items / self.batches if self.batches else 0.0,
+            "max_batch_size": self.max_batch_seen,
+            "avg_wait_ms": self.wait_seconds * 1000 / self.batches if self.batches else 0.0,
+            "max_wait_ms_seen": self.max_wait_seen * 1000,
+        }
+
+
+class WalletWriter(BatchWriter):
+    # Top-ups and spends; transfers and purchases keep their own transaction
+
+    def __init__(self, enabled: bool = GROUP_COMMIT_ENABLED,
+                 max_batch: int = GROUP_COMMIT_MAX_BATCH, max_wait_ms: float = GROUP_COMMIT_MAX_WAIT_MS):
+        super().__init__(max_batch, max_wait_ms)
+        self.enabled = enabled
+
+    async def start(self) -> None:
+        if self.enabled:
+            await super().start()
+
+    async def _write(self, items: List[Tuple[str, User, float]]) -> List[Union[None, Tuple[float, Transaction], Exception]]:
+        if not DB_SHARDS:
+            async with async_session() as session:
+                return await apply_wallet_operations(session, items)
+        # One transaction per shard, committed concurrently. A shard that
+        # fails only fails its own operations, whose callers get a 503: the
+        # commit may have gone through before the error.
+        by_shard = defaultdict(list)
+        for index, (_, user, _) in enumerate(items):
+            by_shard[shard_for(user.id)].append(index)
+        results: List[Union[None, Tuple[float, Transaction], Exception]] = [None] * len(items)
+
+        async def write(shard: int, indexes: List[int]) -> None:
+            async with shard_session(shard) as session:
+                shard_results = await apply_wallet_operations(session, [items[index] for index in indexes])
+            for index, result in zip(indexes, shard_results):
+                results[index] = result
+
+        shards = list(by_shard)
+        failures = await asyncio.gather(*(write(shard, by_shard[shard]) for shard in shards), return_exceptions=True)
+        for shard, failure in zip(shards, failures):
+            if isinstance(failure, Exception):
+                self.failed_batches += 1
+                logger.error("Wallet batch on shard %d failed: %s", shard, failure)
+                for index in by_shard[shard]:
+                    results[index] = write_outcome_unknown()
+        return results
+
+    async def _apply(self, session: AsyncSession, kind: str, user: User, amount: float) -> Tuple[Optional[float], Optional[Transaction]]:
+        if self.running:
+            return await self.submit((kind, user, amount)) or (None, None)
+        operation = spend_money if kind == "spend" else top_up_wallet
+        updated, transaction = await operation(session, user, amount)
+        return (updated.balance if updated else None), transaction
+
+    async def spend(self, session: AsyncSession, user: User, amount: float) -> Tuple[Optional[float], Optional[Transaction]]:
+        return await self._apply(session, "spend", user, amount)
+
+    async def top_up(self, session: AsyncSession, user: User, amount: float) -> Tuple[Optional[float], Optional[Transaction]]:
+        return await self._apply(session, "top_up", user, amount)
+
+
+wallet_writer = WalletWriter()
@@ -0,0 +1,91 @@
+'''
+bcrypt hashing and verification off the event loop
+
+bcrypt is deliberately CPU-bound and holds the GIL, so calls are sent to a
+process pool. Kept free of app imports so spawned workers start quickly.
+Being spawned, the workers re-import the __main__ module, so scripts that
+drive the app need an `if __name__ == "__main__":` guard.
+'''
+
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+from typing import Optional
+
+from src.metrics import Timer, password_hash_duration, password_hash_rejected
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# 0 runs hashing on a thread pool instead of worker processes
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", str(os.cpu_count() or 1)))
+# Hash/verify calls allowed to wait for a worker before new ones are refused
+HASH_MAX_PENDING = int(os.getenv("HASH_MAX_PENDING", "256"))
+
+@lru_cache(maxsize=None)
+def pwd_context():
+    # Built on first use: passlib and its bcrypt backend are slow to load,
+    # and a new worker shouldn't pay for them before its first login
+    from passlib.context import CryptContext
+    return CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+
+def hash_password(password: str) -> str:
+    return pwd_context().hash(password)
+
+
+def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return pwd_context().verify(plain_password, hashed_password)
+
+
+class HashQueueFull(Exception):
+    pass
+
+
+class PasswordHasher:
+    def __init__(self, workers: int = HASH_WORKERS, max_pending: int = HASH_MAX_PENDING):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.rejected = 0
+        self._executor: Optional[Executor] = None
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.workers > 0:
+                # spawn, not fork: by the first login the app is running
+                # threads (log writer, aiosqlite) whose locks a forked child
+                # could inherit held
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            else:
+                self._executor = ThreadPoolExecutor(thread_name_prefix="bcrypt")
+        return self._executor
+
+    async def _submit(self, operation: str, fn, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            password_hash_rejected.inc()
+            raise HashQueueFull(f"{self.pending} password operations already queued")
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            with Timer(password_hash_duration, operation=operation):
+                return await loop.run_in_executor(self._get_executor(), fn, *args)
+        finally:
+            self.pending -= 1
+
+    async def hash(self, password: str) -> str:
+        return await self._submit("hash", hash_password, password)
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self._submit("verify", verify_password, plain_password, hashed_password)
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+password_hasher = PasswordHasher()
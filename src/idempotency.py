@@ -0,0 +1,217 @@
+'''
+Idempotency-Key support for retried POSTs
+
+The first request with a key claims it with a row in the idempotencyrecord
+table and its response is stored there, so retries (from any worker, and
+after a restart) are answered from the stored response instead of repeating
+the wallet operation. Concurrent duplicates in the same process wait on the
+first execution; duplicates in other processes poll the claimed row. A claim
+whose worker died before answering is taken over by the first retry after
+IDEMPOTENCY_CLAIM_TIMEOUT.
+'''
+
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from typing import Dict, Iterable, Optional, Tuple
+
+from src.auth import bearer_subject
+from src.cache import TTLCache
+from src.database import async_session
+from src.crud import (
+    claim_idempotency_key, get_idempotency_record, complete_idempotency_key,
+    release_idempotency_key, purge_expired_idempotency_records
+)
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", str(24 * 3600)))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000"))
+# How long a duplicate waits for another worker to finish the first request
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", "10"))
+# How long a claim may go unanswered before a retry takes it over; longer
+# than any request should run
+IDEMPOTENCY_CLAIM_TIMEOUT = float(os.getenv("IDEMPOTENCY_CLAIM_TIMEOUT", "60"))
+IDEMPOTENCY_PURGE_INTERVAL = 300
+
+# (fingerprint, status_code, content_type, body)
+StoredResponse = Tuple[str, int, Optional[str], bytes]
+
+# Responses worth replaying; auth failures, throttling and server errors are
+# left uncached so the retry is actually attempted again
+_NOT_STORED = {401, 403, 409, 429}
+
+
+class IdempotencyStore:
+    def __init__(self, ttl: float = IDEMPOTENCY_TTL, maxsize: int = IDEMPOTENCY_CACHE_SIZE,
+                 claim_timeout: float = IDEMPOTENCY_CLAIM_TIMEOUT):
+        self.ttl = ttl
+        self.claim_timeout = claim_timeout
+        self.replayed = 0
+        self.completed = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._last_purge = 0.0
+
+    async def _maybe_purge(self, session) -> None:
+        if time.monotonic() - self._last_purge > IDEMPOTENCY_PURGE_INTERVAL:
+            self._last_purge = time.monotonic()
+            await purge_expired_idempotency_records(session, self.ttl)
+
+    async def begin(self, key: str, fingerprint: str) -> Optional[StoredResponse]:
+        """Claim ``key``; returns a stored response instead if there is one."""
+        while True:
+            stored = self.completed.get(key)
+            if stored is not None:
+                return stored
+            inflight = self._inflight.get(key)
+            if inflight is None:
+                break
+            stored = await asyncio.shield(inflight)
+            if stored is not None:
+                return stored
+            # The first attempt failed and released the key. Claim it again:
+            # the first waiter to wake finds no future and becomes the owner,
+            # the rest wait on its future instead
+
+        self._inflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            async with async_session() as session:
+                await self._maybe_purge(session)
+                record = await claim_idempotency_key(session, key, fingerprint, self.claim_timeout)
+                deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+                # Claimed by another worker: wait for it to store its response
+                while record is not None and record.status_code is None and time.monotonic() < deadline:
+                    await asyncio.sleep(0.05)
+                    record = await get_idempotency_record(session, key)
+                    if record is None:
+                        # The first attempt failed and released the key
+                        record = await claim_idempotency_key(session, key, fingerprint, self.claim_timeout)
+        except BaseException:
+            self._finish(key, None)
+            raise
+
+        if record is None:
+            # Ours to execute; end() settles the in-flight future
+            return None
+        if record.status_code is None:
+            stored = (record.fingerprint, 409, "application/json",
+                      b'{"detail":"A request with this Idempotency-Key is still being processed"}')
+        else:
+            stored = (record.fingerprint, record.status_code, record.content_type, record.body or b"")
+            self.completed.set(key, stored)
+        self._finish(key, stored)
+        return stored
+
+    async def end(self, key: str, fingerprint: str, status_code: int, content_type: Optional[str], body: bytes) -> None:
+        stored: Optional[StoredResponse] = None
+        try:
+            async with async_session() as session:
+                if 200 <= status_code < 500 and status_code not in _NOT_STORED:
+                    stored = (fingerprint, status_code, content_type, body)
+                    await complete_idempotency_key(session, key, status_code, content_type, body)
+                    self.completed.set(key, stored)
+                else:
+                    await release_idempotency_key(session, key)
+        finally:
+            self._finish(key, stored)
+
+    async def abort(self, key: str) -> None:
+        try:
+            async with async_session() as session:
+                await release_idempotency_key(session, key)
+        finally:
+            self._finish(key, None)
+
+    def _finish(self, key: str, stored: Optional[StoredResponse]) -> None:
+        future = self._inflight.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(stored)
+
+    def stats(self) -> dict:
+        return {**self.completed.stats(), "in_flight": len(self._inflight), "replayed": self.replayed}
+
+
+idempotency_store = IdempotencyStore()
+
+
+class IdempotencyMiddleware:
+    # Plain ASGI middleware so the response body can be captured while it streams
+
+    def __init__(self, app, paths: Iterable[str] = (), prefixes: Iterable[str] = ()):
+        self.app = app
+        self.paths = frozenset(paths)
+        self.prefixes = tuple(prefixes)
+
+    def _applies(self, scope) -> bool:
+        if scope["type"] != "http" or scope["method"] != "POST":
+            return False
+        path = scope["path"]
+        return path in self.paths or path.startswith(self.prefixes)
+
+    async def __call__(self, scope, receive, send):
+        if not self._applies(scope):
+            return await self.app(scope, receive, send)
+        headers = dict(scope["headers"])
+        idempotency_key = headers.get(b"idempotency-key")
+        # Keys are scoped to the user, not the token, so a retry made after
+        # refreshing the access token still finds the first attempt. Without
+        # a valid token the route answers 401 and there is nothing to dedup
+        user = bearer_subject(headers.get(b"authorization", b"").decode("latin-1"))
+        if not idempotency_key or user is None:
+            return await self.app(scope, receive, send)
+
+        # Buffer the (small) request body so it can be fingerprinted and replayed
+        chunks = []
+        while True:
+            message = await receive()
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+        body = b"".join(chunks)
+
+        key = hashlib.sha256(b"\0".join((
+            user.encode(), scope["method"].encode(), scope["path"].encode(), idempotency_key
+        ))).hexdigest()
+        fingerprint = hashlib.sha256(body).hexdigest()
+
+        stored = await idempotency_store.begin(key, fingerprint)
+        if stored is not None:
+            return await self._replay(stored, fingerprint, send)
+
+        async def replay_receive():
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        status_code = 500
+        content_type = None
+        response_body = []
+
+        async def capture_send(message):
+            nonlocal status_code, content_type
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                content_type = dict(message.get("headers", [])).get(b"content-type", b"").decode() or None
+            elif message["type"] == "http.response.body":
+                response_body.append(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, replay_receive, capture_send)
+        except BaseException:
+            await idempotency_store.abort(key)
+            raise
+        await idempotency_store.end(key, fingerprint, status_code, content_type, b"".join(response_body))
+
+    async def _replay(self, stored: StoredResponse, fingerprint: str, send) -> None:
+        stored_fingerprint, status_code, content_type, body = stored
+        if stored_fingerprint != fingerprint:
+            status_code, content_type = 422, "application/json"
+            body = b'{"detail":"Idempotency-Key was already used with a different request body"}'
+        else:
+            idempotency_store.replayed += 1
+        headers = [(b"content-length", str(len(body)).encode()), (b"idempotent-replayed", b"true")]
+        if content_type:
+            headers.append((b"content-type", content_type.encode()))
+        await send({"type": "http.response.start", "status": status_code, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
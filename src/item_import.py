@@ -0,0 +1,152 @@
+'''
+bulk item import from a streamed CSV / NDJSON request body
+
+The body is read chunk by chunk, rows are validated against
+ItemImportSchema as they arrive, and valid rows are written in batches of
+IMPORT_BATCH_SIZE (one executemany and one commit each). A batch the
+database rejects is retried in halves until the rows it refuses (say, a
+duplicate id) are isolated, so only those are lost: k bad rows cost about
+k * log2(IMPORT_BATCH_SIZE) extra statements. Invalid and refused rows are
+reported back by line number.
+'''
+
+import csv
+import json
+import os
+import uuid
+from typing import AsyncIterator, List, Optional, Tuple
+
+from pydantic import ValidationError
+from sqlalchemy.exc import SQLAlchemyError
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from src.models import Item
+from src.schema import ItemImportSchema
+from src.crud import bulk_import_items, _flash_sale_changed
+
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "5000"))
+# Errors listed in the report; the failed count is always exact
+IMPORT_MAX_ERRORS = 1000
+
+
+async def _lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, bytes]]:
+    # Split on bytes so multi-byte characters cut across chunks survive
+    buffered = b""
+    number = 0
+    async for chunk in chunks:
+        buffered += chunk
+        *complete, buffered = buffered.split(b"\n")
+        for line in complete:
+            number += 1
+            yield number, line
+    if buffered:
+        yield number + 1, buffered
+
+
+def _csv_row(header: List[str], line: str) -> dict:
+    values = next(csv.reader([line]))
+    if len(values) != len(header):
+        raise ValueError(f"expected {len(header)} columns, got {len(values)}")
+    # Empty cells fall back to the schema defaults
+    return {key: value for key, value in zip(header, values) if value != ""}
+
+
+def _error_messages(error: Exception) -> List[str]:
+    if isinstance(error, ValidationError):
+        return [
+            f"{'.'.join(str(part) for part in detail['loc']) or 'row'}: {detail['msg']}"
+            for detail in error.errors(include_url=False)
+        ]
+    return [str(error)]
+
+
+class ImportReport:
+    def __init__(self):
+        self.imported = 0
+        self.failed = 0
+        self.errors: List[dict] = []
+
+    def fail(self, line: int, messages: List[str]) -> None:
+        self.failed += 1
+        if len(self.errors) < IMPORT_MAX_ERRORS:
+            self.errors.append({"line": line, "errors": messages})
+
+    def as_dict(self) -> dict:
+        return {
+            "imported": self.imported,
+            "failed": self.failed,
+            "errors": sorted(self.errors, key=lambda error: error["line"]),
+            "errors_truncated": self.failed > len(self.errors),
+        }
+
+
+async def _flush(session: AsyncSession, batch: List[Tuple[int, dict]], upsert: bool, report: ImportReport) -> None:
+    if not batch:
+        return
+    await _write(session, list(batch), upsert, report)
+    batch.clear()
+
+
+async def _write(session: AsyncSession, batch: List[Tuple[int, dict]], upsert: bool, report: ImportReport) -> None:
+    rows = [row for _, row in batch]
+    try:
+        await bulk_import_items(session, rows, upsert=upsert)
+    except SQLAlchemyError as e:
+        if len(batch) == 1:
+            report.fail(batch[0][0], [f"rejected by the database: {type(e).__name__}: {str(e).splitlines()[0]}"])
+            return
+        # Rolled back as a whole; retry each half so the good rows get in
+        middle = len(batch) // 2
+        await _write(session, batch[:middle], upsert, report)
+        await _write(session, batch[middle:], upsert, report)
+    else:
+        report.imported += len(rows)
+        _sync_flash_sale(rows)
+
+
+def _sync_flash_sale(rows: List[dict]) -> None:
+    # Local import to avoid circular import issues
+    from src.flash_sale import flash_sale
+    for row in rows:
+        if row["flash_sale"]:
+            flash_sale.enable(Item(**row))
+        elif flash_sale.is_active(row["id"]):
+            flash_sale.disable(row["id"])
+        else:
+            continue
+        _flash_sale_changed(row["id"])
+
+
+async def import_items(session: AsyncSession, fmt: str, chunks: AsyncIterator[bytes], upsert: bool = False) -> dict:
+    report = ImportReport()
+    batch: List[Tuple[int, dict]] = []
+    header: Optional[List[str]] = None
+
+    async for number, raw_line in _lines(chunks):
+        if not raw_line.strip():
+            continue
+        try:
+            line = raw_line.decode("utf-8-sig" if number == 1 else "utf-8").rstrip("\r")
+            if fmt == "csv":
+                if header is None:
+                    header = [column.strip() for column in next(csv.reader([line]))]
+                    continue
+                raw = _csv_row(header, line)
+            else:
+                raw = json.loads(line)
+                if not isinstance(raw, dict):
+                    raise ValueError("expected a JSON object")
+            item = ItemImportSchema.model_validate(raw)
+        except (ValueError, ValidationError) as e:
+            report.fail(number, _error_messages(e))
+            continue
+        row = item.model_dump()
+        if row["id"] is None:
+            row["id"] = str(uuid.uuid4())
+        row["owner_id"] = None
+        batch.append((number, row))
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            await _flush(session, batch, upsert, report)
+
+    await _flush(session, batch, upsert, report)
+    return report.as_dict()
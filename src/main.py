@@ -1,16 +1,30 @@
-from fastapi import FastAPI, Depends, HTTPException, status
-from typing import List 
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, Response, status
+from fastapi.responses import StreamingResponse
+from typing import List, Optional
+from datetime import datetime
 from contextlib import asynccontextmanager
 import logging
+from src.logging_config import setup_logging, RequestIdMiddleware
 
-logging.basicConfig(level=logging.DEBUG)
+setup_logging()
 logger = logging.getLogger(__name__)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     from src.database import init_db
+    from src.hashing import password_hasher
+    from src.flash_sale import flash_sale
     init_db()
+    await flash_sale.start()
+    await wallet_writer.start()
+    await sharding.shard_recovery.start()
+    await cache_bus.start()
     yield
+    await cache_bus.stop()
+    await sharding.shard_recovery.stop()
+    await wallet_writer.stop()
+    await flash_sale.stop()
+    password_hasher.shutdown()
 
 app = FastAPI(
     title="E-Commerce API",
@@ -21,26 +35,104 @@ app = FastAPI(
 
 # Import your modules AFTER lifespan defined
 from src.models import User, Transaction
+from src.database import DB_SHARDS, get_async_session, user_session
+from sqlmodel.ext.asyncio.session import AsyncSession
 from src.schema import (
     UserCreateSchema, UserLoginSchema, UserSchema,
     SpendMoneySchema, ItemCreateSchema, ItemSchema,
-    TransferMoneySchema, TopUpWalletSchema, TransactionSchema
+    TransferMoneySchema, TopUpWalletSchema, TransactionSchema,
+    RefreshTokenSchema, FlashSaleSchema
 )
 from src.crud import (
-    create_user, get_user_by_username, list_items, spend_money,
-    buy_item, add_item, top_up_wallet, transfer_money,
-    get_user_transactions, get_item_by_id
+    create_user, get_user_by_username, list_items,
+    buy_item, add_item, transfer_money,
+    get_user_transaction_rows, list_user_rows, store_refresh_token,
+    rotate_refresh_token, revoke_refresh_token, TRANSACTION_PAGE_SIZE,
+    TRANSACTION_PAGE_MAX, set_item_flash_sale, search_items,
+    ITEM_SEARCH_PAGE_SIZE, ITEM_SEARCH_PAGE_MAX
 )
+from src.pagination import encode_cursor, decode_cursor, SCALAR
+from src.cache import catalog_cache
+from src.cache_bus import cache_bus
+from src.flash_sale import flash_sale
+from src.group_commit import wallet_writer
+from src.idempotency import IdempotencyMiddleware, idempotency_store
+from src.responses import FastJSONResponse, user_payload, transaction_payload
+from src.metrics import MetricsMiddleware, registry, pool_gauges, stats_gauges
+from src import profiler, sharding, admission
+from src.admission import AdmissionMiddleware, RouteLimits, RateLimit
 from src.auth import (
-    verify_password, create_access_token, get_current_user,
-    get_current_admin_user
+    verify_password_async, create_access_token, get_current_user,
+    get_current_admin_user, get_user_session, create_refresh_token, decode_refresh_token
 )
 
+# Retried wallet POSTs carrying an Idempotency-Key are answered once
+app.add_middleware(
+    IdempotencyMiddleware,
+    paths=["/wallet/top-up", "/wallet/spend", "/wallet/transfer"],
+    prefixes=["/items/buy/"]
+)
+if profiler.QUERY_PROFILER_ENABLED:
+    from src.database import async_engine, shard_async_engines
+    for profiled_engine in (async_engine, *shard_async_engines):
+        profiler.instrument_engine(profiled_engine.sync_engine)
+    app.add_middleware(profiler.QueryProfilerMiddleware)
+# Per-route admission control, on with RATE_LIMIT_ENABLED. Rates are per
+# second per process; bcrypt routes are throttled per IP, wallet writes per
+# user, and both get a cap on requests in flight with a short queue.
+_wallet_write_limits = RouteLimits(per_user=RateLimit(rate=10, burst=20), max_concurrent=64, max_queued=256)
+ADMISSION_LIMITS = {
+    "/auth/login": RouteLimits(per_ip=RateLimit(rate=5, burst=20), max_concurrent=32, max_queued=64),
+    "/auth/register": RouteLimits(per_ip=RateLimit(rate=1, burst=5), max_concurrent=16, max_queued=32),
+    "/auth/refresh": RouteLimits(per_ip=RateLimit(rate=10, burst=30)),
+    "/wallet/top-up": _wallet_write_limits,
+    "/wallet/spend": _wallet_write_limits,
+    "/wallet/transfer": _wallet_write_limits,
+    "/items/buy/": RouteLimits(per_user=RateLimit(rate=5, burst=10), max_concurrent=128, max_queued=512),
+    "/admin/items/import": RouteLimits(max_concurrent=2, max_queued=4, queue_timeout=30),
+}
+# Outside idempotency, so shed requests never claim a key
+app.add_middleware(AdmissionMiddleware, routes=ADMISSION_LIMITS)
+# Outside the idempotency middleware, so replays are counted too
+app.add_middleware(MetricsMiddleware)
+# Wraps everything so every log line of a request carries its id
+app.add_middleware(RequestIdMiddleware)
+
+@registry.collector
+def _runtime_metrics():
+    from src.database import engine, async_engine, shard_async_engines
+    from src.cache import user_cache
+    from src.hashing import password_hasher
+    shard_pools = {f"shard{shard}": shard_engine for shard, shard_engine in enumerate(shard_async_engines)}
+    return [
+        *pool_gauges({"sync": engine, "async": async_engine, **shard_pools}),
+        *stats_gauges("cache", "In-process cache", {
+            "users": user_cache.stats(),
+            "catalog": catalog_cache.stats(),
+            "idempotency": idempotency_store.stats(),
+        }, label="cache"),
+        *stats_gauges("cache_bus", "Cross-worker cache invalidation", {"default": cache_bus.stats()}, label="bus"),
+        *stats_gauges("batch_writer", "Group-commit writer", {
+            "wallet": wallet_writer.stats(),
+            "flash_sale": flash_sale.stats(),
+        }, label="writer"),
+        *stats_gauges("admission", "Admission control", {
+            route: limiter.stats() for route, limiter in admission.admission_limiters.items()
+        }, label="route"),
+        *stats_gauges("password_hasher", "bcrypt worker pool", {
+            "default": {"pending": password_hasher.pending, "rejected": password_hasher.rejected},
+        }, label="hasher"),
+    ]
+
 # auth endpoint
 @app.post("/auth/register", response_model=UserSchema, status_code=status.HTTP_201_CREATED)
-def register(user: UserCreateSchema):
+async def register(
+    user: UserCreateSchema,
+    session: AsyncSession = Depends(get_async_session)
+):
     try:
-        user_data = create_user(
+        user_data = await (sharding.create_user if DB_SHARDS else create_user)(
+            session,
             username=user.username,
             password=user.password,
             role=user.role or "user"
@@ -49,16 +141,19 @@ def register(user: UserCreateSchema):
     except HTTPException as e:
         raise e
     except Exception as e:
-        logger.error(f"Registration failed: {str(e)}", exc_info=True)
+        logger.error("Registration failed: %s", e, exc_info=True)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Failed to create user"
         )
 
 @app.post("/auth/login")
-def login(user: UserLoginSchema):
-    db_user = get_user_by_username(user.username)
-    if not db_user or not verify_password(user.password, db_user.hashed_password):
+async def login(
+    user: UserLoginSchema,
+    session: AsyncSession = Depends(get_async_session)
+):
+    db_user = await (sharding.get_user_by_username if DB_SHARDS else get_user_by_username)(session, user.username)
+    if not db_user or not await verify_password_async(user.password, db_user.hashed_password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid credentials"
@@ -66,65 +161,97 @@ def login(user: UserLoginSchema):
     access_token = create_access_token(
         data={"sub": db_user.username, "is_admin": db_user.is_admin}
     )
-    return {"access_token": access_token, "token_type": "bearer"}
+    refresh_token, jti, expires_at = create_refresh_token(
+        data={"sub": db_user.username, "uid": db_user.id, "is_admin": db_user.is_admin}
+    )
+    async with user_session(session, db_user.id) as user_db:
+        await store_refresh_token(user_db, jti, db_user.id, expires_at)
+    return {"access_token": access_token, "refresh_token": refresh_token, "token_type": "bearer"}
+
+@app.post("/auth/refresh")
+async def refresh(
+    request: RefreshTokenSchema,
+    session: AsyncSession = Depends(get_async_session)
+):
+    # Signature check plus one indexed DELETE/INSERT; no password hashing
+    payload = decode_refresh_token(request.refresh_token)
+    claims = {"sub": payload["sub"], "is_admin": payload.get("is_admin", False)}
+    refresh_token, jti, expires_at = create_refresh_token(
+        data={**claims, "uid": payload["uid"]}
+    )
+    async with user_session(session, payload["uid"]) as user_db:
+        rotated = await rotate_refresh_token(user_db, payload["jti"], jti, expires_at)
+    if not rotated:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Refresh token expired or revoked",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    access_token = create_access_token(data=claims)
+    return {"access_token": access_token, "refresh_token": refresh_token, "token_type": "bearer"}
+
+@app.post("/auth/logout")
+async def logout(
+    request: RefreshTokenSchema,
+    session: AsyncSession = Depends(get_async_session)
+):
+    payload = decode_refresh_token(request.refresh_token)
+    async with user_session(session, payload["uid"]) as user_db:
+        await revoke_refresh_token(user_db, payload["jti"])
+    return {"message": "Logged out"}
 
 # user endpoint
 @app.get("/users/me", response_model=UserSchema)
-def read_users_me(current_user: User = Depends(get_current_user)):
-    return UserSchema(
-        id=current_user.id,
-        username=current_user.username,
-        wallet_bal=current_user.balance,
-        role="admin" if current_user.is_admin else "user"
-    )
+async def read_users_me(current_user: User = Depends(get_current_user)):
+    return FastJSONResponse(user_payload(
+        current_user.id, current_user.username, current_user.balance, current_user.is_admin
+    ))
 
 @app.get("/wallet/balance", response_model=float)
-def get_balance(current_user: User = Depends(get_current_user)):
+async def get_balance(current_user: User = Depends(get_current_user)):
     return current_user.balance
 
 @app.post("/wallet/top-up", response_model=UserSchema)
-def top_up_wallet_endpoint(
+async def top_up_wallet_endpoint(
     request: TopUpWalletSchema,
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_user),
+    session: AsyncSession = Depends(get_user_session)
 ):
-    user, transaction = top_up_wallet(current_user.id, request.amount)
-    if not user:
+    balance, transaction = await wallet_writer.top_up(session, current_user, request.amount)
+    if not transaction:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Failed to top up wallet"
         )
-    return UserSchema(
-        id=user.id,
-        username=user.username,
-        wallet_bal=user.balance,
-        role="admin" if user.is_admin else "user"
-    )
+    return FastJSONResponse(user_payload(
+        current_user.id, current_user.username, balance, current_user.is_admin
+    ))
 
 @app.post("/wallet/spend", response_model=UserSchema)
-def spend_endpoint(
+async def spend_endpoint(
     request: SpendMoneySchema,
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_user),
+    session: AsyncSession = Depends(get_user_session)
 ):
-    user, transaction = spend_money(current_user.id, request.amount)
-    if not user:
+    balance, transaction = await wallet_writer.spend(session, current_user, request.amount)
+    if not transaction:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Insufficient funds"
         )
-    return UserSchema(
-        id=user.id,
-        username=user.username,
-        wallet_bal=user.balance,
-        role="admin" if user.is_admin else "user"
-    )
+    return FastJSONResponse(user_payload(
+        current_user.id, current_user.username, balance, current_user.is_admin
+    ))
 
 @app.post("/wallet/transfer", response_model=dict)
-def transfer_money_endpoint(
+async def transfer_money_endpoint(
     request: TransferMoneySchema,
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_user),
+    session: AsyncSession = Depends(get_async_session)
 ):
-    sender, recipient, transaction = transfer_money(
-        current_user.id,
+    sender, recipient, transaction = await (sharding.transfer_money if DB_SHARDS else transfer_money)(
+        session,
+        current_user,
         request.recipient_username,
         request.amount
     )
@@ -140,99 +267,186 @@ def transfer_money_endpoint(
     }
 
 @app.get("/transactions", response_model=List[TransactionSchema])
-def get_transactions(current_user: User = Depends(get_current_user)):
-    transactions = get_user_transactions(current_user.id)
-    transaction_schemas = []
-    for transaction in transactions:
-        # Handle the Optional user_id field
-        user_id_str = str(transaction.user_id) if transaction.user_id else ""
-        transaction_schemas.append(
-            TransactionSchema(
-                id=transaction.id,
-                user_id=user_id_str,
-                product_id=transaction.product_id,
-                amount=transaction.amount,
-                timestamp=transaction.timestamp,
-                type=transaction.transaction_type
+async def get_transactions(
+    limit: int = Query(TRANSACTION_PAGE_SIZE, ge=1, le=TRANSACTION_PAGE_MAX),
+    cursor: Optional[str] = None,
+    transaction_type: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    current_user: User = Depends(get_current_user),
+    session: AsyncSession = Depends(get_user_session)
+):
+    after = None
+    if cursor:
+        try:
+            timestamp, transaction_id = decode_cursor(cursor, str, str)
+            after = (datetime.fromisoformat(timestamp), transaction_id)
+        except (ValueError, TypeError):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Invalid cursor"
             )
-        )
-    return transaction_schemas
+    rows = await get_user_transaction_rows(
+        session,
+        current_user.id,
+        limit=limit,
+        after=after,
+        transaction_type=transaction_type,
+        since=since,
+        until=until
+    )
+    # A full page means there may be more; the client passes this back as ?cursor=
+    headers = {}
+    if len(rows) == limit:
+        last_id, _, _, _, last_timestamp, _ = rows[-1]
+        headers["X-Next-Cursor"] = encode_cursor(last_timestamp, last_id)
+    return FastJSONResponse([transaction_payload(*row) for row in rows], headers=headers)
+
+def _export_response(fmt: str, user_id: Optional[str] = None) -> StreamingResponse:
+    # Imported on first use: exports and imports are rare admin/report
+    # paths a fresh worker shouldn't pay for at startup
+    from src.export import export_transactions, EXPORT_MEDIA_TYPES
+    return StreamingResponse(
+        export_transactions(fmt, user_id),
+        media_type=EXPORT_MEDIA_TYPES[fmt],
+        headers={"Content-Disposition": f'attachment; filename="transactions.{fmt}"'}
+    )
+
+@app.get("/transactions/export")
+async def export_my_transactions(
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    current_user: User = Depends(get_current_user)
+):
+    return _export_response(format, current_user.id)
+
+async def _catalog(session: AsyncSession):
+    snapshot = catalog_cache.get()
+    if snapshot is None:
+        version = catalog_cache.version
+        items = await list_items(session)
+        snapshot = catalog_cache.store(version, [
+            ItemSchema(
+                id=item.id,
+                name=item.name,
+                price=item.price,
+                stock_val=item.stock_val
+            ).model_dump(mode="json") for item in items
+        ])
+    return snapshot
+
+def _json_with_etag(request: Request, body: bytes, etag: str) -> Response:
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match.strip() == "*" or etag in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    return Response(
+        content=body,
+        media_type="application/json",
+        headers={"ETag": etag, "Cache-Control": "no-cache"}
+    )
 
 # Item Endpoints
 @app.get("/items", response_model=List[ItemSchema])
-def get_items():
-    items = list_items()
-    return [
-        ItemSchema(
-            id=item.id,
-            name=item.name,
-            price=item.price,
-            stock_val=item.stock_val
-        ) for item in items
-    ]
+async def get_items(request: Request, session: AsyncSession = Depends(get_async_session)):
+    snapshot = await _catalog(session)
+    return _json_with_etag(request, snapshot.body, snapshot.etag)
+
+# Declared before /items/{item_id} so "search" isn't taken for an id
+@app.get("/items/search", response_model=List[ItemSchema])
+async def search_items_endpoint(
+    q: Optional[str] = Query(None, max_length=200, description="Words matched as prefixes anywhere in the name"),
+    prefix: Optional[str] = Query(None, max_length=100, description="Name starts with (case-sensitive)"),
+    min_price: Optional[float] = Query(None, ge=0),
+    max_price: Optional[float] = Query(None, ge=0),
+    in_stock: bool = False,
+    sort: str = Query("relevance", pattern="^(relevance|name|price|-price)$"),
+    limit: int = Query(ITEM_SEARCH_PAGE_SIZE, ge=1, le=ITEM_SEARCH_PAGE_MAX),
+    cursor: Optional[str] = None,
+    session: AsyncSession = Depends(get_async_session)
+):
+    after = None
+    if cursor:
+        try:
+            # The sort key is a name or a number (price, relevance rank)
+            after_key, after_id = decode_cursor(cursor, SCALAR, str)
+            after = (after_key, after_id)
+        except (ValueError, TypeError):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Invalid cursor"
+            )
+    rows = await search_items(
+        session,
+        q=q,
+        prefix=prefix,
+        min_price=min_price,
+        max_price=max_price,
+        in_stock=in_stock,
+        sort=sort,
+        limit=limit,
+        after=after
+    )
+    headers = {}
+    if len(rows) == limit:
+        last_id, _, _, _, last_key = rows[-1]
+        headers["X-Next-Cursor"] = encode_cursor(last_key, last_id)
+    return FastJSONResponse(
+        [{"id": id, "name": name, "price": float(price), "stock_val": stock_val} for id, name, price, stock_val, _ in rows],
+        headers=headers
+    )
 
 @app.get("/items/{item_id}", response_model=ItemSchema)
-def get_item(item_id: str):
-    item = get_item_by_id(item_id)
-    if not item:
+async def get_item(item_id: str, request: Request, session: AsyncSession = Depends(get_async_session)):
+    snapshot = await _catalog(session)
+    entry = snapshot.items.get(item_id)
+    if not entry:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Item not found"
         )
-    return ItemSchema(
-        id=item.id,
-        name=item.name,
-        price=item.price,
-        stock_val=item.stock_val
-    )
+    return _json_with_etag(request, *entry)
 
 @app.post("/items/buy/{item_id}", response_model=dict)
-def buy_item_endpoint(
+async def buy_item_endpoint(
     item_id: str,
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_user),
+    session: AsyncSession = Depends(get_async_session)
 ):
-    user, item, transaction = buy_item(current_user.id, item_id)
+    if flash_sale.is_active(item_id):
+        result = await flash_sale.buy(current_user, item_id)
+        user, (item, transaction) = current_user, result or (None, None)
+    elif DB_SHARDS:
+        (result,), _ = await sharding.purchase(session, [(current_user, item_id)])
+        if isinstance(result, HTTPException):
+            raise result
+        user, (item, transaction) = current_user, result or (None, None)
+    else:
+        user, item, transaction = await buy_item(session, current_user, item_id)
     if not transaction or not user or not item:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Purchase failed: insufficient balance, out of stock, or invalid item"
         )
-    
-    # Handle the Optional user_id field for transaction
-    transaction_user_id = str(transaction.user_id) if transaction.user_id else ""
-    
-    return {
+    return FastJSONResponse({
         "message": "Purchase successful",
-        "user": UserSchema(
-            id=user.id,
-            username=user.username,
-            wallet_bal=user.balance,
-            role="admin" if user.is_admin else "user"
-        ),
-        "item": ItemSchema(
-            id=item.id,
-            name=item.name,
-            price=item.price,
-            stock_val=item.stock_val
-        ),
-        "transaction": TransactionSchema(
-            id=transaction.id,
-            user_id=transaction_user_id,
-            product_id=transaction.product_id,
-            amount=transaction.amount,
-            timestamp=transaction.timestamp,
-            type=transaction.transaction_type
+        "user": user_payload(user.id, user.username, user.balance, user.is_admin),
+        "item": {"id": item.id, "name": item.name, "price": float(item.price), "stock_val": item.stock_val},
+        "transaction": transaction_payload(
+            transaction.id, transaction.user_id, transaction.product_id,
+            transaction.amount, transaction.timestamp, transaction.transaction_type
         )
-    }
+    })
 
 # admin endpoint
 @app.post("/admin/items", response_model=ItemSchema, status_code=status.HTTP_201_CREATED)
-def create_item(
+async def create_item(
     item: ItemCreateSchema,
-    current_user: User = Depends(get_current_admin_user)
+    current_user: User = Depends(get_current_admin_user),
+    session: AsyncSession = Depends(get_async_session)
 ):
     try:
-        new_item = add_item(item.name, item.price, item.stock_val)
+        new_item = await add_item(session, item.name, item.price, item.stock_val, item.flash_sale)
+        if new_item.flash_sale:
+            flash_sale.enable(new_item)
         return ItemSchema(
             id=new_item.id,
             name=new_item.name,
@@ -240,47 +454,120 @@ def create_item(
             stock_val=new_item.stock_val
         )
     except Exception as e:
-        logger.error(f"Failed to create item: {str(e)}", exc_info=True)
+        logger.error("Failed to create item: %s", e, exc_info=True)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Failed to create item"
         )
 
+@app.post("/admin/items/import", response_model=dict)
+async def import_items_endpoint(
+    request: Request,
+    format: str = Query("csv", pattern="^(csv|ndjson)$"),
+    mode: str = Query("insert", pattern="^(insert|upsert)$"),
+    current_user: User = Depends(get_current_admin_user),
+    session: AsyncSession = Depends(get_async_session)
+):
+    from src.item_import import import_items
+    # The body is consumed as it streams in; nothing buffers the whole upload
+    try:
+        return await import_items(session, format, request.stream(), upsert=mode == "upsert")
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+@app.put("/admin/items/{item_id}/flash-sale", response_model=dict)
+async def set_flash_sale(
+    item_id: str,
+    request: FlashSaleSchema,
+    current_user: User = Depends(get_current_admin_user),
+    session: AsyncSession = Depends(get_async_session)
+):
+    item = await set_item_flash_sale(session, item_id, request.enabled)
+    if not item:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Item not found"
+        )
+    if item.flash_sale:
+        flash_sale.enable(item)
+    else:
+        flash_sale.disable(item.id)
+    return {"id": item.id, "flash_sale": item.flash_sale, "stock_val": item.stock_val}
+
+@app.get("/admin/write-batching/stats", response_model=dict)
+async def write_batching_stats(current_user: User = Depends(get_current_admin_user)):
+    return {
+        "wallet": {"enabled": wallet_writer.enabled, **wallet_writer.stats()},
+        "flash_sale": flash_sale.stats(),
+        "shard_recovery": {"enabled": sharding.enabled, **sharding.shard_recovery.stats()},
+    }
+
 @app.get("/admin/users", response_model=List[UserSchema])
-def list_all_users(current_user: User = Depends(get_current_admin_user)):
-    from src.crud import list_users
-    users = list_users()
-    return [
-        UserSchema(
-            id=user.id,
-            username=user.username,
-            wallet_bal=user.balance,
-            role="admin" if user.is_admin else "user"
-        ) for user in users
-    ]
+async def list_all_users(
+    current_user: User = Depends(get_current_admin_user),
+    session: AsyncSession = Depends(get_async_session)
+):
+    rows = await sharding.fan_out(list_user_rows) if DB_SHARDS else await list_user_rows(session)
+    return FastJSONResponse([user_payload(*row) for row in rows])
+
+@app.get("/admin/transactions/export")
+async def export_all_transactions(
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    user_id: Optional[str] = None,
+    current_user: User = Depends(get_current_admin_user)
+):
+    return _export_response(format, user_id)
+
+@app.get("/admin/cache/stats", response_model=dict)
+async def cache_stats(current_user: User = Depends(get_current_admin_user)):
+    from src.cache import user_cache
+    return {
+        "users": user_cache.stats(),
+        "catalog": catalog_cache.stats(),
+        "idempotency": idempotency_store.stats(),
+        "bus": cache_bus.stats()
+    }
+
+@app.get("/admin/admission/stats", response_model=dict)
+async def admission_stats(current_user: User = Depends(get_current_admin_user)):
+    return admission.stats()
+
+@app.get("/admin/profiler/requests", response_model=dict)
+async def profiler_requests(current_user: User = Depends(get_current_admin_user)):
+    return {
+        "enabled": profiler.QUERY_PROFILER_ENABLED,
+        "slow_ms": profiler.QUERY_PROFILER_SLOW_MS,
+        "requests": list(profiler.traces),
+    }
+
+@app.delete("/admin/profiler/requests", status_code=status.HTTP_204_NO_CONTENT)
+async def clear_profiler_requests(current_user: User = Depends(get_current_admin_user)):
+    profiler.traces.clear()
 
 # health check
 @app.get("/health")
-def health_check():
+async def health_check():
     return {"status": "healthy", "message": "API is running"}
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return Response(registry.render(), media_type="text/plain; version=0.0.4")
+
 # debugging
 @app.post("/test-db")
-def test_db_operation():
-    from src.database import get_session
+async def test_db_operation(session: AsyncSession = Depends(get_async_session)):
     from sqlmodel import select
     
     try:
-        session = next(get_session())
-        result = session.exec(select(1))
+        result = await session.exec(select(1))
         return {"status": "Database connection working", "test_query": result.first()}
     except Exception as e:
         return {"status": "Database error", "error": str(e)}
 
 @app.get("/test-get-user/{username}")
-def test_get_user(username: str):
+async def test_get_user(username: str, session: AsyncSession = Depends(get_async_session)):
     from src.crud import get_user_by_username
-    user = get_user_by_username(username)
+    user = await (sharding.get_user_by_username if DB_SHARDS else get_user_by_username)(session, username)
     if user:
         return {
             "exists": True,
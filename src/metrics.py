@@ -0,0 +1,323 @@
+'''
+Prometheus text-format metrics
+
+Hand-rolled rather than pulling in prometheus_client: a handful of counters
+and histograms updated with a dict lookup and a bisect, plus collectors that
+read pool, cache and batch-writer state only when /metrics is scraped.
+Stdlib-only so src.database and the hashing workers can import it freely.
+'''
+
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Tuple
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DB_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> LabelValues:
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return self.header() + [
+            f"{self.name}{_labels(self.label_names, key)} {value}" for key, value in values
+        ]
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return self.header() + [
+            f"{self.name}{_labels(self.label_names, key)} {value}" for key, value in values
+        ]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (), buckets: Iterable[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts..., +Inf count, sum]
+        self._values: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = [(key, list(series)) for key, series in self._values.items()]
+        lines = self.header()
+        for key, series in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound!r}"'
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {series[-1]}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[Metric] = []
+        self._collectors: List[Callable[[], Iterable[Metric]]] = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labels: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: Iterable[str] = ()) -> Gauge:
+        return self.register(Gauge(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Iterable[str] = (), buckets: Iterable[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def collector(self, fn: Callable[[], Iterable[Metric]]) -> Callable[[], Iterable[Metric]]:
+        """Registers ``fn`` to build gauges from live state at scrape time."""
+        self._collectors.append(fn)
+        return fn
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collect in self._collectors:
+            for metric in collect():
+                lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_requests = registry.counter(
+    "http_requests_total", "HTTP requests by route template and status", ("method", "route", "status"))
+http_request_duration = registry.histogram(
+    "http_request_duration_seconds", "HTTP request latency", ("method", "route"))
+http_in_flight = registry.gauge("http_requests_in_flight", "HTTP requests being handled")
+
+db_statements = registry.counter("db_statements_total", "SQL statements executed", ("engine", "statement"))
+db_statement_duration = registry.histogram(
+    "db_statement_duration_seconds", "SQL statement execution time", ("engine", "statement"), DB_BUCKETS)
+db_errors = registry.counter("db_errors_total", "SQL statements that raised", ("engine",))
+db_pool_checkouts = registry.counter("db_pool_checkouts_total", "Connections checked out of the pool", ("engine",))
+db_pool_connects = registry.counter("db_pool_connects_total", "New DBAPI connections opened", ("engine",))
+db_pool_wait = registry.histogram(
+    "db_pool_wait_seconds", "Time spent waiting for a pooled connection", ("engine",), DB_BUCKETS)
+
+password_hash_duration = registry.histogram(
+    "password_hash_duration_seconds", "bcrypt hash/verify time including queueing for a worker", ("operation",))
+password_hash_rejected = registry.counter(
+    "password_hash_rejected_total", "Hash/verify calls refused because the queue was full")
+
+wallet_operations = registry.counter(
+    "wallet_operations_total", "Wallet and purchase operations by outcome", ("operation", "outcome"))
+# Shed rate: everything but outcome="admitted"
+admission_decisions = registry.counter(
+    "admission_decisions_total", "Rate-limit and concurrency-cap decisions", ("route", "outcome"))
+
+
+class Timer:
+    def __init__(self, histogram: Histogram, **labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+def _statement_kind(statement: str) -> str:
+    kind = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+    return kind if kind in ("SELECT", "INSERT", "UPDATE", "DELETE", "PRAGMA", "BEGIN", "COMMIT", "ROLLBACK") else "OTHER"
+
+
+def instrument_engine(engine, name: str) -> None:
+    """Statement, error and pool metrics for a sync Engine (``AsyncEngine.sync_engine``)."""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["metrics_started"].pop()
+        kind = _statement_kind(statement)
+        db_statements.inc(engine=name, statement=kind)
+        db_statement_duration.observe(time.perf_counter() - started, engine=name, statement=kind)
+
+    @event.listens_for(engine, "handle_error")
+    def _error(context):
+        stack = context.connection.info.get("metrics_started") if context.connection is not None else None
+        if stack:
+            stack.pop()
+        db_errors.inc(engine=name)
+
+    @event.listens_for(engine, "connect")
+    def _connect(dbapi_connection, connection_record):
+        db_pool_connects.inc(engine=name)
+
+    @event.listens_for(engine, "checkout")
+    def _checkout(dbapi_connection, connection_record, connection_proxy):
+        db_pool_checkouts.inc(engine=name)
+
+    # The pool has no "before checkout" event, so time the pool's own get
+    pool = engine.pool
+    do_get = pool._do_get
+
+    def _timed_get():
+        started = time.perf_counter()
+        try:
+            return do_get()
+        finally:
+            db_pool_wait.observe(time.perf_counter() - started, engine=name)
+
+    pool._do_get = _timed_get
+
+
+def pool_gauges(engines: Dict[str, object]) -> List[Metric]:
+    size = Gauge("db_pool_size", "Configured pool size", ("engine",))
+    checked_out = Gauge("db_pool_checked_out", "Connections currently checked out", ("engine",))
+    overflow = Gauge("db_pool_overflow", "Connections open beyond pool_size", ("engine",))
+    for name, engine in engines.items():
+        pool = engine.pool
+        if hasattr(pool, "checkedout"):
+            size.set(pool.size(), engine=name)
+            checked_out.set(pool.checkedout(), engine=name)
+            overflow.set(max(pool.overflow(), 0), engine=name)
+    return [size, checked_out, overflow]
+
+
+def stats_gauges(prefix: str, help: str, stats: Dict[str, dict], label: str = "name") -> List[Metric]:
+    # Flattens {name: {stat: number}} (as returned by the .stats() methods)
+    # into one gauge per stat; non-numeric stats are skipped
+    gauges: Dict[str, Gauge] = {}
+    for name, values in stats.items():
+        for stat, value in values.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            gauge = gauges.get(stat)
+            if gauge is None:
+                gauge = gauges[stat] = Gauge(f"{prefix}_{stat}", f"{help}: {stat}", (label,))
+            gauge.set(value, **{label: name})
+    return list(gauges.values())
+
+
+def _route_template(scope) -> str:
+    route = scope.get("route")
+    if route is None:
+        # Answered before routing (404s, idempotent replays): match it here
+        from starlette.routing import Match
+        router = getattr(scope.get("app"), "router", None)
+        for candidate in getattr(router, "routes", ()):
+            if candidate.matches(scope)[0] == Match.FULL:
+                route = candidate
+                break
+    return getattr(route, "path", None) or "unmatched"
+
+
+class MetricsMiddleware:
+    # Plain ASGI middleware; the route template comes from the scope the
+    # router fills in, so /items/{item_id} is one series, not one per id
+
+    def __init__(self, app, skip: Iterable[str] = ("/metrics",)):
+        self.app = app
+        self.skip = frozenset(skip)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.skip:
+            return await self.app(scope, receive, send)
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        http_in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            http_in_flight.dec()
+            template = _route_template(scope)
+            method = scope["method"]
+            http_requests.inc(method=method, route=template, status=status_code)
+            http_request_duration.observe(elapsed, method=method, route=template)
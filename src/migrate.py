@@ -0,0 +1,248 @@
+'''
+schema migrations
+
+Every database (DATABASE_URL, and each shard with DB_SHARDS) records the
+migrations applied to it in the schemaversion table. Worker startup only
+compares that with SCHEMA_VERSION, one query per database, instead of
+running create_all. The migrations themselves run here, once per deploy
+and outside the request workers:
+
+    python -m src.migrate            # apply pending migrations
+    python -m src.migrate --check    # exit 1 if any database is behind
+    python -m src.migrate --rebuild-search  # re-index item names (SQLite)
+
+To change the schema, append a Migration to MIGRATIONS; a new model or
+column is not created by anything else. Pending steps run in order in one
+locked transaction per database, each recorded as it is applied, so two
+processes migrating at once can't both apply a step and a step that fails
+leaves the version where it was.
+
+A worker started against a database that is behind refuses to start and
+names the command to run, so migrating is a deploy step (and the first
+step on a fresh checkout). DB_AUTO_MIGRATE=true makes workers migrate it
+themselves instead, for local development; with several workers they
+take turns on the lock.
+'''
+
+import argparse
+import logging
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterator, List, NamedTuple, Tuple
+
+from sqlalchemy import func, inspect, insert, select, tuple_, update
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.schema import CreateTable
+from sqlmodel import SQLModel
+
+from src.database import engine, env_bool, shard_engines, shard_tables
+from src.models import (
+    User, Item, Transaction, RefreshToken, IdempotencyRecord, BalanceCheckpoint,
+    UserDirectory, ShardWriteLog, CacheInvalidation, SchemaVersion,
+)
+from src.search import install_item_search, detect_item_search, rebuild_item_search
+
+logger = logging.getLogger(__name__)
+
+DB_AUTO_MIGRATE = env_bool("DB_AUTO_MIGRATE", False)
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    # (connection, is_shard); shards only hold shard_tables()
+    apply: Callable[[Connection, bool], None]
+
+
+def _create_tables(*models) -> Callable[[Connection, bool], None]:
+    # Creates whichever of the models' tables are missing; shards only get
+    # the ones in shard_tables()
+    def apply(connection: Connection, shard: bool) -> None:
+        tables = [model.__table__ for model in models]
+        if shard:
+            shard_names = {table.name for table in shard_tables()}
+            tables = [table for table in tables if table.name in shard_names]
+        SQLModel.metadata.create_all(connection, tables=tables)
+    return apply
+
+
+def _transaction_history_index(connection: Connection, shard: bool) -> None:
+    # Transaction tables created before keyset pagination lack it
+    index = next(index for index in Transaction.__table__.indexes if index.name == "ix_transaction_user_id_timestamp")
+    index.create(connection, checkfirst=True)
+
+
+def _item_flash_sale(connection: Connection, shard: bool) -> None:
+    if shard:
+        return
+    columns = {column["name"] for column in inspect(connection).get_columns(Item.__tablename__)}
+    if "flash_sale" not in columns:
+        connection.exec_driver_sql("ALTER TABLE item ADD COLUMN flash_sale BOOLEAN NOT NULL DEFAULT FALSE")
+
+
+def _item_search(connection: Connection, shard: bool) -> None:
+    if not shard:
+        install_item_search(connection)
+
+
+def _ledger_seq(connection: Connection, shard: bool) -> None:
+    # Numbers each user's existing ledger rows in (timestamp, id) order, the
+    # only order there was; new rows get theirs from User.ledger_seq
+    for table in (User.__table__, Transaction.__table__):
+        columns = {column["name"] for column in inspect(connection).get_columns(table.name)}
+        if "ledger_seq" not in columns:
+            connection.exec_driver_sql(f'ALTER TABLE "{table.name}" ADD COLUMN ledger_seq INTEGER NOT NULL DEFAULT 0')
+    user, ledger = User.__table__, Transaction.__table__
+    earlier = ledger.alias("earlier")
+    connection.execute(update(ledger).where(ledger.c.ledger_seq == 0).values(ledger_seq=(
+        select(func.count())
+        .where(earlier.c.user_id == ledger.c.user_id,
+               tuple_(earlier.c.timestamp, earlier.c.id) <= tuple_(ledger.c.timestamp, ledger.c.id))
+        .scalar_subquery()
+    )))
+    connection.execute(update(user).values(ledger_seq=(
+        select(func.coalesce(func.max(ledger.c.ledger_seq), 0)).where(ledger.c.user_id == user.c.id).scalar_subquery()
+    )))
+    index = next(index for index in ledger.indexes if index.name == "ix_transaction_user_id_ledger_seq")
+    index.create(connection, checkfirst=True)
+    # Checkpoints were keyed on (timestamp, id); dropping them only costs the
+    # next reconcile run a full read of the ledger
+    checkpoint = BalanceCheckpoint.__table__
+    checkpoint.drop(connection, checkfirst=True)
+    checkpoint.create(connection)
+
+
+# Every step checks what is already there before changing anything, so a
+# database created by create_all (before versioning) can be brought up to
+# date from version 0 like an empty one.
+MIGRATIONS: List[Migration] = [
+    Migration(1, "users, items and transactions", _create_tables(User, Item, Transaction)),
+    Migration(2, "refresh tokens", _create_tables(RefreshToken)),
+    Migration(3, "transaction history index", _transaction_history_index),
+    Migration(4, "item.flash_sale", _item_flash_sale),
+    Migration(5, "idempotency records", _create_tables(IdempotencyRecord)),
+    Migration(6, "item search index", _item_search),
+    Migration(7, "balance checkpoints", _create_tables(BalanceCheckpoint)),
+    Migration(8, "shard directory and write log", _create_tables(UserDirectory, ShardWriteLog)),
+    Migration(9, "cache invalidation log", _create_tables(CacheInvalidation)),
+    # Re-keys the version 6 index off item.rowid, which VACUUM may renumber
+    Migration(10, "item search keyed on a stable id", _item_search),
+    # Reconcile checkpoints move from wall-clock (timestamp, id) to it
+    Migration(11, "per-user ledger sequence", _ledger_seq),
+]
+SCHEMA_VERSION = MIGRATIONS[-1].version
+
+
+def databases() -> List[Tuple[str, Engine, bool]]:
+    # (name, engine, is_shard)
+    return [("main", engine, False)] + [(f"shard{shard}", shard_engine, True)
+                                        for shard, shard_engine in enumerate(shard_engines)]
+
+
+def schema_version(connection: Connection) -> int:
+    if not inspect(connection).has_table(SchemaVersion.__tablename__):
+        return 0
+    return connection.execute(select(func.max(SchemaVersion.__table__.c.version))).scalar() or 0
+
+
+@contextmanager
+def _locked(db_engine: Engine) -> Iterator[Connection]:
+    if db_engine.dialect.name == "sqlite":
+        # pysqlite doesn't open a transaction before DDL, so take the write
+        # lock up front; a second migrating process waits here
+        with db_engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.exec_driver_sql("ROLLBACK")
+                raise
+            connection.exec_driver_sql("COMMIT")
+    else:
+        with db_engine.begin() as connection:
+            if db_engine.dialect.name == "postgresql":
+                connection.exec_driver_sql("SELECT pg_advisory_xact_lock(hashtext('src.migrate'))")
+            yield connection
+
+
+def migrate_database(db_engine: Engine, shard: bool = False) -> List[int]:
+    applied = []
+    with _locked(db_engine) as connection:
+        connection.execute(CreateTable(SchemaVersion.__table__, if_not_exists=True))
+        current = schema_version(connection)
+        for migration in MIGRATIONS:
+            if migration.version <= current:
+                continue
+            migration.apply(connection, shard)
+            connection.execute(insert(SchemaVersion.__table__).values(
+                version=migration.version,
+                description=migration.description,
+                applied_at=datetime.now(timezone.utc),
+            ))
+            applied.append(migration.version)
+    return applied
+
+
+def migrate() -> Dict[str, List[int]]:
+    applied = {}
+    for name, db_engine, shard in databases():
+        applied[name] = migrate_database(db_engine, shard)
+        if applied[name]:
+            logger.info("Migrated %s to schema version %d", name, SCHEMA_VERSION)
+    return applied
+
+
+def pending() -> Dict[str, int]:
+    # Databases behind SCHEMA_VERSION, with the version they are at
+    behind = {}
+    for name, db_engine, _ in databases():
+        with db_engine.connect() as connection:
+            version = schema_version(connection)
+        if version < SCHEMA_VERSION:
+            behind[name] = version
+    return behind
+
+
+def ensure_schema() -> None:
+    # Worker startup: a version check per database, migrating only if allowed
+    behind = pending()
+    if behind:
+        if not DB_AUTO_MIGRATE:
+            versions = ", ".join(f"{name} at {version}" for name, version in behind.items())
+            raise RuntimeError(
+                f"Database schema is behind version {SCHEMA_VERSION} ({versions}); run `python -m src.migrate`"
+            )
+        migrate()
+    with engine.connect() as connection:
+        detect_item_search(connection)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply pending schema migrations")
+    parser.add_argument("--check", action="store_true", help="only report; exit 1 if a database is behind")
+    parser.add_argument("--rebuild-search", action="store_true", help="re-index item names in the search table")
+    args = parser.parse_args()
+
+    if args.rebuild_search:
+        with engine.begin() as connection:
+            if not detect_item_search(connection):
+                print("No item search index in this database")
+                return 1
+            rebuild_item_search(connection)
+        print("Rebuilt the item search index")
+        return 0
+
+    if args.check:
+        behind = pending()
+        for name, version in behind.items():
+            print(f"{name}: at version {version}, latest is {SCHEMA_VERSION}")
+        if not behind:
+            print(f"All databases at version {SCHEMA_VERSION}")
+        return 1 if behind else 0
+    for name, versions in migrate().items():
+        print(f"{name}: applied {versions}" if versions else f"{name}: up to date")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
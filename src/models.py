@@ -1,4 +1,5 @@
 ﻿from sqlmodel import SQLModel, Field, Relationship
+from sqlalchemy import Index
 from typing import Optional, List
 from datetime import datetime, timezone
 import uuid
@@ -12,6 +13,9 @@ class User(SQLModel, table=True):
     hashed_password: str
     balance: float = Field(default=0.0)
     is_admin: bool = Field(default=False)
+    # Bumped by every balance change, in the same UPDATE; the change's
+    # Transaction row gets the new value
+    ledger_seq: int = Field(default=0)
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     
     transactions: List["Transaction"] = Relationship(back_populates="user")
@@ -24,12 +28,20 @@ class Item(SQLModel, table=True):
     name: str = Field(index=True)
     price: float
     stock_val: int = Field(default=0)
+    # Purchases go through the in-memory flash-sale engine
+    flash_sale: bool = Field(default=False)
     owner_id: Optional[str] = Field(default=None, foreign_key="user.id")
     
     owner: Optional[User] = Relationship(back_populates="items")
 
 class Transaction(SQLModel, table=True):
-    __table_args__ = {'extend_existing': True}
+    __table_args__ = (
+        # Serves per-user history pages ordered by (timestamp, id)
+        Index("ix_transaction_user_id_timestamp", "user_id", "timestamp", "id"),
+        # Reconciliation reads the rows after a checkpoint's ledger_seq
+        Index("ix_transaction_user_id_ledger_seq", "user_id", "ledger_seq", unique=True),
+        {'extend_existing': True},
+    )
     
     id: str = Field(default_factory=lambda: str(uuid.uuid4()), primary_key=True)
     amount: float
@@ -37,5 +49,85 @@ class Transaction(SQLModel, table=True):
     user_id: str = Field(foreign_key="user.id")  # Changed from Optional to required
     product_id: Optional[str] = Field(default=None)
     timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    # User.ledger_seq after this row's balance change. Taken under the
+    # user's row lock, so unlike timestamp it follows commit order.
+    ledger_seq: int
     
-    user: Optional[User] = Relationship(back_populates="transactions")
\ No newline at end of file
+    user: Optional[User] = Relationship(back_populates="transactions")
+
+class RefreshToken(SQLModel, table=True):
+    __table_args__ = {'extend_existing': True}
+
+    # Only the token id is stored; the token itself is a signed JWT
+    jti: str = Field(primary_key=True)
+    user_id: str = Field(foreign_key="user.id", index=True)
+    expires_at: datetime = Field(index=True)
+
+class BalanceCheckpoint(SQLModel, table=True):
+    __table_args__ = {'extend_existing': True}
+
+    # Ledger balance as of the user's transaction with this ledger_seq;
+    # reconciliation only sums transactions after it
+    user_id: str = Field(foreign_key="user.id", primary_key=True)
+    balance: float
+    ledger_seq: int
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class UserDirectory(SQLModel, table=True):
+    __table_args__ = {'extend_existing': True}
+
+    # Only used with DB_SHARDS: which shard holds each user
+    username: str = Field(primary_key=True)
+    user_id: str
+    shard: int
+
+class ShardWriteLog(SQLModel, table=True):
+    __table_args__ = {'extend_existing': True}
+
+    # Recovery log for writes spanning two databases under DB_SHARDS:
+    # transfers between shards, and purchases (item stock stays in the main
+    # database). The debit's ledger row reuses this id, so recovery can tell
+    # whether the debit committed.
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()), primary_key=True)
+    kind: str  # 'transfer' or 'purchase'
+    status: str = Field(default="pending", index=True)  # 'pending', 'committed', 'aborted'
+    user_id: str
+    shard: int
+    amount: float
+    recipient_id: Optional[str] = Field(default=None)
+    recipient_shard: Optional[int] = Field(default=None)
+    product_id: Optional[str] = Field(default=None)
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class CacheInvalidation(SQLModel, table=True):
+    # AUTOINCREMENT so ids never go backwards once old rows are pruned;
+    # workers poll for ids above the last one they applied
+    __table_args__ = {'extend_existing': True, 'sqlite_autoincrement': True}
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    entity: str  # 'user' or 'catalog'
+    key: Optional[str] = Field(default=None)
+    # Publishing worker, which skips its own events
+    origin: str
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc), index=True)
+
+class IdempotencyRecord(SQLModel, table=True):
+    __table_args__ = {'extend_existing': True}
+
+    # sha256 of caller, route and Idempotency-Key header
+    key: str = Field(primary_key=True)
+    fingerprint: str
+    # None while the first request with this key is still running
+    status_code: Optional[int] = Field(default=None)
+    content_type: Optional[str] = Field(default=None)
+    body: Optional[bytes] = Field(default=None)
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc), index=True)
+
+class SchemaVersion(SQLModel, table=True):
+    __table_args__ = {'extend_existing': True}
+
+    # One row per migration applied by src.migrate, in every database
+    # (shards included)
+    version: int = Field(primary_key=True)
+    description: str
+    applied_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
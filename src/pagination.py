@@ -0,0 +1,34 @@
+'''
+opaque keyset cursors for paginated endpoints
+'''
+
+import base64
+import json
+from datetime import datetime
+from typing import Any, List, Tuple, Type, Union
+
+# Cursor value types, as they come back from JSON
+SCALAR = (int, float, str)
+
+
+def encode_cursor(*values: Any) -> str:
+    raw = json.dumps([v.isoformat() if isinstance(v, datetime) else v for v in values], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, *types: Union[Type, Tuple[Type, ...]]) -> List[Any]:
+    # With `types`, the cursor must hold exactly one value of each type, so
+    # nothing but a scalar of the expected kind reaches the SQL comparison
+    padded = cursor + "=" * (-len(cursor) % 4)
+    try:
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except ValueError:
+        raise ValueError("Malformed cursor")
+    if not isinstance(values, list):
+        raise ValueError("Malformed cursor")
+    if types:
+        if len(values) != len(types) or any(
+            isinstance(value, bool) or not isinstance(value, expected) for value, expected in zip(values, types)
+        ):
+            raise ValueError("Malformed cursor")
+    return values
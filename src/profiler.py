@@ -0,0 +1,163 @@
+'''
+opt-in per-request SQL profiler
+
+With QUERY_PROFILER_ENABLED every statement a request runs is counted and
+timed through engine cursor events, attributed to the request via a
+contextvar (SQLAlchemy carries the context into the greenlet that runs the
+driver). Responses get X-DB-Queries / X-DB-Time headers, identical
+statements repeated QUERY_PROFILER_REPEAT_THRESHOLD times or more are
+flagged as a likely N+1, and traces of slow or flagged requests are kept in
+a ring buffer for /admin/profiler/requests.
+
+Writes queued to a BatchWriter (group commit, flash-sale orders) run in the
+writer task, outside the request's context; the writer profiles each batch
+with shared() instead, so every request in a batch is charged with all of
+the batch's statements and their time.
+'''
+
+import logging
+import os
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
+
+from src.database import env_bool
+
+logger = logging.getLogger(__name__)
+
+QUERY_PROFILER_ENABLED = env_bool("QUERY_PROFILER_ENABLED", False)
+QUERY_PROFILER_SLOW_MS = float(os.getenv("QUERY_PROFILER_SLOW_MS", "100"))
+QUERY_PROFILER_REPEAT_THRESHOLD = int(os.getenv("QUERY_PROFILER_REPEAT_THRESHOLD", "3"))
+QUERY_PROFILER_BUFFER_SIZE = int(os.getenv("QUERY_PROFILER_BUFFER_SIZE", "100"))
+
+
+class RequestProfile:
+    def __init__(self, method: str, path: str):
+        self.method = method
+        self.path = path
+        self.started = time.perf_counter()
+        self.db_time = 0.0
+        # (statement, seconds), in execution order
+        self.statements: List[Tuple[str, float]] = []
+
+    def record(self, statement: str, elapsed: float) -> None:
+        self.db_time += elapsed
+        self.statements.append((statement, elapsed))
+
+    @property
+    def queries(self) -> int:
+        return len(self.statements)
+
+    def repeated(self, threshold: int = QUERY_PROFILER_REPEAT_THRESHOLD) -> dict:
+        counts = Counter(statement for statement, _ in self.statements)
+        return {statement: count for statement, count in counts.items() if count >= threshold}
+
+    def trace(self, status_code: int) -> dict:
+        return {
+            "at": datetime.now(timezone.utc).isoformat(),
+            "method": self.method,
+            "path": self.path,
+            "status": status_code,
+            "duration_ms": round((time.perf_counter() - self.started) * 1000, 3),
+            "queries": self.queries,
+            "db_time_ms": round(self.db_time * 1000, 3),
+            "repeated": [{"statement": s, "count": c} for s, c in self.repeated().items()],
+            "statements": [{"statement": s, "ms": round(d * 1000, 3)} for s, d in self.statements],
+        }
+
+
+class SharedProfile:
+    # Stands in for the profiles of the requests whose work runs as one batch
+    def __init__(self, profiles: List[RequestProfile]):
+        self.profiles = profiles
+
+    def record(self, statement: str, elapsed: float) -> None:
+        for profile in self.profiles:
+            profile.record(statement, elapsed)
+
+
+_current: ContextVar[Union[RequestProfile, SharedProfile, None]] = ContextVar("query_profile", default=None)
+
+
+def current() -> Optional[RequestProfile]:
+    profile = _current.get()
+    return profile if isinstance(profile, RequestProfile) else None
+
+
+@contextmanager
+def shared(profiles: Iterable[Optional[RequestProfile]]) -> Iterator[None]:
+    # Statements run inside are recorded in each of the profiles
+    profiles = [profile for profile in profiles if profile is not None]
+    if not profiles:
+        yield
+        return
+    token = _current.set(SharedProfile(profiles))
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+# Slow or N+1-flagged request traces, newest last
+traces: deque = deque(maxlen=QUERY_PROFILER_BUFFER_SIZE)
+
+
+def instrument_engine(engine) -> None:
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        if _current.get() is not None:
+            conn.info.setdefault("profiler_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        profile = _current.get()
+        if profile is None:
+            return
+        stack = conn.info.get("profiler_started")
+        if not stack:
+            return
+        profile.record(statement, time.perf_counter() - stack.pop())
+
+
+class QueryProfilerMiddleware:
+    def __init__(self, app, slow_ms: float = QUERY_PROFILER_SLOW_MS, skip: Tuple[str, ...] = ("/admin/profiler", "/metrics")):
+        self.app = app
+        self.slow = slow_ms / 1000
+        self.skip = skip
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith(self.skip):
+            return await self.app(scope, receive, send)
+        profile = RequestProfile(scope["method"], scope["path"])
+        token = _current.set(profile)
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                # Streamed responses keep querying after this point; their
+                # full count is in the trace, not the headers
+                headers = list(message.get("headers", []))
+                headers.append((b"x-db-queries", str(profile.queries).encode()))
+                headers.append((b"x-db-time", f"{profile.db_time * 1000:.3f}".encode()))
+                repeated = profile.repeated()
+                if repeated:
+                    headers.append((b"x-db-repeated", str(sum(repeated.values())).encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current.reset(token)
+            repeated = profile.repeated()
+            if repeated:
+                logger.warning("Repeated statements in %s %s: %s", profile.method, profile.path,
+                               {statement[:80]: count for statement, count in repeated.items()})
+            if repeated or time.perf_counter() - profile.started >= self.slow:
+                traces.append(profile.trace(status_code))
@@ -0,0 +1,210 @@
+'''
+incremental wallet reconciliation
+
+Checks every User.balance against its ledger: the balance recorded in the
+user's BalanceCheckpoint (or INITIAL_BALANCE when there is none) plus the
+Transaction amounts after the checkpoint. Each batch of users is read with
+a single statement, so balances and ledger come from one snapshot. Wallets
+that agree get their checkpoint moved to their latest transaction, so the
+next run reads only newer transactions. Drifted wallets are reported and
+their checkpoints are left alone.
+
+"After" is by Transaction.ledger_seq, the per-user counter every balance
+change bumps under the user's row lock, not by timestamp: a row stamped
+before a checkpoint (clock skew, or a timestamp taken before the lock) can
+still commit after it.
+
+User ids are split into ranges and the ranges are reconciled in parallel
+worker processes, each with its own engine. With DB_SHARDS every shard is
+split the same way.
+
+    python -m src.reconcile --workers 4 --partitions 16
+    python -m src.reconcile --json report.json --every 3600
+'''
+
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+
+from sqlalchemy import and_, delete, func, insert, select
+from sqlalchemy.engine import make_url
+
+RECONCILE_BATCH_SIZE = int(os.getenv("RECONCILE_BATCH_SIZE", "1000"))
+# Float balances: differences below half a cent are rounding, not drift
+RECONCILE_TOLERANCE = float(os.getenv("RECONCILE_TOLERANCE", "0.005"))
+
+def partition_bounds(partitions: int) -> List[Tuple[str, Optional[str]]]:
+    # User ids are uuid4 hex strings; split on the first two hex digits.
+    # The first range starts at "" and the last is open-ended, so ids of
+    # any other shape are still covered.
+    partitions = max(1, min(partitions, 256))
+    cuts = [f"{round(i * 256 / partitions):02x}" for i in range(1, partitions)]
+    lows = [""] + cuts
+    highs = cuts + [None]
+    return list(zip(lows, highs))
+
+
+def _batch_statement(low: str, high: Optional[str], after_id: Optional[str], batch_size: int):
+    from src.models import User, Transaction, BalanceCheckpoint
+
+    user, ledger, checkpoint = User.__table__, Transaction.__table__, BalanceCheckpoint.__table__
+    users = select(user.c.id, user.c.balance).where(user.c.id > after_id if after_id is not None else user.c.id >= low)
+    if high is not None:
+        users = users.where(user.c.id < high)
+    users = users.order_by(user.c.id).limit(batch_size).subquery()
+
+    # Only rows after the checkpoint: a range on ix_transaction_user_id_ledger_seq
+    newer = and_(ledger.c.user_id == users.c.id, ledger.c.ledger_seq > func.coalesce(checkpoint.c.ledger_seq, 0))
+    return (
+        select(
+            users.c.id,
+            users.c.balance,
+            checkpoint.c.balance,
+            func.coalesce(func.sum(ledger.c.amount), 0.0),
+            func.count(ledger.c.id),
+            func.max(ledger.c.ledger_seq),
+        )
+        .select_from(
+            users
+            .outerjoin(checkpoint, checkpoint.c.user_id == users.c.id)
+            .outerjoin(ledger, newer)
+        )
+        .group_by(users.c.id, users.c.balance, checkpoint.c.balance)
+        .order_by(users.c.id)
+    )
+
+
+def reconcile_range(url: str, low: str, high: Optional[str], batch_size: int = RECONCILE_BATCH_SIZE,
+                    write_checkpoints: bool = True) -> dict:
+    from src.database import create_db_engine
+    from src.models import BalanceCheckpoint
+    from src.crud import INITIAL_BALANCE
+
+    checkpoints = BalanceCheckpoint.__table__
+    engine = create_db_engine(url)
+    started = time.perf_counter()
+    users = transactions = checkpointed = 0
+    drifted = []
+    after_id = None
+    try:
+        while True:
+            with engine.connect() as connection:
+                rows = connection.execute(_batch_statement(low, high, after_id, batch_size)).all()
+            if not rows:
+                break
+            advanced = []
+            for user_id, balance, checkpoint_balance, amount, count, ledger_seq in rows:
+                base = INITIAL_BALANCE if checkpoint_balance is None else checkpoint_balance
+                expected = base + amount
+                users += 1
+                transactions += count
+                if abs(balance - expected) > RECONCILE_TOLERANCE:
+                    drifted.append({
+                        "user_id": user_id,
+                        "balance": balance,
+                        "expected": round(expected, 6),
+                        "difference": round(balance - expected, 6),
+                        "transactions_checked": count,
+                    })
+                elif count:
+                    advanced.append({
+                        "user_id": user_id,
+                        "balance": expected,
+                        "ledger_seq": ledger_seq,
+                        "updated_at": datetime.now(timezone.utc),
+                    })
+            if write_checkpoints and advanced:
+                with engine.begin() as connection:
+                    connection.execute(delete(checkpoints).where(
+                        checkpoints.c.user_id.in_([row["user_id"] for row in advanced])
+                    ))
+                    connection.execute(insert(checkpoints), advanced)
+                checkpointed += len(advanced)
+            after_id = rows[-1][0]
+    finally:
+        engine.dispose()
+    return {
+        "database": make_url(url).render_as_string(),
+        "range": [low, high],
+        "users": users,
+        "transactions": transactions,
+        "checkpoints_written": checkpointed,
+        "drifted": drifted,
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+
+
+def reconcile(urls: List[str], workers: int, partitions: int, batch_size: int = RECONCILE_BATCH_SIZE,
+              write_checkpoints: bool = True) -> dict:
+    started = time.perf_counter()
+    tasks = [(url, low, high) for url in urls for low, high in partition_bounds(partitions)]
+    if workers <= 1:
+        results = [reconcile_range(url, low, high, batch_size, write_checkpoints) for url, low, high in tasks]
+    else:
+        # spawn: workers build their own engines instead of inheriting pools
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            futures = [pool.submit(reconcile_range, url, low, high, batch_size, write_checkpoints) for url, low, high in tasks]
+            results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - started
+    users = sum(result["users"] for result in results)
+    transactions = sum(result["transactions"] for result in results)
+    return {
+        "finished_at": datetime.now(timezone.utc).isoformat(),
+        "workers": workers,
+        "partitions": len(tasks),
+        "users": users,
+        "transactions": transactions,
+        "checkpoints_written": sum(result["checkpoints_written"] for result in results),
+        "drifted": [wallet for result in results for wallet in result["drifted"]],
+        "seconds": round(elapsed, 3),
+        "users_per_second": round(users / elapsed, 1) if elapsed else None,
+        "transactions_per_second": round(transactions / elapsed, 1) if elapsed else None,
+        "partition_stats": [{key: value for key, value in result.items() if key != "drifted"} for result in results],
+    }
+
+
+def main():
+    from src.database import DATABASE_URL, DB_SHARDS, init_db, shard_url
+
+    parser = argparse.ArgumentParser(description="Reconcile wallet balances against the transaction ledger")
+    parser.add_argument("--url", default=DATABASE_URL, help="default: DATABASE_URL, or every shard with DB_SHARDS")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--partitions", type=int, default=None, help="user-id ranges (default: 4 per worker)")
+    parser.add_argument("--batch-size", type=int, default=RECONCILE_BATCH_SIZE)
+    parser.add_argument("--no-checkpoints", action="store_true", help="report only, don't advance checkpoints")
+    parser.add_argument("--json", help="write the full report here")
+    parser.add_argument("--every", type=float, help="repeat every N seconds")
+    args = parser.parse_args()
+
+    urls = [args.url]
+    if args.url == DATABASE_URL:
+        # Fails early, naming src.migrate, if the checkpoint table is missing
+        init_db()
+        if DB_SHARDS:
+            urls = [shard_url(shard) for shard in range(DB_SHARDS)]
+    partitions = args.partitions or args.workers * 4
+    while True:
+        report = reconcile(urls, args.workers, partitions, args.batch_size, not args.no_checkpoints)
+        print(
+            f"{report['users']} wallets, {report['transactions']} transactions in {report['seconds']}s "
+            f"({report['users_per_second']} wallets/s, {report['transactions_per_second']} tx/s), "
+            f"{report['checkpoints_written']} checkpoints advanced, {len(report['drifted'])} drifted"
+        )
+        for wallet in report["drifted"][:20]:
+            print(f"  drift {wallet['user_id']}: balance {wallet['balance']} expected {wallet['expected']} "
+                  f"({wallet['difference']:+})")
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2, default=str)
+        if not args.every:
+            return 1 if report["drifted"] else 0
+        time.sleep(args.every)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -64,17 +64,23 @@ class ItemCreateSchema(BaseModel):
     name: str = Field(min_length=1, max_length=100)
     price: float = Field(ge=0)
     stock_val: int = Field(ge=0)
+    flash_sale: bool = False
 
     model_config = {
         "json_schema_extra": {
             "example": {
                 "name": "Sample Item",
                 "price": 29.99,
-                "stock_val": 100
+                "stock_val": 100,
+                "flash_sale": False
             }
         }
     }
 
+class ItemImportSchema(ItemCreateSchema):
+    # Rows with an id update that item when importing with mode=upsert
+    id: Optional[str] = Field(default=None, min_length=1, max_length=64)
+
 class UserLoginSchema(BaseModel):
     username: str
     password: str
@@ -121,4 +127,26 @@ class TopUpWalletSchema(BaseModel):
                 "amount": 100.0
             }
         }
-    }
\ No newline at end of file
+    }
+
+class RefreshTokenSchema(BaseModel):
+    refresh_token: str
+
+    model_config = {
+        "json_schema_extra": {
+            "example": {
+                "refresh_token": "eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9..."
+            }
+        }
+    }
+
+class FlashSaleSchema(BaseModel):
+    enabled: bool
+
+    model_config = {
+        "json_schema_extra": {
+            "example": {
+                "enabled": True
+            }
+        }
+    }
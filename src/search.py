@@ -0,0 +1,124 @@
+'''
+item search index
+
+On SQLite the item names are indexed by an FTS5 table (item_fts). Its
+rowids are item_search_key.search_id, an INTEGER PRIMARY KEY assigned to
+each item id, and its content is read through the item_search_content
+view. item's own rowid isn't used: item has a VARCHAR primary key, so its
+rowids can be renumbered by VACUUM, which would leave the index pointing at
+the wrong rows. Triggers keep the index in step with every write to item:
+add_item, bulk imports and renames alike. Where FTS5 isn't available
+(other databases, or SQLite built without it), search falls back to LIKE
+matching.
+
+rebuild_item_search() re-indexes every item from the table, for an index
+suspected to be out of step (say, after writes with triggers disabled):
+
+    python -m src.migrate --rebuild-search
+'''
+
+import re
+from typing import Optional
+
+from sqlalchemy import column, table
+from sqlalchemy.exc import OperationalError
+
+# Set by install_item_search() or detect_item_search(); read when building
+# search queries
+fts_enabled = False
+
+# rank is FTS5's bm25 score: lower is a better match
+item_fts = table("item_fts", column("rowid"), column("rank"))
+item_search_key = table("item_search_key", column("search_id"), column("item_id"))
+
+_ITEM_SEARCH_DDL = (
+    # First, so nothing else is created where FTS5 is missing. prefix='2 3'
+    # keeps short prefix queries ("ph*") off full term scans
+    "CREATE VIRTUAL TABLE IF NOT EXISTS item_fts USING fts5("
+    "name, content='item_search_content', content_rowid='search_id', tokenize='unicode61', prefix='2 3')",
+    "CREATE TABLE IF NOT EXISTS item_search_key ("
+    "search_id INTEGER PRIMARY KEY, item_id VARCHAR NOT NULL UNIQUE)",
+    "CREATE VIEW IF NOT EXISTS item_search_content AS "
+    "SELECT item_search_key.search_id AS search_id, item.name AS name "
+    "FROM item_search_key JOIN item ON item.id = item_search_key.item_id",
+    "CREATE TRIGGER IF NOT EXISTS item_search_insert AFTER INSERT ON item BEGIN "
+    "INSERT INTO item_search_key(item_id) VALUES (new.id); "
+    "INSERT INTO item_fts(rowid, name) "
+    "SELECT search_id, new.name FROM item_search_key WHERE item_id = new.id; END",
+    "CREATE TRIGGER IF NOT EXISTS item_search_delete AFTER DELETE ON item BEGIN "
+    "INSERT INTO item_fts(item_fts, rowid, name) "
+    "SELECT 'delete', search_id, old.name FROM item_search_key WHERE item_id = old.id; "
+    "DELETE FROM item_search_key WHERE item_id = old.id; END",
+    "CREATE TRIGGER IF NOT EXISTS item_search_rename AFTER UPDATE OF name ON item BEGIN "
+    "INSERT INTO item_fts(item_fts, rowid, name) "
+    "SELECT 'delete', search_id, old.name FROM item_search_key WHERE item_id = old.id; "
+    "INSERT INTO item_fts(rowid, name) "
+    "SELECT search_id, new.name FROM item_search_key WHERE item_id = new.id; END",
+)
+
+# The first version indexed item.rowid directly
+_LEGACY_ITEM_SEARCH_DDL = (
+    "DROP TRIGGER IF EXISTS item_fts_insert",
+    "DROP TRIGGER IF EXISTS item_fts_delete",
+    "DROP TRIGGER IF EXISTS item_fts_rename",
+    "DROP TABLE IF EXISTS item_fts",
+)
+
+
+def _item_fts_sql(connection) -> Optional[str]:
+    row = connection.exec_driver_sql(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'item_fts'"
+    ).first()
+    return row[0] if row else None
+
+
+def install_item_search(connection) -> bool:
+    global fts_enabled
+    if connection.dialect.name != "sqlite":
+        fts_enabled = False
+        return False
+    existing = _item_fts_sql(connection)
+    if existing is not None and "content='item'" in existing:
+        for ddl in _LEGACY_ITEM_SEARCH_DDL:
+            connection.exec_driver_sql(ddl)
+        existing = None
+    try:
+        for ddl in _ITEM_SEARCH_DDL:
+            connection.exec_driver_sql(ddl)
+    except OperationalError:
+        # SQLite compiled without FTS5
+        fts_enabled = False
+        return False
+    if existing is None:
+        # Index the items that were there before the search table
+        rebuild_item_search(connection)
+    fts_enabled = True
+    return True
+
+
+def rebuild_item_search(connection) -> None:
+    connection.exec_driver_sql(
+        "INSERT INTO item_search_key(item_id) SELECT id FROM item "
+        "WHERE id NOT IN (SELECT item_id FROM item_search_key)"
+    )
+    connection.exec_driver_sql("INSERT INTO item_fts(item_fts) VALUES ('rebuild')")
+
+
+def detect_item_search(connection) -> bool:
+    # Startup check for a database migrated elsewhere: no DDL, just whether
+    # the FTS table is there
+    global fts_enabled
+    fts_enabled = connection.dialect.name == "sqlite" and _item_fts_sql(connection) is not None
+    return fts_enabled
+
+
+def search_terms(query: str) -> list:
+    return re.findall(r"\w+", query)
+
+
+def fts_match_query(query: str) -> Optional[str]:
+    # Every word must match as a prefix: "red sho" -> "red"* "sho"*
+    terms = search_terms(query)
+    if not terms:
+        return None
+    return " ".join(f'"{term}"*' for term in terms)
@@ -0,0 +1,375 @@
+'''
+sharded user storage (DB_SHARDS)
+
+Users, their ledger, refresh tokens and balance checkpoints are spread over
+DB_SHARDS databases by a hash of the user id (src.database.shard_for), so
+wallet writes for different users take different write locks. The main
+database keeps the item catalog, idempotency records and two tables of
+its own: UserDirectory (username -> user id and shard) and ShardWriteLog.
+
+Writes that touch two databases go through ShardWriteLog:
+
+1. A pending log row is committed in the main database (for purchases in
+   the same transaction as the stock decrement).
+2. The debit and its ledger row are committed on the payer's shard. The
+   ledger row takes the log row's id. This is the commit point: the write
+   is complete once that row exists, and cancelled if it never will.
+3. The other side is applied: the recipient's credit on their shard (its
+   ledger row id is derived from the log id, so applying it twice is a
+   no-op), or, for a failed purchase, the stock goes back.
+4. The log row is marked committed or aborted.
+
+A crash or a failing shard can leave a row pending. ShardWriteRecovery
+settles pending rows older than SHARD_RECOVERY_GRACE seconds by checking
+for the debit's ledger row: rolled forward if it is there, aborted if not.
+Step 2 gives up after SHARD_WRITE_TIMEOUT seconds, well inside the grace
+period, so recovery never aborts a write that is still about to commit.
+'''
+
+import asyncio
+import logging
+import os
+import time
+import uuid
+from collections import Counter, defaultdict
+from datetime import datetime, timezone, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+from fastapi import HTTPException, status
+from sqlalchemy import delete, update
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from src.database import DB_SHARDS, async_session, shard_for, shard_session, shard_sessions
+from src.models import User, Item, Transaction, UserDirectory, ShardWriteLog
+from src.auth import get_password_hash_async
+from src.crud import (
+    INITIAL_BALANCE, _debit, _credit, _remember_balance, _catalog_changed, _forget_user,
+    transfer_money as transfer_on_shard,
+)
+from src.metrics import wallet_operations
+
+logger = logging.getLogger(__name__)
+
+enabled = DB_SHARDS > 0
+
+SHARD_WRITE_TIMEOUT = float(os.getenv("SHARD_WRITE_TIMEOUT", "10"))
+SHARD_RECOVERY_GRACE = float(os.getenv("SHARD_RECOVERY_GRACE", "60"))
+SHARD_RECOVERY_INTERVAL = float(os.getenv("SHARD_RECOVERY_INTERVAL", "30"))
+
+
+def write_outcome_unknown() -> HTTPException:
+    # A shard failed mid-write: its commit may or may not have happened (and
+    # a purchase may still be rolled forward by recovery), so this must not
+    # read as a refusal, nor be stored as the Idempotency-Key's response
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="The write could not be confirmed; check the balance or transaction history before retrying",
+    )
+
+
+def _credit_transaction_id(log_id: str) -> str:
+    return str(uuid.uuid5(uuid.UUID(log_id), "transfer_in"))
+
+
+async def get_user_by_username(session: AsyncSession, username: str) -> Optional[User]:
+    # `session` is on the main database; the user comes back detached
+    entry = await session.get(UserDirectory, username)
+    if entry is None:
+        return None
+    async with shard_session(entry.shard) as shard_db:
+        return await shard_db.get(User, entry.user_id)
+
+
+async def create_user(session: AsyncSession, username: str, password: str, role: str = "user") -> dict:
+    if await session.get(UserDirectory, username):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Username already registered"
+        )
+    password_hash = await get_password_hash_async(password)
+    user = User(
+        username=username,
+        email=f"{username}@example.com",
+        hashed_password=password_hash,
+        balance=INITIAL_BALANCE,
+        is_admin=role == "admin"
+    )
+    shard = shard_for(user.id)
+    try:
+        async with shard_session(shard) as shard_db:
+            shard_db.add(user)
+            await shard_db.commit()
+        # The user row goes in first, so a crash in between leaves an
+        # unreachable user rather than a directory entry with no user.
+        # The directory's primary key settles concurrent sign-ups.
+        session.add(UserDirectory(username=username, user_id=user.id, shard=shard))
+        await session.commit()
+    except IntegrityError:
+        await session.rollback()
+        async with shard_session(shard) as shard_db:
+            await shard_db.exec(delete(User).where(User.id == user.id))
+            await shard_db.commit()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Username already registered"
+        )
+    return {
+        "id": user.id,
+        "username": user.username,
+        "wallet_bal": user.balance,
+        "role": "admin" if user.is_admin else "user"
+    }
+
+
+async def _settle(session: AsyncSession, log_ids: List[str], outcome: str) -> int:
+    # Only pending rows move, so a write is settled exactly once whether by
+    # its request or by recovery. Aborted purchases give their stock back.
+    if not log_ids:
+        return 0
+    product_ids = (await session.exec(
+        update(ShardWriteLog)
+        .where(ShardWriteLog.id.in_(log_ids), ShardWriteLog.status == "pending")
+        .values(status=outcome)
+        .returning(ShardWriteLog.product_id)
+        .execution_options(synchronize_session=False)
+    )).scalars().all()
+    restocked = Counter(product_id for product_id in product_ids if product_id) if outcome == "aborted" else {}
+    for product_id, count in restocked.items():
+        await session.exec(
+            update(Item)
+            .where(Item.id == product_id)
+            .values(stock_val=Item.stock_val + count)
+            .execution_options(synchronize_session=False)
+        )
+    await session.commit()
+    if restocked:
+        _catalog_changed()
+    return len(product_ids)
+
+
+async def _apply_credit(log: ShardWriteLog) -> None:
+    async with shard_session(log.recipient_shard) as shard_db:
+        posting = await _credit(shard_db, log.recipient_id, log.amount)
+        if posting is None:
+            await shard_db.rollback()
+            return
+        # If the ledger row is already there, the credit was applied before
+        # and this one is rolled back
+        shard_db.add(Transaction(
+            id=_credit_transaction_id(log.id),
+            user_id=log.recipient_id,
+            amount=log.amount,
+            transaction_type="transfer_in",
+            ledger_seq=posting.ledger_seq
+        ))
+        try:
+            await shard_db.commit()
+        except IntegrityError:
+            await shard_db.rollback()
+
+
+async def transfer_money(session: AsyncSession, sender: User, recipient_username: str, amount: float) -> Tuple[Optional[User], Optional[Union[User, UserDirectory]], Optional[Transaction]]:
+    entry = await session.get(UserDirectory, recipient_username)
+    if entry is None or entry.user_id == sender.id:
+        await session.rollback()
+        wallet_operations.inc(operation="transfer", outcome="invalid_recipient")
+        return None, None, None
+    sender_shard = shard_for(sender.id)
+    if entry.shard == sender_shard:
+        # Both wallets in one database: the single-transaction path
+        async with shard_session(sender_shard) as shard_db:
+            return await transfer_on_shard(shard_db, sender, recipient_username, amount)
+
+    log = ShardWriteLog(
+        kind="transfer", user_id=sender.id, shard=sender_shard, amount=amount,
+        recipient_id=entry.user_id, recipient_shard=entry.shard
+    )
+    session.add(log)
+    await session.commit()
+    started = time.monotonic()
+    async with shard_session(sender_shard) as shard_db:
+        posting = await _debit(shard_db, sender.id, amount)
+        timed_out = time.monotonic() - started > SHARD_WRITE_TIMEOUT
+        if posting is None or timed_out:
+            await shard_db.rollback()
+            await _settle(session, [log.id], "aborted")
+            wallet_operations.inc(operation="transfer", outcome="timeout" if timed_out else "insufficient_funds")
+            return None, None, None
+        transaction = Transaction(
+            id=log.id,
+            user_id=sender.id,
+            amount=-amount,
+            transaction_type="transfer_out",
+            ledger_seq=posting.ledger_seq
+        )
+        shard_db.add(transaction)
+        await shard_db.commit()
+    _remember_balance(sender, posting.balance)
+
+    # Committed from here on; if the credit fails now, recovery applies it
+    try:
+        await _apply_credit(log)
+        await _settle(session, [log.id], "committed")
+    except Exception as e:
+        logger.error("Transfer %s is debited but not yet credited, left to recovery: %s", log.id, e, exc_info=True)
+    _forget_user(recipient_username)
+    wallet_operations.inc(operation="transfer", outcome="ok")
+    return sender, entry, transaction
+
+
+async def purchase(session: AsyncSession, orders: List[Tuple[User, str]], operation: str = "purchase") -> Tuple[List[Union[None, Tuple[Item, Transaction], HTTPException]], List[str]]:
+    # Same contract as crud.apply_flash_sale_orders, except that an order
+    # whose shard failed gets write_outcome_unknown() instead of a result,
+    # and outcomes can also be "timeout" or "error".
+    # Stock is reserved in the main database together with the log rows,
+    # each shard then debits its buyers in one transaction, and reservations
+    # without a debit are handed back.
+    results: List[Union[None, Tuple[Item, Transaction], HTTPException]] = [None] * len(orders)
+    outcomes = ["out_of_stock"] * len(orders)
+    reserved: Dict[int, List[Tuple[int, User, Item, ShardWriteLog]]] = defaultdict(list)
+    for index, (user, item_id) in enumerate(orders):
+        item = (await session.exec(
+            update(Item)
+            .where(Item.id == item_id, Item.stock_val > 0)
+            .values(stock_val=Item.stock_val - 1)
+            .returning(Item)
+            .execution_options(synchronize_session=False, populate_existing=True)
+        )).scalar_one_or_none()
+        if item is None:
+            continue
+        log = ShardWriteLog(kind="purchase", user_id=user.id, shard=shard_for(user.id), amount=item.price, product_id=item_id)
+        session.add(log)
+        snapshot = Item(id=item.id, name=item.name, price=item.price, stock_val=item.stock_val)
+        reserved[log.shard].append((index, user, snapshot, log))
+    await session.commit()
+    if not reserved:
+        for outcome in outcomes:
+            wallet_operations.inc(operation=operation, outcome=outcome)
+        return results, outcomes
+
+    started = time.monotonic()
+    debited: Dict[str, float] = {}
+
+    async def debit(shard: int, entries: List[Tuple[int, User, Item, ShardWriteLog]]) -> None:
+        async with shard_session(shard) as shard_db:
+            shard_results = {}
+            for index, user, item, log in entries:
+                posting = await _debit(shard_db, user.id, log.amount)
+                if posting is None:
+                    outcomes[index] = "insufficient_funds"
+                    continue
+                transaction = Transaction(
+                    id=log.id,
+                    user_id=user.id,
+                    product_id=item.id,
+                    amount=-log.amount,
+                    transaction_type="purchase",
+                    ledger_seq=posting.ledger_seq
+                )
+                shard_db.add(transaction)
+                shard_results[index] = (posting.balance, (item, transaction))
+            if time.monotonic() - started > SHARD_WRITE_TIMEOUT:
+                await shard_db.rollback()
+                for index, _, _, _ in entries:
+                    outcomes[index] = "timeout"
+                return
+            await shard_db.commit()
+        for index, (new_balance, result) in shard_results.items():
+            results[index] = result
+            debited[result[1].id] = new_balance
+
+    shards = list(reserved)
+    failures = await asyncio.gather(*(debit(shard, reserved[shard]) for shard in shards), return_exceptions=True)
+    committed, aborted = [], []
+    for shard, failure in zip(shards, failures):
+        if isinstance(failure, Exception):
+            # Unknown whether the shard committed: left to recovery
+            logger.error("Purchase debits on shard %d failed, left to recovery: %s", shard, failure)
+            for index, _, _, _ in reserved[shard]:
+                outcomes[index] = "error"
+                results[index] = write_outcome_unknown()
+            continue
+        for index, user, _, log in reserved[shard]:
+            if log.id in debited:
+                committed.append(log.id)
+                _remember_balance(user, debited[log.id])
+                outcomes[index] = "ok"
+            else:
+                aborted.append(log.id)
+    await _settle(session, committed, "committed")
+    await _settle(session, aborted, "aborted")
+    _catalog_changed()
+    for outcome in outcomes:
+        wallet_operations.inc(operation=operation, outcome=outcome)
+    return results, outcomes
+
+
+async def recover_pending_writes(grace: float = SHARD_RECOVERY_GRACE) -> Dict[str, int]:
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=grace)
+    counts = {"committed": 0, "aborted": 0}
+    async with async_session() as session:
+        logs = (await session.exec(
+            select(ShardWriteLog)
+            .where(ShardWriteLog.status == "pending", ShardWriteLog.created_at < cutoff)
+            .order_by(ShardWriteLog.created_at)
+        )).all()
+        for log in logs:
+            async with shard_session(log.shard) as shard_db:
+                debited = await shard_db.get(Transaction, log.id) is not None
+            if debited and log.kind == "transfer":
+                await _apply_credit(log)
+            outcome = "committed" if debited else "aborted"
+            counts[outcome] += await _settle(session, [log.id], outcome)
+    if counts["committed"] or counts["aborted"]:
+        logger.warning("Shard write recovery: %d rolled forward, %d aborted", counts["committed"], counts["aborted"])
+    return counts
+
+
+async def fan_out(query: Callable[..., Awaitable[list]], *args) -> list:
+    # Runs query(session, *args) on every shard at once; rows in shard order
+    async def run(session: AsyncSession) -> list:
+        async with session:
+            return await query(session, *args)
+    return [row for rows in await asyncio.gather(*(run(session) for session in shard_sessions())) for row in rows]
+
+
+class ShardWriteRecovery:
+    def __init__(self, interval: float = SHARD_RECOVERY_INTERVAL):
+        self.interval = interval
+        self.runs = 0
+        self.committed = 0
+        self.aborted = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        if enabled:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                counts = await recover_pending_writes()
+                self.runs += 1
+                self.committed += counts["committed"]
+                self.aborted += counts["aborted"]
+            except Exception as e:
+                logger.error("Shard write recovery failed: %s", e, exc_info=True)
+            await asyncio.sleep(self.interval)
+
+    def stats(self) -> dict:
+        return {"runs": self.runs, "committed": self.committed, "aborted": self.aborted}
+
+
+shard_recovery = ShardWriteRecovery()
@@ -0,0 +1,46 @@
+import os
+import tempfile
+import uuid
+
+import pytest
+
+# The engines are bound when src is first imported, so point them at a
+# scratch database before anything imports it
+_workdir = tempfile.mkdtemp(prefix="ewallet-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_workdir, 'test.db')}"
+os.environ["DB_SHARD_URL"] = f"sqlite:///{os.path.join(_workdir, 'test.shard{shard}.db')}"
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+from src.migrate import migrate  # noqa: E402
+
+PASSWORD = "password123"
+
+migrate()
+
+
+@pytest.fixture(scope="session")
+def client():
+    from src.main import app
+    with TestClient(app) as client:
+        yield client
+
+
+@pytest.fixture
+def login(client):
+    # The /auth/login response: access and refresh token
+    def login(username: str) -> dict:
+        response = client.post("/auth/login", json={"username": username, "password": PASSWORD})
+        response.raise_for_status()
+        return response.json()
+    return login
+
+
+@pytest.fixture
+def register(client, login):
+    # Registers a fresh user and returns (username, Authorization header)
+    def register():
+        username = f"user_{uuid.uuid4().hex[:12]}"
+        client.post("/auth/register", json={"username": username, "password": PASSWORD}).raise_for_status()
+        return username, {"Authorization": f"Bearer {login(username)['access_token']}"}
+    return register
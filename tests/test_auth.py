@@ -0,0 +1,25 @@
+def test_refresh_rotates_the_refresh_token(client, register, login):
+    tokens = login(register()[0])
+    response = client.post("/auth/refresh", json={"refresh_token": tokens["refresh_token"]})
+    assert response.status_code == 200
+    rotated = response.json()
+    assert rotated["refresh_token"] != tokens["refresh_token"]
+    me = client.get("/users/me", headers={"Authorization": f"Bearer {rotated['access_token']}"})
+    assert me.status_code == 200
+
+    # The old token was used up by the rotation; the new one still works
+    replayed = client.post("/auth/refresh", json={"refresh_token": tokens["refresh_token"]})
+    assert replayed.status_code == 401
+    assert client.post("/auth/refresh", json={"refresh_token": rotated["refresh_token"]}).status_code == 200
+
+
+def test_logout_revokes_the_refresh_token(client, register, login):
+    tokens = login(register()[0])
+    assert client.post("/auth/logout", json={"refresh_token": tokens["refresh_token"]}).status_code == 200
+    assert client.post("/auth/refresh", json={"refresh_token": tokens["refresh_token"]}).status_code == 401
+
+
+def test_refresh_token_is_not_an_access_token(client, register, login):
+    tokens = login(register()[0])
+    response = client.get("/users/me", headers={"Authorization": f"Bearer {tokens['refresh_token']}"})
+    assert response.status_code == 401
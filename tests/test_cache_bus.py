@@ -0,0 +1,37 @@
+import asyncio
+from datetime import datetime, timezone
+
+from sqlalchemy import insert, update
+
+from src.cache_bus import CacheBus
+from src.crud import add_item
+from src.database import async_session
+from src.flash_sale import flash_sale
+from src.models import CacheInvalidation, Item
+
+
+async def _changed_by_another_worker(item_id: str, **values) -> None:
+    async with async_session() as session:
+        await session.exec(update(Item).where(Item.id == item_id).values(**values))
+        await session.exec(insert(CacheInvalidation.__table__).values(
+            entity="flash_sale", key=item_id, origin="another-worker", created_at=datetime.now(timezone.utc)
+        ))
+        await session.commit()
+
+
+def test_flash_sale_changes_reload_the_counter():
+    async def scenario():
+        async with async_session() as session:
+            item = await add_item(session, "Flash gadget", 10.0, 5, flash_sale=True)
+        flash_sale.enable(item)
+        bus = CacheBus(enabled=True)
+
+        await _changed_by_another_worker(item.id, stock_val=40)
+        await bus.sync()
+        assert flash_sale.stats()["items"][item.id] == 40
+
+        await _changed_by_another_worker(item.id, flash_sale=False)
+        await bus.sync()
+        assert not flash_sale.is_active(item.id)
+
+    asyncio.run(scenario())
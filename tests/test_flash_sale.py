@@ -0,0 +1,33 @@
+import asyncio
+
+from sqlalchemy import update
+
+from src.crud import add_item
+from src.database import async_session
+from src.flash_sale import FlashSaleEngine
+from src.models import Item, User
+
+
+def test_counter_drops_to_zero_when_the_database_is_sold_out():
+    async def scenario():
+        async with async_session() as session:
+            item = await add_item(session, "Sold elsewhere", 10.0, 5, flash_sale=True)
+            # Other workers sold the stock this worker's counter still shows
+            await session.exec(update(Item).where(Item.id == item.id).values(stock_val=0))
+            await session.commit()
+        engine = FlashSaleEngine(max_wait_ms=0)
+        await engine.start()
+        engine.enable(Item(id=item.id, name=item.name, price=item.price, stock_val=5))
+        buyer = User(username="late_buyer", email="late@example.com", hashed_password="x", balance=100.0)
+        try:
+            assert await engine.buy(buyer, item.id) is None
+            assert engine.stats()["items"][item.id] == 0
+            # Turned away from memory from now on, without another batch
+            batches = engine.batches
+            assert await engine.buy(buyer, item.id) is None
+            assert engine.batches == batches
+            assert engine.sold_out == 1
+        finally:
+            await engine.stop()
+
+    asyncio.run(scenario())
@@ -0,0 +1,75 @@
+import asyncio
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from src import profiler
+from src.group_commit import BatchWriter
+
+
+class EchoWriter(BatchWriter):
+    # Items that are exceptions fail on their own; the rest echo back
+    async def _write(self, items):
+        return items
+
+
+def test_an_item_that_fails_on_its_own_only_fails_its_caller():
+    async def scenario():
+        writer = EchoWriter(max_batch=10, max_wait_ms=5)
+        await writer.start()
+        try:
+            return await asyncio.gather(
+                writer.submit("first"), writer.submit(RuntimeError("shard down")), writer.submit("third"),
+                return_exceptions=True,
+            )
+        finally:
+            await writer.stop()
+
+    first, failed, third = asyncio.run(scenario())
+    assert (first, third) == ("first", "third")
+    assert isinstance(failed, RuntimeError)
+
+
+def test_a_failed_batch_fails_every_caller():
+    class FailingWriter(BatchWriter):
+        async def _write(self, items):
+            raise RuntimeError("database down")
+
+    async def scenario():
+        writer = FailingWriter(max_batch=10, max_wait_ms=5)
+        await writer.start()
+        try:
+            return await asyncio.gather(writer.submit(1), writer.submit(2), return_exceptions=True)
+        finally:
+            await writer.stop()
+
+    assert all(isinstance(result, RuntimeError) for result in asyncio.run(scenario()))
+
+
+def test_batch_statements_count_for_every_request_in_the_batch():
+    engine = create_async_engine("sqlite+aiosqlite://")
+    profiler.instrument_engine(engine.sync_engine)
+
+    class QueryWriter(BatchWriter):
+        async def _write(self, items):
+            async with engine.connect() as connection:
+                await connection.execute(text("SELECT 1"))
+            return items
+
+    async def request(writer, profile):
+        profiler._current.set(profile)
+        return await writer.submit(profile.path)
+
+    async def scenario():
+        writer = QueryWriter(max_batch=10, max_wait_ms=5)
+        await writer.start()
+        try:
+            profiles = [profiler.RequestProfile("POST", f"/request{i}") for i in range(2)]
+            await asyncio.gather(*(request(writer, profile) for profile in profiles))
+            return profiles
+        finally:
+            await writer.stop()
+            await engine.dispose()
+
+    for profile in asyncio.run(scenario()):
+        assert [statement for statement, _ in profile.statements] == ["SELECT 1"]
@@ -0,0 +1,112 @@
+import asyncio
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import httpx
+
+from src.auth import create_access_token
+from src.crud import claim_idempotency_key
+from src.database import async_session
+from src.idempotency import IdempotencyMiddleware, IdempotencyStore
+from src.models import IdempotencyRecord
+
+
+def test_retry_is_answered_from_the_stored_response(client, register):
+    _, auth = register()
+    headers = {**auth, "Idempotency-Key": uuid.uuid4().hex}
+    first = client.post("/wallet/top-up", json={"amount": 100}, headers=headers)
+    retry = client.post("/wallet/top-up", json={"amount": 100}, headers=headers)
+    assert first.status_code == 200
+    assert retry.json() == first.json()
+    assert retry.headers["idempotent-replayed"] == "true"
+    assert client.get("/wallet/balance", headers=auth).json() == 1100.0
+
+
+def test_key_reused_with_a_different_body_is_rejected(client, register):
+    _, auth = register()
+    headers = {**auth, "Idempotency-Key": uuid.uuid4().hex}
+    assert client.post("/wallet/top-up", json={"amount": 100}, headers=headers).status_code == 200
+    assert client.post("/wallet/top-up", json={"amount": 200}, headers=headers).status_code == 422
+    assert client.get("/wallet/balance", headers=auth).json() == 1100.0
+
+
+def test_duplicates_of_a_failed_first_attempt_execute_once():
+    calls = 0
+
+    async def spend(scope, receive, send):
+        # The first attempt fails after its duplicates are already waiting
+        nonlocal calls
+        calls += 1
+        attempt = calls
+        await asyncio.sleep(0.2)
+        status = 500 if attempt == 1 else 200
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": b'{"attempt":%d}' % attempt})
+
+    app = IdempotencyMiddleware(spend, paths=["/wallet/spend"])
+    headers = {
+        "Authorization": f"Bearer {create_access_token({'sub': 'alice'})}",
+        "Idempotency-Key": uuid.uuid4().hex,
+    }
+
+    async def send_duplicates():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            first = asyncio.create_task(http.post("/wallet/spend", json={"amount": 10}, headers=headers))
+            await asyncio.sleep(0.05)
+            duplicates = [http.post("/wallet/spend", json={"amount": 10}, headers=headers) for _ in range(3)]
+            return await asyncio.gather(first, *duplicates)
+
+    responses = asyncio.run(send_duplicates())
+    assert [response.status_code for response in responses] == [500, 200, 200, 200]
+    assert calls == 2
+    assert all(response.json() == {"attempt": 2} for response in responses[1:])
+
+
+def test_retry_with_a_refreshed_token_is_deduplicated(client, register):
+    username, auth = register()
+    key = uuid.uuid4().hex
+    first = client.post("/wallet/top-up", json={"amount": 100}, headers={**auth, "Idempotency-Key": key})
+    # A different token for the same user, as after /auth/refresh
+    refreshed = create_access_token({"sub": username}, expires_delta=timedelta(minutes=5))
+    retry = client.post("/wallet/top-up", json={"amount": 100},
+                        headers={"Authorization": f"Bearer {refreshed}", "Idempotency-Key": key})
+    assert retry.headers["idempotent-replayed"] == "true"
+    assert retry.json() == first.json()
+    assert client.get("/wallet/balance", headers=auth).json() == 1100.0
+
+
+def test_keys_are_per_user(client, register):
+    key = uuid.uuid4().hex
+    _, alice = register()
+    _, bob = register()
+    assert client.post("/wallet/top-up", json={"amount": 100}, headers={**alice, "Idempotency-Key": key}).status_code == 200
+    response = client.post("/wallet/top-up", json={"amount": 100}, headers={**bob, "Idempotency-Key": key})
+    assert "idempotent-replayed" not in response.headers
+    assert client.get("/wallet/balance", headers=bob).json() == 1100.0
+
+
+def test_a_claim_abandoned_by_a_crashed_worker_is_taken_over():
+    async def scenario():
+        key = uuid.uuid4().hex
+        async with async_session() as session:
+            # Claimed by a worker that died before answering
+            session.add(IdempotencyRecord(key=key, fingerprint="body", created_at=datetime.now(timezone.utc) - timedelta(minutes=5)))
+            await session.commit()
+        store = IdempotencyStore(claim_timeout=60)
+        return await store.begin(key, "body")
+
+    # None: this request now owns the key and runs
+    assert asyncio.run(scenario()) is None
+
+
+def test_a_claim_within_its_timeout_is_not_taken_over():
+    async def scenario():
+        key = uuid.uuid4().hex
+        async with async_session() as session:
+            assert await claim_idempotency_key(session, key, "body", 60) is None
+            return await claim_idempotency_key(session, key, "body", 60)
+
+    record = asyncio.run(scenario())
+    assert record is not None and record.status_code is None
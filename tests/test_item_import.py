@@ -0,0 +1,33 @@
+import asyncio
+import uuid
+
+from src.database import async_session
+from src.item_import import import_items
+
+
+async def _body(text: str):
+    yield text.encode()
+
+
+def _import(text: str) -> dict:
+    async def run():
+        async with async_session() as session:
+            return await import_items(session, "csv", _body(text))
+    return asyncio.run(run())
+
+
+def test_a_duplicate_only_fails_its_own_line():
+    taken, new = uuid.uuid4().hex, [uuid.uuid4().hex for _ in range(3)]
+    assert _import(f"id,name,price,stock_val\n{taken},first,1.0,1\n")["imported"] == 1
+
+    report = _import(
+        "id,name,price,stock_val\n"
+        f"{new[0]},fresh,1.0,1\n"
+        f"{new[1]},fresh,1.0,1\n"
+        f"{taken},duplicate,1.0,1\n"
+        f"{new[2]},fresh,1.0,1\n"
+        f"{new[2]},repeated in the file,1.0,1\n"
+    )
+    assert report["imported"] == 3
+    assert [error["line"] for error in report["errors"]] == [4, 6]
+    assert all("rejected by the database" in error["errors"][0] for error in report["errors"])
@@ -0,0 +1,48 @@
+import pytest
+
+from src.pagination import encode_cursor
+
+
+def test_transaction_pages_cover_the_history_once(client, register):
+    _, auth = register()
+    for amount in range(1, 12):
+        client.post("/wallet/top-up", json={"amount": amount}, headers=auth).raise_for_status()
+    full = client.get("/transactions", headers=auth).json()
+    assert len(full) == 11
+
+    pages, cursor = [], None
+    while True:
+        params = {"limit": 4, **({"cursor": cursor} if cursor else {})}
+        response = client.get("/transactions", params=params, headers=auth)
+        assert response.status_code == 200
+        pages.append(response.json())
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+
+    assert [len(page) for page in pages] == [4, 4, 3]
+    assert [row["id"] for page in pages for row in page] == [row["id"] for row in full]
+    # Newest first
+    assert [row["amount"] for row in full] == [float(amount) for amount in range(11, 0, -1)]
+
+
+def test_pages_stay_stable_when_new_rows_arrive(client, register):
+    _, auth = register()
+    for amount in range(1, 5):
+        client.post("/wallet/top-up", json={"amount": amount}, headers=auth).raise_for_status()
+    first = client.get("/transactions", params={"limit": 2}, headers=auth)
+    client.post("/wallet/top-up", json={"amount": 99}, headers=auth).raise_for_status()
+    second = client.get("/transactions", params={"limit": 2, "cursor": first.headers["X-Next-Cursor"]}, headers=auth)
+    assert [row["amount"] for row in second.json()] == [2.0, 1.0]
+
+
+@pytest.mark.parametrize("cursor", [
+    "not-a-cursor",
+    encode_cursor("2024-01-01T00:00:00"),
+    encode_cursor(1, 2),
+    encode_cursor("2024-01-01T00:00:00", "id", "extra"),
+])
+def test_malformed_cursor_is_rejected(client, register, cursor):
+    _, auth = register()
+    response = client.get("/transactions", params={"cursor": cursor}, headers=auth)
+    assert response.status_code == 400
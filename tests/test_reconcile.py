@@ -0,0 +1,53 @@
+import asyncio
+from datetime import timedelta
+
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
+from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from src.crud import INITIAL_BALANCE, get_user_by_username, spend_money, top_up_wallet
+from src.database import create_db_engine
+from src.migrate import migrate_database
+from src.models import User, Transaction
+from src.reconcile import reconcile_range
+
+
+def test_a_row_stamped_before_the_checkpoint_is_still_counted(tmp_path):
+    path = tmp_path / "reconcile.db"
+    url = f"sqlite:///{path}"
+    engine = create_db_engine(url)
+    migrate_database(engine)
+    with Session(engine) as session:
+        session.add(User(username="late", email="late@example.com", hashed_password="x", balance=INITIAL_BALANCE))
+        session.commit()
+
+    async def write(operation, amount):
+        async_engine = create_async_engine(f"sqlite+aiosqlite:///{path}", poolclass=NullPool)
+        try:
+            async with AsyncSession(async_engine, expire_on_commit=False) as session:
+                user = await get_user_by_username(session, "late")
+                _, transaction = await operation(session, user, amount)
+                return transaction
+        finally:
+            await async_engine.dispose()
+
+    first = asyncio.run(write(top_up_wallet, 50.0))
+    report = reconcile_range(url, "", None)
+    assert report["checkpoints_written"] == 1 and not report["drifted"]
+
+    # Committed after the checkpoint, but stamped before it (e.g. another
+    # worker's clock running behind)
+    late = asyncio.run(write(spend_money, 30.0))
+    with Session(engine) as session:
+        row = session.get(Transaction, late.id)
+        row.timestamp = first.timestamp - timedelta(minutes=5)
+        session.add(row)
+        session.commit()
+        balance = session.exec(select(User.balance).where(User.username == "late")).one()
+    engine.dispose()
+
+    report = reconcile_range(url, "", None)
+    assert balance == INITIAL_BALANCE + 20.0
+    assert report["transactions"] == 1
+    assert not report["drifted"]
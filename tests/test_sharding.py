@@ -0,0 +1,30 @@
+import asyncio
+import uuid
+
+import pytest
+
+from src import sharding
+from src.crud import add_item
+from src.database import DB_SHARDS, async_session
+
+pytestmark = pytest.mark.skipif(not DB_SHARDS, reason="needs DB_SHARDS")
+
+
+def test_a_failed_shard_is_not_reported_as_a_refusal(client, register, monkeypatch):
+    async def create():
+        async with async_session() as session:
+            return await add_item(session, "Shard-failure widget", 10.0, 5)
+    item = asyncio.run(create())
+    _, auth = register()
+
+    async def shard_down(*args, **kwargs):
+        raise RuntimeError("shard down")
+    monkeypatch.setattr(sharding, "_debit", shard_down)
+
+    headers = {**auth, "Idempotency-Key": uuid.uuid4().hex}
+    first = client.post(f"/items/buy/{item.id}", headers=headers)
+    assert first.status_code == 503
+    # Not stored as the key's answer: the retry runs again
+    retry = client.post(f"/items/buy/{item.id}", headers=headers)
+    assert retry.status_code == 503
+    assert "idempotent-replayed" not in retry.headers
@@ -0,0 +1,78 @@
+import asyncio
+import threading
+
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
+from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from src.crud import INITIAL_BALANCE, get_user_by_username, spend_money
+from src.database import create_db_engine
+from src.migrate import migrate_database
+from src.models import User, Transaction
+
+THREADS = 8
+SPENDS = 30
+AMOUNT = 10.0
+
+
+def _spend(url: str, username: str, results: list) -> None:
+    async def run():
+        # Each thread has its own event loop, so it needs its own engine
+        engine = create_async_engine(url, poolclass=NullPool, connect_args={"timeout": 30})
+        succeeded = 0
+        try:
+            for _ in range(SPENDS):
+                async with AsyncSession(engine, expire_on_commit=False) as session:
+                    user = await get_user_by_username(session, username)
+                    spent, _ = await spend_money(session, user, AMOUNT)
+                    succeeded += spent is not None
+        finally:
+            await engine.dispose()
+        return succeeded
+    results.append(asyncio.run(run()))
+
+
+def test_concurrent_spends_lose_no_update_and_never_overdraw(tmp_path):
+    path = tmp_path / "contention.db"
+    engine = create_db_engine(f"sqlite:///{path}")
+    migrate_database(engine)
+    with Session(engine) as session:
+        session.add(User(username="hammer", email="hammer@example.com", hashed_password="x", balance=INITIAL_BALANCE))
+        session.commit()
+
+    results: list = []
+    threads = [threading.Thread(target=_spend, args=(f"sqlite+aiosqlite:///{path}", "hammer", results))
+               for _ in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with Session(engine) as session:
+        user = session.exec(select(User).where(User.username == "hammer")).one()
+        ledger = session.exec(select(Transaction).where(Transaction.user_id == user.id)).all()
+    engine.dispose()
+
+    # More spends are attempted than the balance covers: exactly as many as
+    # it covers succeed, each with one ledger row
+    expected = int(INITIAL_BALANCE // AMOUNT)
+    assert THREADS * SPENDS > expected
+    assert sum(results) == expected
+    assert user.balance == INITIAL_BALANCE - expected * AMOUNT == 0
+    assert len(ledger) == expected
+
+
+def test_transfers_either_way_round_move_the_money_once(client, register):
+    # Whichever of the two user ids sorts first, a refused debit leaves
+    # the recipient's credit rolled back too
+    (alice, alice_auth), (bob, bob_auth) = register(), register()
+    for auth, recipient in ((alice_auth, bob), (bob_auth, alice)):
+        refused = client.post("/wallet/transfer", json={"recipient_username": recipient, "amount": 5000}, headers=auth)
+        assert refused.status_code == 400
+        moved = client.post("/wallet/transfer", json={"recipient_username": recipient, "amount": 100}, headers=auth)
+        assert moved.status_code == 200
+    for auth in (alice_auth, bob_auth):
+        assert client.get("/wallet/balance", headers=auth).json() == INITIAL_BALANCE
+        amounts = sorted(row["amount"] for row in client.get("/transactions", headers=auth).json())
+        assert amounts == [-100.0, 100.0]